@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+'''
+This script takes as input a path to a file containing patients' clinic notes (in the format read by extract_events.py) and, for each date matcher backend (see date.set_date_matcher()), times a search for every date expression in every note and prints to standard out a line in the following format:
+backend [tab] matches [tab] seconds [tab] matches per second [tab] MB per second [tab] parity
+
+...where seconds is the best of --repeat runs, and parity is 'same' if the backend found exactly the same matches (same positions and text) as the 're' backend, or the number of notes in which it found different ones. Backends whose module is not installed are reported as unavailable.
+
+It also reports how many of the matches are bare years (str9) that are part of a longer run of digits (e.g. in lab values or IDs), which are almost never event dates.
+'''
+
+import argparse
+import logging
+import re
+import time
+from date import DATE_MATCHERS, get_date_regex, get_make_date_regexes
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.WARNING)
+
+
+def main():
+    logging.basicConfig()
+
+    parser = argparse.ArgumentParser(description='Benchmark the date matcher backends on a notes file.')
+    parser.add_argument('notes_filename', help='notes file')
+    parser.add_argument('--backends', nargs='+', choices=DATE_MATCHERS, default=DATE_MATCHERS, help='backends to benchmark (default: all)')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timed runs per backend (default: 5)')
+    args = parser.parse_args()
+
+    notes_file = open(args.notes_filename, encoding='utf-8', errors='replace')
+    texts = get_note_texts(notes_file)
+    notes_file.close()
+    megabytes = sum([len(text) for text in texts]) / 1e6
+
+    reference = find_matches(get_date_regex('re'), texts)
+    print('\t'.join(['backend', 'matches', 'seconds', 'matches/s', 'MB/s', 'parity']))
+    for backend in args.backends:
+        try:
+            regex = get_date_regex(backend)
+        except ImportError:
+            print('%s\tunavailable (module not installed)' % backend)
+            continue
+
+        seconds, matches = time_matches(regex, texts, args.repeat)
+        differing = len([i for i in range(len(texts)) if matches[i] != reference[i]])
+        count = sum([len(note_matches) for note_matches in matches])
+        print('%s\t%s\t%.4f\t%.0f\t%.2f\t%s' % (backend, count, seconds, count/seconds if seconds else 0.0, megabytes/seconds if seconds else 0.0, 'same' if differing == 0 else '%s notes differ' % differing))
+
+    embedded, bare = count_embedded_years(texts, reference)
+    print("Bare years: %s of %s matches, %s of them inside a longer run of digits" % (bare, sum([len(note_matches) for note_matches in reference]), embedded))
+
+
+def get_note_texts(file):
+    '''
+    This method takes as input an open notes file and returns the list of note texts in it.
+    '''
+    texts = []
+    for line in file:
+        line_elements = line.strip().split('\t')
+        if len(line_elements) == 4:
+            texts.append(line_elements[3])
+    return texts
+
+
+def find_matches(regex, texts):
+    '''
+    This method takes as input a compiled date regex and a list of texts, and returns, for each text, the list of (start, end, matched text) 3-tuples of the date expressions found in it.
+    '''
+    return [[(match.start(), match.end(), match.group(0)) for match in regex.finditer(text)] for text in texts]
+
+
+def time_matches(regex, texts, repeat):
+    '''
+    This method takes as input a compiled date regex, a list of texts, and a number of runs, and returns a 2-tuple of the best time in seconds of find_matches() over the texts and its result.
+    '''
+    best = None
+    for i in range(max(repeat, 1)):
+        start = time.perf_counter()
+        matches = find_matches(regex, texts)
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best:
+            best = seconds
+    return (best, matches)
+
+
+def count_embedded_years(texts, matches):
+    '''
+    This method takes as input a list of texts and the matches found in them (see find_matches()), and returns a 2-tuple of the number of matches that are bare years with a digit immediately before or after them, and the number of matches that are bare years.
+    '''
+    year_regex = get_make_date_regexes()[6]
+    embedded = 0
+    bare = 0
+    for text, note_matches in zip(texts, matches):
+        for start, end, string in note_matches:
+            if year_regex.match(string):
+                bare += 1
+                if (start > 0 and text[start-1].isdigit()) or (end < len(text) and text[end].isdigit()):
+                    embedded += 1
+    return (embedded, bare)
+
+
+if __name__=='__main__':
+    main()
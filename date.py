@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 
 # Written by Andrea Kahn & Emily Silgard
 # Last updated Aug. 15, 2014
@@ -9,7 +9,10 @@ This module contains a Date class (a wrapper for python's datetime class that ta
 
 import logging
 import re
+from array import array
+from bisect import bisect_left, bisect_right
 from datetime import datetime
+from functools import lru_cache
 
 LOG = logging.getLogger(__name__)
 LOG.setLevel(logging.WARNING)
@@ -20,40 +23,154 @@ months={'January':'01','February':'02','March':'03','April':'04','May':'05','Jun
 
 month_abrvs={'Jan':'01','Feb':'02','Mar':'03','Apr':'04','Jun':'06','Jul':'07','Aug':'08','Sep':'09','Oct':'10','Nov':'11','Dec':'12'}
 
+# Lowercased month names accepted by the %B and %b directives of strptime() below (as for datetime.strptime(), 'May' is also an abbreviation)
+month_numbers={'%B':dict([(name.lower(), int(number)) for name, number in months.items()]), '%b':dict([(name.lower(), int(number)) for name, number in list(month_abrvs.items())+[('May','05')]])}
+
 # fully named months, with years and possibly with days
-str1 = '('+'|'.join(months.keys())+')[ ,]*(?:([\d]{1,2})(?:st|nd|rd|th)?)?[ ,\']+((?:(?:19)|(?:20)|\')[\d]{2})'
+str1 = '('+'|'.join(months.keys())+')[ ,]*(?:([\\d]{1,2})(?:st|nd|rd|th)?)?[ ,\']+((?:(?:19)|(?:20)|\')[\\d]{2})'
 
 # common month abbreviations, with years and possibly days
-str2 = '('+'|'.join(month_abrvs.keys())+')[ ,\.]*(?:([\d]{1,2})(?:st|nd|rd|th)?)?[ ,\']+((?:(?:19)|(?:20)|\')[\d]{2})'
+str2 = '('+'|'.join(month_abrvs.keys())+')[ ,\\.]*(?:([\\d]{1,2})(?:st|nd|rd|th)?)?[ ,\']+((?:(?:19)|(?:20)|\')[\\d]{2})'
 
 # month/day/year
-str3 = '([\d]{1,2})/([\d]{1,2})/((?:(?:19)|(?:20))?[\d]{2})'
+str3 = '([\\d]{1,2})/([\\d]{1,2})/((?:(?:19)|(?:20))?[\\d]{2})'
 
 # month-day-year
-str4 = '([\d]{1,2})-([\d]{1,2})-((?:(?:19)|(?:20))?[\d]{2})'
+str4 = '([\\d]{1,2})-([\\d]{1,2})-((?:(?:19)|(?:20))?[\\d]{2})'
 
 # month/year or month-year
-str5 = '([\d]{1,2})[/\-]((?:(?:19)|(?:20))[\d]{2})'
+str5 = '([\\d]{1,2})[/\\-]((?:(?:19)|(?:20))[\\d]{2})'
 
 # "year in month" or "year in month abbreviation"
-str6 = '((?:(?:19)|(?:20))[\d]{2}) in ('+'|'.join(month_abrvs.keys())+'|'.join(months.keys())+')'
+str6 = '((?:(?:19)|(?:20))[\\d]{2}) in ('+'|'.join(month_abrvs.keys())+'|'.join(months.keys())+')'
 
 # year/month/day 
-str7 = '((?:(?:19)|(?:20))[\d]{2})/([\d]{1,2})/([\d]{1,2})'
+str7 = '((?:(?:19)|(?:20))[\\d]{2})/([\\d]{1,2})/([\\d]{1,2})'
 
 # year-month-day
-str8 = '((?:(?:19)|(?:20))[\d]{2})-([\d]{1,2})-([\d]{1,2})'
+str8 = '((?:(?:19)|(?:20))[\\d]{2})-([\\d]{1,2})-([\\d]{1,2})'
 
 # just a year
-str9 = '((?:(?:19)|(?:20))[\d]{2})'
+str9 = '((?:(?:19)|(?:20))[\\d]{2})'
 
 # coordinated month and year combos
-str10 = '('+'|'.join(month_abrvs.keys()+months.keys())+')[ ,\.]+and ('+'|'.join(month_abrvs.keys()+months.keys())+')[ ,\']+((?:(?:19)|(?:20))?[\d]{2})'
+str10 = '('+'|'.join(list(month_abrvs.keys())+list(months.keys()))+')[ ,\\.]+and ('+'|'.join(list(month_abrvs.keys())+list(months.keys()))+')[ ,\']+((?:(?:19)|(?:20))?[\\d]{2})'
 
 # coordinated year combos
-str11 = '((?:(?:19)|(?:20))[\d]{2}) and ((?:(?:19)|(?:20))[\d]{2})'
+str11 = '((?:(?:19)|(?:20))[\\d]{2}) and ((?:(?:19)|(?:20))[\\d]{2})'
+
+
+# Globals: Relative Date Expressions (resolved against the creation date of the note they appear in)
+relative_numbers={'a':1,'an':1,'one':1,'two':2,'three':3,'four':4,'five':5,'six':6,'seven':7,'eight':8,'nine':9,'ten':10,'eleven':11,'twelve':12}
+
+# "3 weeks ago", "a year ago", "last month", "yesterday"
+relative_str = r'\b(?:([\d]{1,3}|'+'|'.join(relative_numbers.keys())+r') +(day|week|month|year)s? +ago|last +(week|month|year)|(yesterday))\b'
+
+# Two-digit years are resolved to the century that puts them no more than this many years after the anchor year
+TWO_DIGIT_YEAR_FUTURE_WINDOW = 10
+
+# Values of DateArray.precisions
+YEAR_PRECISION = 0
+MONTH_PRECISION = 1
+DAY_PRECISION = 2
+
+# Days in each month of a non-leap year (index 0 unused)
+days_in_month = [0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+
+
+# The regexes are compiled the first time they are needed rather than at import, so that importing this module stays cheap
+# (date_regex and relative_date_regex remain available as module attributes; see __getattr__())
+
+# Backends for the date expression matcher (see set_date_matcher()):
+# 're' compiles the alternatives str1 ... str11 in their original order with the standard library's re module;
+# 'ordered' (the default) compiles the same alternatives with re, split by their first character, so that most positions in a note are rejected by one character test instead of by trying all eleven alternatives;
+# 'regex' compiles the 'ordered' pattern with the third-party regex module, if it is installed.
+# All three find the same matches.
+DATE_MATCHERS = ['re', 'ordered', 'regex']
+date_matcher = 'ordered'
+
+
+def set_date_matcher(backend):
+    '''
+    This method takes as input the name of a date matcher backend (one of DATE_MATCHERS) and makes it the one returned by get_date_regex(). It raises ValueError for an unknown backend, and ImportError if the backend's module is not installed.
+    '''
+    global date_matcher
+    if backend not in DATE_MATCHERS:
+        raise ValueError("Unknown date matcher %s (choose from %s)" % (backend, ', '.join(DATE_MATCHERS)))
+    compile_date_regex(backend)
+    date_matcher = backend
+
+
+def get_date_regex(backend=None, binary=False):
+    '''
+    This method returns the compiled regex matching any of the date expressions str1 ... str11, for the given backend (default: the one set with set_date_matcher()), or if binary is True, the same regex compiled to match bytes.
+    '''
+    return compile_date_regex(backend or date_matcher, binary)
+
+
+def get_date_pattern(backend):
+    '''
+    This method takes as input the name of a date matcher backend and returns the pattern string it compiles.
+    '''
+    if backend == 're':
+        return '(?:' + ')|(?:'.join([str1, str2, str3, str4, str5, str6, str7, str8, str9, str10, str11]) + ')'
+
+    # Every alternative starts either with a month name (str1, str2, str10) or with a digit (the others), so a lookahead on the first character picks the
+    # group that can match at a position. The groups cannot both match at the same position and each keeps its original order, so the leftmost match
+    # found is the same as with the original pattern.
+    month_initials = ''.join(sorted(set([name[0] for name in list(months.keys()) + list(month_abrvs.keys())])))
+    return '(?=[' + month_initials + '])(?:(?:' + ')|(?:'.join([str1, str2, str10]) + '))|(?=\\d)(?:(?:' + ')|(?:'.join([str3, str4, str5, str6, str7, str8, str9, str11]) + '))'
+
+
+@lru_cache(maxsize=None)
+def compile_date_regex(backend, binary=False):
+    '''
+    This method takes as input the name of a date matcher backend and an optional boolean, and returns its compiled date expression regex (compiled once per backend), matching bytes if binary is True.
+    NB: The patterns are ASCII, and in ASCII text the bytes regex finds the same matches as the str one.
+    '''
+    if backend == 'regex':
+        # Imported here because it is an optional dependency
+        import regex
+        pattern = get_date_pattern('ordered')
+        return regex.compile(pattern.encode('ascii') if binary else pattern)
+    elif backend in DATE_MATCHERS:
+        pattern = get_date_pattern(backend)
+        return re.compile(pattern.encode('ascii') if binary else pattern)
+    raise ValueError("Unknown date matcher %s (choose from %s)" % (backend, ', '.join(DATE_MATCHERS)))
+
+
+@lru_cache(maxsize=None)
+def get_relative_date_regex(binary=False):
+    '''
+    This method returns the compiled (case-insensitive) regex matching relative date expressions, matching bytes if binary is True.
+    '''
+    return re.compile(relative_str.encode('ascii') if binary else relative_str, re.IGNORECASE)
+
+
+@lru_cache(maxsize=None)
+def get_make_date_regexes():
+    '''
+    This method returns a 9-tuple of the compiled regexes used by make_date() to interpret a single date expression.
+    '''
+    mdy1 = re.compile(r'^('+'|'.join(months.keys())+')[ ,]*(?:([\\d]{1,2})(?:st|nd|rd|th)?)?[ ,\']+((?:(?:19)|(?:20)|\')[\\d]{2})$')
+    mdy2 = re.compile(r'^('+'|'.join(month_abrvs.keys())+')[ ,\\.]*(?:([\\d]{1,2})(?:st|nd|rd|th)?)?[ ,\']+((?:(?:19)|(?:20)|\')[\\d]{2})$')
+    mdy3 = re.compile('^([\\d]{1,2})([/\\-])([\\d]{1,2})\\2((?:(?:19)|(?:20))?[\\d]{2})$')
+    mdy4 = re.compile('^([\\d]{1,2})[/\\-]((?:(?:19)|(?:20))[\\d]{2})$')
+    mdy5 = re.compile('^((?:(?:19)|(?:20))[\\d]{2}) in ('+'|'.join(month_abrvs.keys())+'|'.join(months.keys())+')$')
+    mdy6 = re.compile('^((?:(?:19)|(?:20))[\\d]{2})([/\\-])([\\d]{1,2})\\2([\\d]{1,2})$')
+    mdy7 = re.compile('^((?:(?:19)|(?:20))[\\d]{2})$')
+    mdy8 = re.compile('^('+'|'.join(list(month_abrvs.keys())+list(months.keys()))+')(?:[ ,\\.\']+((?:(?:19)|(?:20))?[\\d]{2}))?,? +and +('+'|'.join(list(month_abrvs.keys())+list(months.keys()))+')[ ,\\.\']+((?:(?:19)|(?:20))?[\\d]{2})$')
+    mdy9 = re.compile('^((?:(?:19)|(?:20))[\\d]{2}) +and +((?:(?:19)|(?:20))[\\d]{2})$')
+    return (mdy1, mdy2, mdy3, mdy4, mdy5, mdy6, mdy7, mdy8, mdy9)
 
-date_regex = re.compile('(?:' + ')|(?:'.join([str1, str2, str3, str4, str5, str6, str7, str8, str9, str10, str11]) + ')')
+
+def __getattr__(name):
+    if name == 'date_regex':
+        return get_date_regex()
+    elif name == 'relative_date_regex':
+        return get_relative_date_regex()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 
 
@@ -87,7 +204,7 @@ class Date(object):
 
     
     def __ne__(self, other):
-        return not __eq__(other)
+        return not self.__eq__(other)
 
     
     def __hash__(self):
@@ -96,7 +213,7 @@ class Date(object):
 
     def is_fuzzy_match(self, other):
         '''
-        This method takes as input a second Date object and returns True if the input Date is a fuzzy match for this Date, else False.
+        This method takes as input a second Date object and returns True if the input Date is a fuzzy match for this Date, else False: that is, if the interval of days one of them could be contains the interval of the other (see get_interval()).
         NB: The method returns True for exact matches as well.
         '''
         if type(other) != type(self):
@@ -109,14 +226,30 @@ class Date(object):
         elif (other.dt==None) or (self.dt==None):
             return False
         
-        elif (self.month_known==False) or (other.month_known==False):
-            return (self.dt.year==other.dt.year)
-        
-        elif (self.day_known==False) or (other.day_known==False):
-            return (self.dt.month==other.dt.month and self.dt.year==other.dt.year)
+        # Two precise dates only match if they are equal
+        elif self.day_known and self.month_known and other.day_known and other.month_known:
+            return False
         
         else:
-            return False
+            first, last = self.get_interval()
+            other_first, other_last = other.get_interval()
+            return (first <= other_first and other_last <= last) or (other_first <= first and last <= other_last)
+
+
+    def get_interval(self):
+        '''
+        This method returns a 2-tuple of the first and last day ordinals (see datetime.toordinal()) of the closed interval of days this Date could be: the day itself if the day is known, the whole month if only the month is known, and the whole year if the month is unknown (or None if the Date has no datetime).
+        NB: Year, month, and day intervals are either nested or disjoint.
+        '''
+        if self.dt is None:
+            return None
+        elif not self.month_known:
+            return get_calendar_interval(self.dt.year)
+        elif not self.day_known:
+            return get_calendar_interval(self.dt.year, self.dt.month)
+        else:
+            day = self.dt.toordinal()
+            return (day, day)
 
 
     def make_date_expression(self):
@@ -136,32 +269,90 @@ class Date(object):
 
 
 
+@lru_cache(maxsize=None)
+def get_calendar_interval(year, month=None):
+    '''
+    This method takes as input an int year and optionally an int month, and returns a 2-tuple of the day ordinals of the first and last days of the month (or of the year, if no month is given).
+    '''
+    if month is None:
+        return (datetime(year, 1, 1).toordinal(), datetime(year, 12, 31).toordinal())
+    first = datetime(year, month, 1).toordinal()
+    return (first, first + (29 if month == 2 and is_valid_date(year, 2, 29) else days_in_month[month]) - 1)
+
+
+
+class DateIntervalIndex(object):
+    '''
+    A DateIntervalIndex holds the intervals of a list of Date objects (see Date.get_interval()) sorted by their first day, so that the dates whose intervals overlap a given interval (among them every fuzzy match for a date with that interval) are found by bisection instead of by comparing every date. It has attributes 'starts' and 'ends' (lists of the first and last day ordinals of the intervals, sorted by first day), 'positions' (a list giving, for each interval, the position of its date in the input list), and 'longest' (the length in days of the longest interval).
+    NB: None and Dates without a datetime are not indexed.
+    '''
+    def __init__(self, dates):
+        entries = []
+        for i, date in enumerate(dates):
+            interval = date.get_interval() if date is not None else None
+            if interval is not None:
+                entries.append((interval[0], interval[1], i))
+        entries.sort()
+        self.starts = [entry[0] for entry in entries]
+        self.ends = [entry[1] for entry in entries]
+        self.positions = [entry[2] for entry in entries]
+        self.longest = max([end - start + 1 for start, end, i in entries]) if entries else 0
+
+    def __repr__(self):
+        return "DateIntervalIndex: %s intervals, longest %s days" % (len(self.starts), self.longest)
+
+    def get_overlapping(self, interval):
+        '''
+        This method takes as input a 2-tuple of the first and last day ordinals of an interval and returns the sorted list of the positions (in the input list) of the dates whose intervals overlap it.
+        An interval that starts before the given one can only overlap it if it starts less than 'longest' days before it, so only the intervals starting in that range or inside the given interval are looked at.
+        '''
+        first, last = interval
+        lo = bisect_left(self.starts, first - self.longest + 1)
+        hi = bisect_right(self.starts, last)
+        return sorted([self.positions[k] for k in range(lo, hi) if self.ends[k] >= first])
+
+
+
 def extract_date(string, position):
     '''
     This method takes as input a string from which to extract a date and either 'first' or 'last' (specifying whether to return the first or last date found), and returns the first or last internal string that looks like a date.
     NB: This method returns a string corresponding to a date expression, not a Date object. The output can then be fed to make_date() to generate a Date object.
     '''
+    date = extract_date_match(string, position)
+    if date:
+        return date.group(0)
+
+
+
+def extract_date_match(string, position):
+    '''
+    This method takes the same input as extract_date() and returns the match object for the first or last internal string that looks like a date (or None if there is none), so that the caller can also get its position in the string. The string may also be ASCII bytes, in which case so is the match.
+    '''
+    date_regex = get_date_regex(binary=isinstance(string, bytes))
     if date_regex.search(string):
         if position=='first':
             date = min(date_regex.finditer(string), key=lambda x: x.start())
         if position=='last':
 #           LOG.debug(string)
             date = max(date_regex.finditer(string), key=lambda x: x.start())
-#           LOG.debug("Returning pre-window date %s" % date.group(0))
-        return date.group(0)
+#           LOG.debug("Returning pre-window date %s", date.group(0))
+        return date
 
 
 
-def extract_dates_and_char_indices(string):
+def extract_dates_and_char_indices(string, anchor_year=None):
     '''
-    This method takes as input a string from which to extract dates and returns a list of (Date, start_index, end_index) 3-tuples.
+    This method takes as input a string from which to extract dates (and optionally, an int anchor year against which two-digit years are resolved; see make_date()) and returns a list of (Date, start_index, end_index) 3-tuples.
+    The string may also be ASCII bytes, in which case only the date expressions found are decoded.
     '''
     to_return = []
+    binary = isinstance(string, bytes)
+    date_regex = get_date_regex(binary=binary)
 
     if date_regex.search(string):
         for match in date_regex.finditer(string):
-            LOG.debug("Found date expression: %s" % match.group(0))
-            match_dates = make_date(match.group(0))
+            LOG.debug("Found date expression: %s", match.group(0))
+            match_dates = make_date(match.group(0).decode('ascii') if binary else match.group(0), anchor_year)
             if match_dates:
                 match_date = match_dates[0]
                 match_start = match.start()
@@ -175,21 +366,14 @@ def extract_dates_and_char_indices(string):
 
 
 
-def make_date(string):
+def make_date(string, anchor_year=None):
     '''
     This method takes a string as input and returns a list of representative Date objects. In most cases, this list is length 1, except for the case of coordinated years or coordinated month/year combos, in which the returned list is length 2.
+    If an int anchor year (typically the year the note was written) is given, two-digit years are resolved relative to it (see resolve_two_digit_year()) rather than with strptime's fixed rule (00-68 -> 20xx, 69-99 -> 19xx).
     '''
-    LOG.debug("Creating date from string %s" % string)
+    LOG.debug("Creating date from string %s", string)
     
-    mdy1 = re.compile(r'^('+'|'.join(months.keys())+')[ ,]*(?:([\d]{1,2})(?:st|nd|rd|th)?)?[ ,\']+((?:(?:19)|(?:20)|\')[\d]{2})$')
-    mdy2 = re.compile(r'^('+'|'.join(month_abrvs.keys())+')[ ,\.]*(?:([\d]{1,2})(?:st|nd|rd|th)?)?[ ,\']+((?:(?:19)|(?:20)|\')[\d]{2})$')
-    mdy3 = re.compile('^([\d]{1,2})([/\-])([\d]{1,2})\\2((?:(?:19)|(?:20))?[\d]{2})$')
-    mdy4 = re.compile('^([\d]{1,2})[/\-]((?:(?:19)|(?:20))[\d]{2})$')
-    mdy5 = re.compile('^((?:(?:19)|(?:20))[\d]{2}) in ('+'|'.join(month_abrvs.keys())+'|'.join(months.keys())+')$')
-    mdy6 = re.compile('^((?:(?:19)|(?:20))[\d]{2})([/\-])([\d]{1,2})\\2([\d]{1,2})$')
-    mdy7=re.compile('^((?:(?:19)|(?:20))[\d]{2})$')
-    mdy8 = re.compile('^('+'|'.join(month_abrvs.keys()+months.keys())+')(?:[ ,\.\']+((?:(?:19)|(?:20))?[\d]{2}))?,? +and +('+'|'.join(month_abrvs.keys()+months.keys())+')[ ,\.\']+((?:(?:19)|(?:20))?[\d]{2})$')
-    mdy9 = re.compile('^((?:(?:19)|(?:20))[\d]{2}) +and +((?:(?:19)|(?:20))[\d]{2})$')
+    mdy1, mdy2, mdy3, mdy4, mdy5, mdy6, mdy7, mdy8, mdy9 = get_make_date_regexes()
 
     # Default is to assume years are 4 digits (always check and reset yr_string to 'y' if 2 digits)
     yr_string='Y'
@@ -201,10 +385,10 @@ def make_date(string):
         
         # Start by looking for fully named months, with years and possibly with days  
         if mdy1.match(string).group(2):            
-            dt = make_datetime_myd(mdy1.match(string).group(1),mdy1.match(string).group(3),mdy1.match(string).group(2),'%B,%'+yr_string+',%d')
+            dt = make_datetime_myd(mdy1.match(string).group(1),mdy1.match(string).group(3),mdy1.match(string).group(2),'%B,%'+yr_string+',%d', anchor_year)
             if dt:
                 date = Date(dt)
-                LOG.debug("Input was %s; matched mdy1; returning date %s" % (string, date))
+                LOG.debug("Input was %s; matched mdy1; returning date %s", string, date)
                 return [date]
             else:
                 LOG.warning("Could not create Date object (text: %s)" % string)            
@@ -214,17 +398,17 @@ def make_date(string):
             dt = make_datetime_my(mdy1.match(string).group(1),mdy1.match(string).group(3),'%B,%Y')
             if dt:
                 date = Date(dt, False)
-                LOG.debug("Input was %s; matched mdy1 with no day; returning date %s" % (string, date))
+                LOG.debug("Input was %s; matched mdy1 with no day; returning date %s", string, date)
                 return [date]
             else:
                 LOG.warning("Could not create Date object (text: %s)" % string)
         
         # Deal with abbreviated years with apostrophes
         elif len(mdy1.match(string).group(3))==3:
-            dt = make_datetime_my(mdy1.match(string).group(1),mdy1.match(string).group(3)[1:],'%B,%y')
+            dt = make_datetime_my(mdy1.match(string).group(1),mdy1.match(string).group(3)[1:],'%B,%y', anchor_year)
             if dt:
                 date = Date(dt, False)
-                LOG.debug("Input was %s; matched mdy1 with no day; returning date %s" % (string, date))
+                LOG.debug("Input was %s; matched mdy1 with no day; returning date %s", string, date)
                 return [date]
             else:
                 LOG.warning("Could not create Date object (text: %s)" % string)
@@ -237,9 +421,9 @@ def make_date(string):
             yr_string='y'
             
         if mdy2.match(string).group(2):
-            dt = make_datetime_myd(mdy2.match(string).group(1),mdy2.match(string).group(3),mdy2.match(string).group(2),'%b,%'+yr_string+',%d')
+            dt = make_datetime_myd(mdy2.match(string).group(1),mdy2.match(string).group(3),mdy2.match(string).group(2),'%b,%'+yr_string+',%d', anchor_year)
             date = Date(dt)
-            LOG.debug("Input was %s; matched mdy2; returning date %s" % (string, date))
+            LOG.debug("Input was %s; matched mdy2; returning date %s", string, date)
             return [date]
 
         # Back off to abbreviated month and year (do nothing with month and two digits, which could be year or day)
@@ -247,17 +431,17 @@ def make_date(string):
             dt = make_datetime_my(mdy2.match(string).group(1),mdy2.match(string).group(3),'%b,%Y')
             if dt:
                 date = Date(dt, False)
-                LOG.debug("Input was %s; matched mdy2 with abbreviated month; returning date %s" % (string, date))
+                LOG.debug("Input was %s; matched mdy2 with abbreviated month; returning date %s", string, date)
                 return [date]
             else:
                 LOG.warning("Could not create Date object (text: %s)" % string)
         
         # Back off to abbreviated month and year abbreviated with apostrophe
         elif len(mdy2.match(string).group(3))==3:
-            dt = make_datetime_my(mdy2.match(string).group(1),mdy2.match(string).group(3)[1:],'%b,%y')
+            dt = make_datetime_my(mdy2.match(string).group(1),mdy2.match(string).group(3)[1:],'%b,%y', anchor_year)
             if dt:
                 date = Date(dt, False)
-                LOG.debug("Input was %s; matched mdy2 with abbreviated month; returning date %s" % (string, date))
+                LOG.debug("Input was %s; matched mdy2 with abbreviated month; returning date %s", string, date)
                 return [date]
             else:
                 LOG.warning("Could not create Date object (text: %s)" % string)
@@ -267,10 +451,10 @@ def make_date(string):
         LOG.debug("Matched mdy3")
         if len(mdy3.match(string).group(4))==2:
             yr_string='y'
-        dt = make_datetime_myd(mdy3.match(string).group(1),mdy3.match(string).group(4),mdy3.match(string).group(3),'%m,%'+yr_string+',%d')
+        dt = make_datetime_myd(mdy3.match(string).group(1),mdy3.match(string).group(4),mdy3.match(string).group(3),'%m,%'+yr_string+',%d', anchor_year)
         if dt:
             date = Date(dt)
-            LOG.debug("Input was %s; matched mdy3; returning date %s" % (string, date))
+            LOG.debug("Input was %s; matched mdy3; returning date %s", string, date)
             return [date]
         else:
             LOG.warning("Could not create Date object (text: %s)" % string)
@@ -281,7 +465,7 @@ def make_date(string):
         dt = make_datetime_my(mdy4.match(string).group(1),mdy4.match(string).group(2),'%m,%Y')
         if dt:
             date = Date(dt, False)
-            LOG.debug("Input was %s; matched mdy4; returning date %s" % (string, date))
+            LOG.debug("Input was %s; matched mdy4; returning date %s", string, date)
             return [date]
         else:
             LOG.warning("Could not create Date object (text: %s)" % string)
@@ -295,7 +479,7 @@ def make_date(string):
             dt = make_datetime_my(mdy5.match(string).group(2),mdy5.match(string).group(1),'%b,%Y')
         if dt:
             date = Date(dt, False)
-            LOG.debug("Input was %s; matched mdy5; returning date %s" % (string, date))
+            LOG.debug("Input was %s; matched mdy5; returning date %s", string, date)
             return [date]
         else:
             LOG.warning("Could not create Date object (text: %s)" % string)
@@ -303,11 +487,11 @@ def make_date(string):
     # Back off to year/month/day or year-month-day
     elif mdy6.match(string):
         LOG.debug("Matched mdy6")
-        dt = make_datetime_myd(mdy6.match(string).group(3),mdy6.match(string).group(1),mdy6.match(string).group(4),'%m,%'+yr_string+',%d')
+        dt = make_datetime_myd(mdy6.match(string).group(3),mdy6.match(string).group(1),mdy6.match(string).group(4),'%m,%'+yr_string+',%d', anchor_year)
 
         if dt:
             date = Date(dt)
-            LOG.debug("Input was %s; matched mdy6; returning date %s" % (string, date))
+            LOG.debug("Input was %s; matched mdy6; returning date %s", string, date)
             return [date]
         else:
             LOG.warning("Could not create Date object (text: %s)" % string)
@@ -319,7 +503,7 @@ def make_date(string):
 
         if dt:
             date = Date(dt, False, False)
-            LOG.debug("Input was %s; matched mdy7; returning date %s" % (string, date))
+            LOG.debug("Input was %s; matched mdy7; returning date %s", string, date)
             return [date]
         else:
             LOG.warning("Could not create Date object (text: %s)" % string)
@@ -338,27 +522,27 @@ def make_date(string):
         if len(yr_group)==2:
             yr_string='y'
         
-        if mdy8_match.group(1) in months.keys():
+        if mdy8_match.group(1) in months:
             mo_string = 'B'
         else:
             mo_string = 'b'
-        dt1 = make_datetime_my(mdy8_match.group(1), yr_group, '%'+mo_string+',%'+yr_string)
+        dt1 = make_datetime_my(mdy8_match.group(1), yr_group, '%'+mo_string+',%'+yr_string, anchor_year)
         
         if len(mdy8_match.group(4))==2:
             yr_string='y'
         else:
             yr_string='Y'
 
-        if mdy8_match.group(3) in months.keys():
+        if mdy8_match.group(3) in months:
             mo_string = 'B'
         else:
             mo_string = 'b'
-        dt2 = make_datetime_my(mdy8_match.group(3), mdy8_match.group(4), '%'+mo_string+',%'+yr_string)
+        dt2 = make_datetime_my(mdy8_match.group(3), mdy8_match.group(4), '%'+mo_string+',%'+yr_string, anchor_year)
 
         if dt1 and dt2:
             date1 = Date(dt1, False)
             date2 = Date(dt2, False)
-            LOG.debug("Input was %s; matched mdy8; returning dates %s, %s" % (string, date1, date2))
+            LOG.debug("Input was %s; matched mdy8; returning dates %s, %s", string, date1, date2)
             return [date1, date2]
         else:
             LOG.warning("Could not create Date object (text: %s)" % string)
@@ -374,7 +558,7 @@ def make_date(string):
         if dt1 and dt2:    
             date1 = Date(dt1, False, False)
             date2 = Date(dt2, False, False)
-            LOG.debug("Input was %s; matched mdy9; returning dates %s, %s" % (string, date1, date2))
+            LOG.debug("Input was %s; matched mdy9; returning dates %s, %s", string, date1, date2)
             return [date1, date2]
 
         else:
@@ -385,29 +569,271 @@ def make_date(string):
 
 
 
+class DateArray(object):
+    '''
+    A DateArray stores the dates returned by make_dates() for a list of date expressions in compact columns rather than as Date objects. Each distinct expression is stored once. It has attributes 'years', 'months', 'days', and 'precisions' (arrays with one entry per date; a precision is YEAR_PRECISION, MONTH_PRECISION, or DAY_PRECISION, and unknown months and days are stored as 1, as in a Date object), 'starts' (an array with one entry per distinct expression plus one: the dates of the kth distinct expression are entries starts[k] to starts[k+1]-1, of which there are usually one, none if the expression could not be interpreted, and two for coordinated expressions), and 'expressions' (an array giving, for each input string, the index of its distinct expression).
+    Date objects are only built when asked for, by get_date() or get_dates(), and the latter builds them once per distinct expression.
+    '''
+    def __init__(self):
+        self.years = array('H')
+        self.months = array('B')
+        self.days = array('B')
+        self.precisions = array('B')
+        self.starts = array('L', [0])
+        self.expressions = array('L')
+        self.dates = {}
+
+    def __repr__(self):
+        return "DateArray: %s strings, %s distinct, %s dates" % (len(self), len(self.starts)-1, len(self.years))
+
+    def __len__(self):
+        return len(self.expressions)
+
+    def get_date(self, j):
+        '''
+        This method takes as input the index of an entry and returns a new Date object for it.
+        '''
+        precision = self.precisions[j]
+        return Date(datetime(self.years[j], self.months[j], self.days[j]), precision==DAY_PRECISION, precision!=YEAR_PRECISION)
+
+    def get_dates(self, i):
+        '''
+        This method takes as input the index of an input string and returns the list of Date objects that make_date() returns for it (or an empty list where make_date() returns None).
+        NB: Equal input strings get the same (shared) Date objects.
+        '''
+        k = self.expressions[i]
+        dates = self.dates.get(k)
+        if dates is None:
+            dates = [self.get_date(j) for j in range(self.starts[k], self.starts[k+1])]
+            self.dates[k] = dates
+        return dates
+
+
+def make_dates(strings, anchor_year=None):
+    '''
+    This method takes as input a list of date expression strings (and optionally an anchor year; see make_date()) and returns a DateArray holding, for each string, the dates make_date() would return for it.
+    Each distinct string is interpreted once. The distinct strings are grouped by form: those in the forms written by Date.make_date_expression() (YYYY-MM-DD, MM-YYYY, and YYYY) are converted by slicing and int() alone, a column at a time, and only the others (and any that turn out not to be valid dates) are passed to make_date() one at a time.
+    '''
+    # Index of the distinct expression of each string
+    expressions = {}
+    date_array = DateArray()
+    for string in strings:
+        k = expressions.get(string)
+        if k is None:
+            k = expressions[string] = len(expressions)
+        date_array.expressions.append(k)
+
+    # Entries for each distinct string, as lists of (year, month, day, precision) 4-tuples
+    parsed = {}
+    ymd = []
+    my = []
+    y = []
+    other = []
+    for string in expressions:
+        if len(string) == 10 and string[4] == '-' and string[7] == '-' and string[:2] in ('19', '20'):
+            ymd.append(string)
+        elif len(string) == 7 and string[2] == '-' and string[3:5] in ('19', '20'):
+            my.append(string)
+        elif len(string) == 4 and string[:2] in ('19', '20'):
+            y.append(string)
+        else:
+            other.append(string)
+
+    if ymd:
+        digits = [string for string in ymd if (string[:4]+string[5:7]+string[8:]).isdecimal()]
+        other.extend([string for string in ymd if not (string[:4]+string[5:7]+string[8:]).isdecimal()])
+        for string, year, month, day in zip(digits, map(int, [string[:4] for string in digits]), map(int, [string[5:7] for string in digits]), map(int, [string[8:] for string in digits])):
+            if is_valid_date(year, month, day):
+                parsed[string] = [(year, month, day, DAY_PRECISION)]
+            else:
+                other.append(string)
+
+    if my:
+        digits = [string for string in my if (string[:2]+string[3:]).isdecimal()]
+        other.extend([string for string in my if not (string[:2]+string[3:]).isdecimal()])
+        for string, month, year in zip(digits, map(int, [string[:2] for string in digits]), map(int, [string[3:] for string in digits])):
+            if 1 <= month <= 12:
+                parsed[string] = [(year, month, 1, MONTH_PRECISION)]
+            else:
+                other.append(string)
+
+    if y:
+        other.extend([string for string in y if not string.isdecimal()])
+        for string in y:
+            if string.isdecimal():
+                parsed[string] = [(int(string), 1, 1, YEAR_PRECISION)]
+
+    for string in other:
+        dates = make_date(string, anchor_year) or []
+        parsed[string] = [(date.dt.year, date.dt.month, date.dt.day, DAY_PRECISION if date.day_known else (MONTH_PRECISION if date.month_known else YEAR_PRECISION)) for date in dates]
+
+    for string in expressions:
+        for year, month, day, precision in parsed[string]:
+            date_array.years.append(year)
+            date_array.months.append(month)
+            date_array.days.append(day)
+            date_array.precisions.append(precision)
+        date_array.starts.append(len(date_array.years))
+    return date_array
+
+
+def is_valid_date(year, month, day):
+    '''
+    This method takes as input an int year, month, and day and returns True if they make a valid date, else False.
+    '''
+    if not 1 <= month <= 12 or day < 1:
+        return False
+    if month == 2 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0):
+        return day <= 29
+    return day <= days_in_month[month]
+
+
+
 # Helper methods for converting strings to datetime objects
 # NB: Unknown days or months will default to '1'
-# See https://docs.python.org/2/library/datetime.html for documentation on the format_strings
+# See https://docs.python.org/3/library/datetime.html for documentation on the format_strings
 
 def make_datetime_y(year,format_string):
-    return datetime.strptime(year,format_string)
+    return strptime(year,format_string)
 
 
-def make_datetime_my(month,year,format_string):
+def make_datetime_my(month,year,format_string,anchor_year=None):
     if len(month)==1:month='0'+month
     try:
-        return datetime.strptime(month+','+year,format_string)
+        return resolve_datetime_year(strptime(month+','+year,format_string),format_string,anchor_year)
     except ValueError:
         LOG.warning("Input was month %s, year %s; cannot make date" % (month, year))
 
 
-def make_datetime_myd(month,year,day,format_string):
+def make_datetime_myd(month,year,day,format_string,anchor_year=None):
     if len(month)==1:
         month='0'+month
     if len(day)==1:
         day='0'+day
     try:
-        return datetime.strptime(month+','+year+','+day,format_string)
+        return resolve_datetime_year(strptime(month+','+year+','+day,format_string),format_string,anchor_year)
     except ValueError:
            LOG.warning("ValueError: month %s, year %s, day %s, format_string %s" % (month, year, day, format_string))
-           return None
\ No newline at end of file
+           return None
+
+
+def strptime(string,format_string):
+    # Equivalent to datetime.strptime() for the comma-separated %B, %b, %m, %Y, %y, and %d formats used above, without the cost of
+    # importing _strptime and compiling its locale-dependent regexes on first use; raises ValueError on bad input
+    year, month, day = 1900, 1, 1
+    values = string.split(',')
+    directives = format_string.split(',')
+    if len(values) != len(directives):
+        raise ValueError("%s does not match format %s" % (string, format_string))
+    for value, directive in zip(values, directives):
+        if directive == '%B' or directive == '%b':
+            month = month_numbers[directive].get(value.lower())
+            if month is None:
+                raise ValueError("Unknown month name %s" % value)
+        elif not value.isdigit():
+            raise ValueError("%s does not match format %s" % (string, format_string))
+        elif directive == '%m':
+            month = int(value)
+        elif directive == '%d':
+            day = int(value)
+        elif directive == '%Y':
+            year = int(value)
+        elif directive == '%y':
+            year = int(value) + (2000 if int(value) < 69 else 1900)
+        else:
+            raise ValueError("Unsupported format %s" % format_string)
+    return datetime(year, month, day)
+
+
+def resolve_datetime_year(dt,format_string,anchor_year):
+    # Only two-digit years (%y) are re-resolved; raises ValueError if the resolved year makes the date invalid (e.g. Feb. 29)
+    if anchor_year and '%y' in format_string:
+        return dt.replace(year=resolve_two_digit_year(dt.year % 100, anchor_year))
+    return dt
+
+
+def resolve_two_digit_year(year, anchor_year):
+    '''
+    This method takes as input a two-digit year (an int between 0 and 99) and a four-digit anchor year, and returns the four-digit year in the century that puts it closest to the anchor year without falling more than TWO_DIGIT_YEAR_FUTURE_WINDOW years after it (e.g. 97 -> 1997 and 09 -> 2009 for anchor year 2008).
+    '''
+    resolved = anchor_year - anchor_year % 100 + year
+    if resolved > anchor_year + TWO_DIGIT_YEAR_FUTURE_WINDOW:
+        resolved -= 100
+    elif resolved <= anchor_year + TWO_DIGIT_YEAR_FUTURE_WINDOW - 100:
+        resolved += 100
+    return resolved
+
+
+
+# Methods for resolving dates against the creation date of a note
+
+def make_anchor_date(string):
+    '''
+    This method takes as input a document creation date string in the format YYYY-MM-DD, YYYY-MM, or YYYY and returns a corresponding Date object, or None if the string cannot be interpreted.
+    NB: The string is split on hyphens and converted with int(); no regular expressions or strptime are involved.
+    '''
+    tokens = string.strip().split('-')
+    try:
+        if len(tokens) == 3:
+            return Date(datetime(int(tokens[0]), int(tokens[1]), int(tokens[2])))
+        elif len(tokens) == 2:
+            return Date(datetime(int(tokens[0]), int(tokens[1]), 1), False)
+        elif len(tokens) == 1:
+            return Date(datetime(int(tokens[0]), 1, 1), False, False)
+    except ValueError:
+        pass
+    LOG.warning("Could not interpret document creation date %s" % string)
+
+
+def extract_relative_dates(string, anchor):
+    '''
+    This method takes as input a string (typically the full text of a note) and an anchor Date (typically the creation date of the note), and returns a list of (Date, start_index, end_index) 3-tuples for the relative date expressions in the string ("3 weeks ago", "last month", "yesterday"), in the order in which they appear. The string may also be ASCII bytes.
+    The string is scanned once, and each expression is resolved with integer arithmetic on the anchor date. A resolved Date is never more precise than the anchor: expressions in days are precise, expressions in weeks or months are resolved to a month, and expressions in years to a year.
+    '''
+    to_return = []
+    binary = isinstance(string, bytes)
+
+    for match in get_relative_date_regex(binary).finditer(string):
+        groups = [group.decode('ascii') if binary and group else group for group in match.groups()]
+        if groups[3]:
+            count, unit = 1, 'day'
+        elif groups[2]:
+            count, unit = 1, groups[2].lower()
+        else:
+            count = groups[0].lower()
+            count = int(count) if count.isdigit() else relative_numbers[count]
+            unit = groups[1].lower()
+
+        date = shift_date(anchor, count, unit)
+        if date:
+            LOG.debug("Resolved relative date expression %s to %s", match.group(0), date)
+            to_return.append((date, match.start(), match.end()))
+
+    return to_return
+
+
+def shift_date(anchor, count, unit):
+    '''
+    This method takes as input an anchor Date, an int count, and a unit ('day', 'week', 'month', or 'year'), and returns a Date object for the date count units before the anchor (or None if that date is out of range).
+    '''
+    try:
+        if unit in ['day', 'week'] and anchor.day_known:
+            dt = datetime.fromordinal(anchor.dt.toordinal() - count * (7 if unit=='week' else 1))
+            if unit == 'day':
+                return Date(dt)
+            return Date(datetime(dt.year, dt.month, 1), False)
+
+        elif unit != 'year' and anchor.month_known:
+            if unit == 'month':
+                year, month = divmod(anchor.dt.year * 12 + anchor.dt.month - 1 - count, 12)
+            else:
+                # Days or weeks before a note whose day is unknown: only the month can be resolved (approximately)
+                year, month = divmod(anchor.dt.year * 12 + anchor.dt.month - 1 - (count * (7 if unit=='week' else 1)) // 30, 12)
+            return Date(datetime(year, month + 1, 1), False)
+
+        else:
+            years = count if unit == 'year' else (count * {'day':1, 'week':7, 'month':30}[unit]) // 365
+            return Date(datetime(anchor.dt.year - years, 1, 1), False, False)
+
+    except (ValueError, OverflowError):
+        LOG.warning("Could not shift date %s by %s %s(s)" % (anchor, count, unit))
@@ -1,12 +1,12 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 
 # Written by Andrea Kahn
 # Last updated Aug. 28, 2014
 
 
 import logging
-import re
-from date import *
+from array import array
+from date import DateIntervalIndex
 
 LOG = logging.getLogger(__name__)
 LOG.setLevel(logging.WARNING)
@@ -14,75 +14,273 @@ LOG.setLevel(logging.WARNING)
 
 class DateCandidate(object):
     '''
-    A DateCandidate object stores a Date object, a list of supporting snippets (which are themselves strings), and a confidence score (default is 0).
+    A DateCandidate object stores a Date object, a list of supporting snippets (which are themselves strings), a confidence score (default is 0), a weight (the total weight of the keyword hits supporting it, which is what score_candidates() normalizes; default is the number of snippets, i.e. a weight of 1 per snippet), and the Keyword whose hit it was found near (default is None; combining candidates does not change it).
     '''
 
-    def __init__(self, date, snippets, score=0):
+    def __init__(self, date, snippets, score=0, weight=None, keyword=None):
         self.date = date
         self.snippets = snippets
         self.score = score
+        if weight is None:
+            weight = float(len(snippets))
+        self.weight = weight
+        self.keyword = keyword
 
     def __repr__(self):
-        to_return = "DATE: %s\nSCORE: %s\nSNIPPETS: %s\n" % (self.date, self.score, self.snippets)
+        to_return = "DATE: %s\nSCORE: %s\nWEIGHT: %s\nSNIPPETS: %s\n" % (self.date, self.score, self.weight, self.snippets)
         return to_return
 
     def combine_candidate(self, other):
         '''
-        This method takes another DateCandidate as input and combines it with this one (i.e., adding the scores and concatenating the snippets lists), preserving the date field of this one.
+        This method takes another DateCandidate as input and combines it with this one (i.e., adding the scores and weights and concatenating the snippets lists), preserving the date field of this one.
         '''
-        LOG.debug("Combining DateCandidate %s with DateCandidate %s; preserving Date of the former" % (self, other))
+        LOG.debug("Combining DateCandidate %s with DateCandidate %s; preserving Date of the former", self, other)
         self.snippets.extend(other.snippets)
         self.score += other.score
+        self.weight += other.weight
 
     
 def rerank_candidates(candidates, filter, n):
     '''
     This method takes as input a list of date candidates and collapses them and scores them.
     '''
-    LOG.debug("List is now length %s (beginning of reranking)" % len(candidates))
+    LOG.debug("List is now length %s (beginning of reranking)", len(candidates))
 #   remove_duplicate_candidates(candidates) # add back in when rework fuzzy date resolution
     score_candidates(candidates)
     remove_fuzzy_dates(candidates)
-    LOG.debug("List is now length %s (after collapsing fuzzy dates)" % len(candidates))
+    LOG.debug("List is now length %s (after collapsing fuzzy dates)", len(candidates))
 #   top_n_candidates(candidates, n)
 #   filter_candidates(candidates, filter)
     filter_candidates_keep_top_n(candidates, filter, n)
-    LOG.debug("List is now length %s (after filtering)" % len(candidates))
+    LOG.debug("List is now length %s (after filtering)", len(candidates))
+
+
+# Values of the low two bits of a packed candidate date (see pack_candidate_date())
+YEAR_ONLY = 0
+MONTH_YEAR = 1
+DAY_MONTH_YEAR = 2
+DAY_YEAR = 3
+
+
+class CandidateColumns(object):
+    '''
+    A CandidateColumns object holds the raw (unscored, uncollapsed) date candidates of a batch of patients in flat columns rather than as DateCandidate objects, for rerank_candidate_columns(). It has attributes 'starts' (an array with one entry per patient plus one: the candidates of the kth patient are rows starts[k] to starts[k+1]-1), 'dates' (an array of the dates of the candidates, packed with pack_candidate_date()), and 'weights' (an array of the weights of the candidates).
+    '''
+    def __init__(self):
+        self.starts = array('L', [0])
+        self.dates = array('q')
+        self.weights = array('d')
+
+    def __repr__(self):
+        return "CandidateColumns: %s patients, %s candidates" % (len(self), len(self.dates))
+
+    def __len__(self):
+        return len(self.starts)-1
+
+    def add_patient(self, candidates):
+        '''
+        This method takes as input a patient's list of DateCandidate objects (as returned by extract_events.get_date_candidates()) and appends them as the rows of a new patient.
+        '''
+        for candidate in candidates:
+            self.dates.append(pack_candidate_date(candidate.date))
+            self.weights.append(candidate.weight)
+        self.starts.append(len(self.dates))
+
+    def add_rows(self, dates, weights):
+        '''
+        This method takes as input a list of packed dates (see pack_candidate_date()) and a list of weights of the same length, and appends them as the rows of a new patient.
+        '''
+        self.dates.extend(dates)
+        self.weights.extend(weights)
+        self.starts.append(len(self.dates))
+
+
+def pack_candidate_date(date):
+    '''
+    This method takes as input a Date object and returns it packed as an int: its year, month, and day as the decimal digits YYYYMMDD, times 4, plus YEAR_ONLY, MONTH_YEAR, DAY_MONTH_YEAR, or DAY_YEAR for the fields that are known. Integer division by 400 and 40000 leaves the month and the year.
+    NB: The time of day is dropped, so two Dates are packed alike exactly when they are equal for every Date that make_date() returns.
+    '''
+    if date.month_known:
+        code = DAY_MONTH_YEAR if date.day_known else MONTH_YEAR
+    else:
+        code = DAY_YEAR if date.day_known else YEAR_ONLY
+    return ((date.dt.year*100 + date.dt.month)*100 + date.dt.day)*4 + code
+
+
+def get_packed_date_expression(packed):
+    '''
+    This method takes as input a date packed with pack_candidate_date() and returns the string Date.make_date_expression() returns for it.
+    '''
+    code = packed % 4
+    if code == YEAR_ONLY or code == DAY_YEAR:
+        return '%04d' % (packed // 40000)
+    elif code == MONTH_YEAR:
+        return '%02d-%04d' % (packed // 400 % 100, packed // 40000)
+    else:
+        return '%04d-%02d-%02d' % (packed // 40000, packed // 400 % 100, packed // 4 % 100)
+
+
+def rerank_candidate_columns(columns, filter, n, snippets=False):
+    '''
+    This method takes as input a CandidateColumns object, a minimum score, a minimum number of dates, and a boolean specifying whether the rows holding each output candidate's snippets are wanted (default: False), and reranks each patient's candidates as rerank_candidates() does (scoring, combining identical dates, collapsing month-year and then year-only dates into the more precise dates they could be, and filtering), with the same results down to the last bit of every score. It returns, for each patient, a list of (row, score, rows) 3-tuples in descending order by score, one per candidate output, where row is the candidate whose date is kept and rows is None, or if snippets is True, the list of the rows of the candidates whose snippets it holds, in order.
+    Dates are compared as packed ints, and the candidates that could be a more precise version of a month-year or year-only date are looked up by month or year in a hash, so no Date or DateCandidate objects are built or compared. Steps that cannot change anything for a patient (combining when all dates differ, collapsing when all dates are precise) are skipped.
+    '''
+    results = []
+    starts = columns.starts
+    all_dates = columns.dates
+    all_weights = columns.weights
+
+    for k in range(len(columns)):
+        start = starts[k]
+        dates = all_dates[start:starts[k+1]].tolist()
+        weights = all_weights[start:starts[k+1]].tolist()
+
+        # Score, as in score_candidates()
+        total_weight = float(sum(weights))
+        if total_weight:
+            scores = [weight/total_weight for weight in weights]
+        else:
+            # Only worth a warning if there are candidates (an empty list, e.g. for a patient without keyword hits, scores nothing)
+            if weights:
+                LOG.warning("Candidates have a total weight of 0; setting all scores to 0")
+            scores = [0.0] * len(weights)
+        if sum(scores)-1 > 0.001:
+            LOG.warning("Candidate scores do not add up to 1")
+
+        # Combine identical dates, as in remove_duplicate_candidates(); rows are numbered from 0 within the patient until the end
+        groups = {}
+        for i, packed in enumerate(dates):
+            groups.setdefault(packed, []).append(i)
+        if len(groups) == len(dates):
+            live = list(range(len(dates)))
+            rows = [[i] for i in live] if snippets else None
+        else:
+            live = []
+            rows = [None] * len(dates) if snippets else None
+            for group in groups.values():
+                for j in range(len(group)-1, 0, -1):
+                    scores[group[j-1]] += scores[group[j]]
+                live.append(group[0])
+                if snippets:
+                    rows[group[0]] = group
+
+        # Collapse month-year dates, then year-only dates, as in remove_month_year_dates() and remove_year_only_dates()
+        codes = set([packed % 4 for packed in groups])
+        if MONTH_YEAR in codes:
+            live = collapse_packed_dates(live, dates, scores, rows, (MONTH_YEAR,), (DAY_MONTH_YEAR, DAY_YEAR))
+        if YEAR_ONLY in codes or DAY_YEAR in codes:
+            live = collapse_packed_dates(live, dates, scores, rows, (YEAR_ONLY, DAY_YEAR), (MONTH_YEAR, DAY_MONTH_YEAR))
+
+        # Filter, as in filter_candidates_keep_top_n()
+        if n < 0:
+            LOG.warning("n must be 0 or greater (input: %s); cannot perform filtering" % n)
+        elif len(live) > n:
+            live.sort(key=scores.__getitem__, reverse=True)
+            while len(live) > n and scores[live[-1]] < filter:
+                live.pop()
+        live.sort(key=scores.__getitem__, reverse=True)
+
+        if snippets:
+            results.append([(start+i, scores[i], [start+j for j in rows[i]]) for i in live])
+        else:
+            results.append([(start+i, scores[i], None) for i in live])
+
+    return results
+
+
+def collapse_packed_dates(live, dates, scores, rows, fuzzy_codes, precise_codes):
+    '''
+    This method takes as input a patient's list of candidate rows (numbered from 0), the lists of the packed dates and of the scores of the patient's rows, the list of the combined rows of each candidate (or None, if they are not kept), and the packed date codes of the candidates to collapse and of those they could be a more precise version of. It collapses every fuzzy candidate, from the end of the list, into the precise candidates that are fuzzy matches for it, as in remove_month_year_dates() (for the month-year code) or remove_year_only_dates() (for the year-only codes), and returns the list of the rows left.
+    NB: A month-year date matches the precise dates in the same month, and those with a known day but no month in the same year; a year-only date matches every precise date in the same year.
+    '''
+    # Precise candidates are never removed, so they can be hashed by month and year once
+    by_month = {}
+    by_year = {}
+    for i in live:
+        code = dates[i] % 4
+        if code in precise_codes:
+            if code == DAY_MONTH_YEAR and MONTH_YEAR in fuzzy_codes:
+                by_month.setdefault(dates[i] // 400, []).append(i)
+            else:
+                by_year.setdefault(dates[i] // 40000, []).append(i)
+
+    removed = set()
+    for i in reversed(live):
+        packed = dates[i]
+        if packed % 4 not in fuzzy_codes:
+            continue
+        if packed % 4 == MONTH_YEAR:
+            matches = by_month.get(packed // 400, []) + by_year.get(packed // 40000, [])
+        else:
+            matches = by_year.get(packed // 40000, [])
+        if not matches:
+            continue
+
+        # Matches are taken from the end of the list, as in remove_month_year_dates()
+        matches = sorted(matches, reverse=True)
+        if len(matches) == 1:
+            scores[matches[0]] += scores[i]
+            if rows is not None:
+                rows[matches[0]].extend(rows[i])
+        else:
+            # As in split_candidate()
+            norm_constant = sum([scores[j] for j in matches])
+            for j in matches:
+                if norm_constant:
+                    scores[j] += scores[i] * float(scores[j])/norm_constant
+                else:
+                    scores[j] += scores[i] * float(scores[j])/len(matches)
+                if rows is not None:
+                    rows[j].extend(rows[i])
+        removed.add(i)
+
+    return [i for i in live if i not in removed]
 
 
 def split_candidate(fuzzy_candidate, precise_candidate_list):
     '''
     This method takes as input a single DateCandidate and a list of DateCandidates, divides the score of the single candidate among the candidates in the list proportionally according to their scores, and augments their scores accordingly. It is intended to be used to collapse a fuzzy candidate across multiple more-precise matches. Snippets from the single candidate are appended to the snippets list of every candidate in the list.
     '''
-    LOG.debug("Candidate to split: %s" % fuzzy_candidate)
-    LOG.debug("Candidates to split among: %s" % precise_candidate_list)
+    LOG.debug("Candidate to split: %s", fuzzy_candidate)
+    LOG.debug("Candidates to split among: %s", precise_candidate_list)
     norm_constant = sum([candidate.score for candidate in precise_candidate_list])
-    LOG.debug("Normalization constant is: %s" % norm_constant)
+    LOG.debug("Normalization constant is: %s", norm_constant)
     if norm_constant:
         for candidate in precise_candidate_list:
             candidate.score += fuzzy_candidate.score * float(candidate.score)/norm_constant
             candidate.snippets.extend(fuzzy_candidate.snippets)
+            candidate.weight += fuzzy_candidate.weight
     else:
         for candidate in precise_candidate_list:
             candidate.score += fuzzy_candidate.score * float(candidate.score)/len(precise_candidate_list)
             candidate.snippets.extend(fuzzy_candidate.snippets)
+            candidate.weight += fuzzy_candidate.weight
 
 
 def score_candidates(candidate_list):
     '''
     FIXME: Add more advanced reasoning, e.g. take into account prior score (may actually want two scores, the prior score and a new confidence level)
-    This method takes as input a list of DateCandidate objects, sets their scores (where the score is the number of supporting snippets for this candidate divided by the sum of the number of supporting snippets for all candidates in the list), and returns a list of the scored objects.
+    This method takes as input a list of DateCandidate objects, sets their scores (where the score is the weight of this candidate divided by the sum of the weights of all candidates in the list), and returns a list of the scored objects.
+    NB: With the default weights (1 per snippet), the score is the number of supporting snippets for this candidate divided by the sum of the number of supporting snippets for all candidates in the list.
     '''
+    # Collect the weights once and normalize them in a single pass
+    weights = [c.weight for c in candidate_list]
+    total_weight = float(sum(weights))
+    LOG.debug("%s total weight", total_weight)
 
-    total_snippets = sum([len(c.snippets) for c in candidate_list])
-    LOG.debug("%s total snippets" % total_snippets)
+    if total_weight:
+        scores = [weight/total_weight for weight in weights]
+    else:
+        # Only worth a warning if there are candidates (an empty list, e.g. for a patient without keyword hits, scores nothing)
+        if weights:
+            LOG.warning("Candidates have a total weight of 0; setting all scores to 0")
+        scores = [0.0] * len(weights)
 
-    for candidate in candidate_list:
-        score = len(candidate.snippets)/float(total_snippets)
-        LOG.debug("Score is %s" % score)
+    for candidate, score in zip(candidate_list, scores):
+        LOG.debug("Score is %s", score)
         candidate.score = score
 
-    if sum([x.score for x in candidate_list])-1 > 0.001:
+    if sum(scores)-1 > 0.001:
         LOG.warning("Candidate scores do not add up to 1")
 
 
@@ -90,13 +288,13 @@ def filter_candidates(candidate_list, threshold_score):
     '''
     This method takes as input a list of DateCandidate objects and a threshold score, and removes all candidates whose scores do not meet some minimum threshold.
     '''
-    for i in xrange(len(candidate_list)-1, -1, -1):
+    for i in range(len(candidate_list)-1, -1, -1):
         if candidate_list[i].score < threshold_score:
-            LOG.debug("Removing candidate number %s with score %s" % (i, candidate_list[i].score))
+            LOG.debug("Removing candidate number %s with score %s", i, candidate_list[i].score)
             del candidate_list[i]
 
         else:
-            LOG.debug("Keeping candidate number %s with score %s" % (i, candidate_list[i].score))
+            LOG.debug("Keeping candidate number %s with score %s", i, candidate_list[i].score)
 
 
 def top_n_candidates(candidate_list, n):
@@ -105,11 +303,11 @@ def top_n_candidates(candidate_list, n):
     '''
     if len(candidate_list) > n:
         candidate_list.sort(key=lambda candidate: candidate.score, reverse=True)
-        for i in xrange(len(candidate_list)-1, n-1, -1):
-            LOG.debug("Deleting candidate number %s in list" % i)
+        for i in range(len(candidate_list)-1, n-1, -1):
+            LOG.debug("Deleting candidate number %s in list", i)
             del candidate_list[i]
 
-    LOG.debug("List is now length %s" % len(candidate_list))
+    LOG.debug("List is now length %s", len(candidate_list))
 
 
 def filter_candidates_keep_top_n(candidate_list, threshold_score, n):
@@ -120,16 +318,16 @@ def filter_candidates_keep_top_n(candidate_list, threshold_score, n):
         LOG.warning("n must be 0 or greater (input: %s); cannot perform filtering" % n)
 
     elif len(candidate_list) > n:
-        LOG.debug("Filtering candidate list of length %s" % len(candidate_list))
+        LOG.debug("Filtering candidate list of length %s", len(candidate_list))
         candidate_list.sort(key=lambda candidate: candidate.score, reverse=True)
 
         next_score = candidate_list[-1].score
-        LOG.debug("Lowest-scored candidate has score %s" % next_score)
-        LOG.debug("Highest-scored candidate has score %s" % candidate_list[0].score)
+        LOG.debug("Lowest-scored candidate has score %s", next_score)
+        LOG.debug("Highest-scored candidate has score %s", candidate_list[0].score)
         i = len(candidate_list)-1
         
         while (next_score < threshold_score) and (i >= n):
-            LOG.debug("Removing candidate number %s with score %s" % (i, next_score))
+            LOG.debug("Removing candidate number %s with score %s", i, next_score)
             del candidate_list[i]
             i -= 1
             if i >= 0:
@@ -151,34 +349,41 @@ def remove_fuzzy_dates(candidate_list):
 def remove_duplicate_candidates(candidate_list):
     '''
     This method takes as input a list of DateCandidate objects and combines DateCandidate objects whose dates are identical.
+    Each candidate is combined into the nearest earlier candidate with the same date, working from the end of the list, so each date is left with its first candidate, holding the snippets of all of them in list order. Candidates are grouped by date with a hash, so this takes time linear in the length of the list.
     '''
-    LOG.debug("Removing duplicate candidates from the following list: %s" % candidate_list)
-    for i in xrange(len(candidate_list)-1, -1, -1):
-        for j in xrange(i-1, -1, -1):
-            LOG.debug("Comparing element %s with element %s" % (i, j))
-            if candidate_list[i].date==candidate_list[j].date:
-                LOG.debug("Combining candidate %s in list into candidate %s in list" % (i, j))
-                candidate_list[j].combine_candidate(candidate_list[i])
-                LOG.debug("Removing element %s" % i)
-                del candidate_list[i]
-                break
+    LOG.debug("Removing duplicate candidates from the following list: %s", candidate_list)
+    groups = {}
+    for candidate in candidate_list:
+        groups.setdefault(candidate.date, []).append(candidate)
+
+    for group in groups.values():
+        for i in range(len(group)-1, 0, -1):
+            LOG.debug("Combining candidate %s into candidate %s with the same date", group[i], group[i-1])
+            group[i-1].combine_candidate(group[i])
+
+    candidate_list[:] = [group[0] for group in groups.values()]
 
 
 def remove_year_only_dates(candidate_list):
     '''
     This method takes as input a list of DateCandidate objects. DateCandidates whose 'date' field is just a year that could represent a precise date of one and only one other DateCandidate in the list are combined with the more precise DateCandidate object.
     '''
-    LOG.debug("Removing year-only dates from the following list: %s" % candidate_list)
-    for i in xrange(len(candidate_list)-1, -1, -1):
+    LOG.debug("Removing year-only dates from the following list: %s", candidate_list)
+    # Only year-only candidates are removed, so the candidates with a known month, and their order, stay the same throughout
+    precise = [candidate for candidate in candidate_list if candidate.date.month_known]
+    index = DateIntervalIndex([candidate.date for candidate in precise])
+    for i in range(len(candidate_list)-1, -1, -1):
         # If the date is just a year
         if not candidate_list[i].date.month_known:
         
             # Start at the end of the list and look for candidates whose dates could be a more precise version of this one
-            LOG.debug("Looking for a more precise version of element %s, %s" % (i, candidate_list[i]))
+            LOG.debug("Looking for a more precise version of element %s, %s", i, candidate_list[i])
             matches = []
-            for j in xrange(len(candidate_list)-1, -1, -1):
-                if (candidate_list[j].date.month_known and candidate_list[i].date.is_fuzzy_match(candidate_list[j].date)):
-                    matches.append(candidate_list[j])
+            interval = candidate_list[i].date.get_interval()
+            if interval is not None:
+                for k in reversed(index.get_overlapping(interval)):
+                    if candidate_list[i].date.is_fuzzy_match(precise[k].date):
+                        matches.append(precise[k])
             
             if matches:
                 # If there's one and only one match, combine the candidates
@@ -190,49 +395,54 @@ def remove_year_only_dates(candidate_list):
                     split_candidate(candidate_list[i], matches)
                 
                 del candidate_list[i]
-                LOG.debug("Here is the precise date list now: %s" % candidate_list)
+                LOG.debug("Here is the precise date list now: %s", candidate_list)
 
 
 def remove_month_year_dates(candidate_list):
     '''
     This method takes as input a list of DateCandidate objects. DateCandidates whose 'date' field is just a year that could represent a precise date of one and only one other DateCandidate in the list are combined with the more precise DateCandidate object.
     '''
-    for i in xrange(len(candidate_list)-1, -1, -1):
+    # Only month-year candidates are removed, so the candidates with a known day, and their order, stay the same throughout
+    precise = [candidate for candidate in candidate_list if candidate.date.day_known]
+    index = DateIntervalIndex([candidate.date for candidate in precise])
+    for i in range(len(candidate_list)-1, -1, -1):
         # If the date is a month and year only
         if (candidate_list[i].date.month_known and not candidate_list[i].date.day_known):
         
             # Look for candidates whose dates could be a more precise version of this one
-            LOG.debug("Looking for a more precise version of %s" % candidate_list[i])
+            LOG.debug("Looking for a more precise version of %s", candidate_list[i])
             matches = []
-            for j in xrange(len(candidate_list)-1, -1, -1):
-                if (candidate_list[j].date.day_known and candidate_list[i].date.is_fuzzy_match(candidate_list[j].date)):
-                    LOG.debug("Found match with known day: %s" % candidate_list[j].date)
-                    matches.append(candidate_list[j])
+            interval = candidate_list[i].date.get_interval()
+            if interval is not None:
+                for k in reversed(index.get_overlapping(interval)):
+                    if candidate_list[i].date.is_fuzzy_match(precise[k].date):
+                        LOG.debug("Found match with known day: %s", precise[k].date)
+                        matches.append(precise[k])
             
             # If there's one and only one match, combine the candidates
             if matches:
                 if len(matches)==1:
-                    LOG.debug("Combining %s and %s" % (candidate_list[i], matches[0]))
+                    LOG.debug("Combining %s and %s", candidate_list[i], matches[0])
                     matches[0].combine_candidate(candidate_list[i])
                 else:
                     split_candidate(candidate_list[i], matches)
                 del candidate_list[i]
-                LOG.debug("Here is the precise date list now: %s" % candidate_list)
+                LOG.debug("Here is the precise date list now: %s", candidate_list)
 
 
 def remove_year_only_dates_2(candidate_list):
     '''
     This method takes as input a list of DateCandidate objects. DateCandidates whose 'date' field is just a year that could represent a precise date of one and only one other DateCandidate in the list are combined with the more precise DateCandidate object.
     '''
-    LOG.debug("Removing year-only dates from the following list: %s" % candidate_list)
-    for i in xrange(len(candidate_list)-1, -1, -1):
+    LOG.debug("Removing year-only dates from the following list: %s", candidate_list)
+    for i in range(len(candidate_list)-1, -1, -1):
         # If the date is just a year
         if not candidate_list[i].date.month_known:
         
             # Start at the end of the list and look for candidates whose dates could be a more precise version of this one
-            LOG.debug("Looking for a more precise version of element %s, %s" % (i, candidate_list[i]))
+            LOG.debug("Looking for a more precise version of element %s, %s", i, candidate_list[i])
             matches = []
-            for j in xrange(len(candidate_list)-1, -1, -1):
+            for j in range(len(candidate_list)-1, -1, -1):
                 if (candidate_list[j].date.month_known and candidate_list[i].date.is_fuzzy_match(candidate_list[j].date)):
                     matches.append(candidate_list[j])
             
@@ -244,11 +454,11 @@ def remove_year_only_dates_2(candidate_list):
                     del candidate_list[i]
 
                 else:
-                    LOG.debug("Matches: %s" % matches)
-                    month_year_matches = filter(lambda x: x.date.day_known==False, matches)
-                    LOG.debug("Found %s month/year matches" % len(month_year_matches))
+                    LOG.debug("Matches: %s", matches)
+                    month_year_matches = [x for x in matches if x.date.day_known==False]
+                    LOG.debug("Found %s month/year matches", len(month_year_matches))
                     if len(month_year_matches) > 1:
-                        LOG.warn("Found more than one month/year match: %s" % month_year_matches)
+                        LOG.warning("Found more than one month/year match: %s" % month_year_matches)
                     
                     # If matches are all fuzzy matches for one another (e.g., ["May 2008", "May 3, 2008", "May 5, 2008"]), candidate in question should get combined with the month/year candidate (e.g., "2008" should get combined with "May 2008" in this case)
                     elif len(month_year_matches) > 0 and all(match1.date.is_fuzzy_match(match2.date) for match1 in month_year_matches for match2 in matches):
@@ -262,20 +472,20 @@ def remove_month_year_dates_2(candidate_list):
     '''
     This method takes as input a list of DateCandidate objects. DateCandidates whose 'date' field is just a year that could represent a precise date of one and only one other DateCandidate in the list are combined with the more precise DateCandidate object.
     '''
-    for i in xrange(len(candidate_list)-1, -1, -1):
+    for i in range(len(candidate_list)-1, -1, -1):
         # If the date is a month and year only
         if (candidate_list[i].date.month_known and not candidate_list[i].date.day_known):
         
             # Look for candidates whose dates could be a more precise version of this one
-            LOG.debug("Looking for a more precise version of %s" % candidate_list[i])
+            LOG.debug("Looking for a more precise version of %s", candidate_list[i])
             matches = []
-            for j in xrange(len(candidate_list)-1, -1, -1):
+            for j in range(len(candidate_list)-1, -1, -1):
                 if (candidate_list[j].date.day_known and candidate_list[i].date.is_fuzzy_match(candidate_list[j].date)):
-                    LOG.debug("Found match with known day: %s" % candidate_list[j].date)
+                    LOG.debug("Found match with known day: %s", candidate_list[j].date)
                     matches.append(candidate_list[j])
             
             # If there's one and only one match, combine the candidates
             if matches and len(matches)==1:
-                LOG.debug("Combining %s and %s" % (candidate_list[i], matches[0]))
+                LOG.debug("Combining %s and %s", candidate_list[i], matches[0])
                 matches[0].combine_candidate(candidate_list[i])
                 del candidate_list[i]
\ No newline at end of file
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+'''
+This script takes as input the same arguments as extract_events.py:
+1) A path to a file containing patients' clinic notes (see extract_events.py for the format)
+2) A path to the file containing keywords to search on (see extract_events.py for the format)
+3) Optionally, a float corresponding to the minimum score a date candidate must have in order to be output (default = 0.0)
+4) Optionally, an int corresponding to the minimum number of dates to be output (default = 0)
+
+...as well as a working directory (--workdir), a number of shards (--shards), and a number of worker processes (--processes).
+
+It partitions the notes file into shards by a hash of MRN (so that all of a patient's notes fall in the same shard), runs event date extraction on each shard in a separate worker process, and merges the per-shard outputs into a single output, written to standard out (or to --output), in the format read by eval_output.get_output_dict(): one line per patient, MRNs sorted alphabetically.
+
+Each shard's output is written to the working directory under a temporary name and renamed once it is complete, so that a run that is interrupted can be restarted with the same arguments and will only process the shards that were not finished. The merge is a streaming k-way merge of the (sorted) shard outputs, so it never holds more than one line per shard in memory.
+'''
+
+import argparse
+import heapq
+import hashlib
+import logging
+import os
+import zlib
+from sys import stdout, stderr
+from extract_events import KeywordIndex, KeywordPrefilter, extract_events, format_output_line, get_keywords_list, get_notes_dict
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.WARNING)
+
+MANIFEST_FILENAME = 'manifest.txt'
+PARTITION_DONE_FILENAME = 'partition.done'
+
+
+def main():
+    logging.basicConfig()
+
+    parser = argparse.ArgumentParser(description='Run extract_events.py over hash-partitioned shards of the notes file and merge the results.')
+    parser.add_argument('notes_filename', help='notes file')
+    parser.add_argument('keywords_filename', help='keywords file')
+    parser.add_argument('filter', nargs='?', type=float, default=0.0, help='minimum score of a date candidate (default: 0.0)')
+    parser.add_argument('n', nargs='?', type=int, default=0, help='minimum number of dates output per patient (default: 0)')
+    parser.add_argument('--workdir', required=True, help='directory for shards, per-shard outputs, and checkpoints')
+    parser.add_argument('--shards', type=int, default=8, help='number of shards (default: 8)')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--output', help='write the merged output to this file instead of standard out')
+    args = parser.parse_args()
+
+    if args.shards < 1:
+        parser.error("--shards must be at least 1")
+    if args.processes is None or args.processes < 1:
+        args.processes = 1
+
+    output_filenames = run_shards(args.notes_filename, args.keywords_filename, args.filter, args.n, args.workdir, args.shards, args.processes)
+
+    if args.output:
+        output_file = open(args.output, 'w')
+        merge_shard_outputs(output_filenames, output_file)
+        output_file.close()
+    else:
+        merge_shard_outputs(output_filenames, stdout)
+
+
+def get_shard(MRN, shards):
+    '''
+    This method takes as input an MRN (bytes) and a number of shards, and returns the index of the shard the patient belongs to. The hash is stable across processes and runs (unlike the built-in hash() of strings).
+    '''
+    return zlib.crc32(MRN) % shards
+
+
+def get_shard_filename(workdir, shard, suffix):
+    '''
+    This method takes as input a working directory, a shard index, and a suffix ('notes' or 'out'), and returns the path of the corresponding shard file.
+    '''
+    return os.path.join(workdir, 'shard-%04d.%s' % (shard, suffix))
+
+
+def get_manifest(notes_filename, keywords_filename, filter, n, shards):
+    '''
+    This method takes as input the arguments of a run and returns a list of (name, value) 2-tuples identifying its inputs, so that checkpoints left by a run with different inputs are not reused.
+    '''
+    notes_stat = os.stat(notes_filename)
+    keywords_file = open(keywords_filename, 'rb')
+    keywords_hash = hashlib.sha1(keywords_file.read()).hexdigest()
+    keywords_file.close()
+    return [('notes', os.path.abspath(notes_filename)), ('notes_size', str(notes_stat.st_size)), ('notes_mtime', str(notes_stat.st_mtime_ns)), ('keywords_sha1', keywords_hash), ('filter', repr(filter)), ('n', str(n)), ('shards', str(shards))]
+
+
+def prepare_workdir(workdir, manifest):
+    '''
+    This method takes as input a working directory and a manifest (see get_manifest()), creating the directory if needed. If the directory holds checkpoints from a run with a different manifest, they are removed. Returns True if checkpoints from a matching run may be reused.
+    '''
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+
+    manifest_filename = os.path.join(workdir, MANIFEST_FILENAME)
+    manifest_text = ''.join(['%s\t%s\n' % item for item in manifest])
+    if os.path.exists(manifest_filename):
+        manifest_file = open(manifest_filename)
+        old_manifest_text = manifest_file.read()
+        manifest_file.close()
+        if old_manifest_text == manifest_text:
+            return True
+        LOG.warning("Checkpoints in %s are from a run with different inputs; starting over" % workdir)
+
+    for filename in os.listdir(workdir):
+        if filename.startswith('shard-') or filename == PARTITION_DONE_FILENAME:
+            os.remove(os.path.join(workdir, filename))
+    write_file_atomically(manifest_filename, manifest_text)
+    return False
+
+
+def write_file_atomically(filename, text):
+    '''
+    This method takes as input a path and a string, and writes the string to the path by way of a temporary file that is flushed to disk and then renamed, so that the path either does not exist or holds the complete text.
+    '''
+    temp_filename = filename + '.tmp'
+    file = open(temp_filename, 'w')
+    file.write(text)
+    file.flush()
+    os.fsync(file.fileno())
+    file.close()
+    os.replace(temp_filename, filename)
+
+
+def partition_notes(notes_filename, workdir, shards):
+    '''
+    This method takes as input a path to a notes file, a working directory, and a number of shards, and splits the notes file into one notes file per shard in the working directory (see get_shard()). Lines are copied byte for byte, so malformed lines are reported by get_notes_dict() when their shard is read.
+    The split is skipped if a previous run already completed it.
+    '''
+    done_filename = os.path.join(workdir, PARTITION_DONE_FILENAME)
+    if os.path.exists(done_filename):
+        LOG.debug("Notes already partitioned in %s" % workdir)
+        return
+
+    shard_files = [open(get_shard_filename(workdir, shard, 'notes.tmp'), 'wb') for shard in range(shards)]
+    notes_file = open(notes_filename, 'rb')
+    for line in notes_file:
+        MRN = line.strip().split(b'\t', 1)[0]
+        shard_files[get_shard(MRN, shards)].write(line)
+    notes_file.close()
+
+    for shard, shard_file in enumerate(shard_files):
+        shard_file.flush()
+        os.fsync(shard_file.fileno())
+        shard_file.close()
+        os.replace(get_shard_filename(workdir, shard, 'notes.tmp'), get_shard_filename(workdir, shard, 'notes'))
+    write_file_atomically(done_filename, '')
+
+
+def extract_shard(task):
+    '''
+    This method takes as input a 5-tuple of a shard notes file, a keywords file, a minimum score, a minimum number of dates, and an output path; runs event date extraction on every patient in the shard; and writes one output line per patient, sorted by MRN, to the output path (by way of a temporary file, so that the output path only exists once the shard is complete). It returns a 3-tuple of the output path and the number of notes seen and skipped by the keyword prefilter.
+    It is run in a worker process, so it reads its inputs from disk rather than receiving them from the parent.
+    '''
+    shard_notes_filename, keywords_filename, filter, n, output_filename = task
+
+    keywords_file = open(keywords_filename)
+    keyword_index = KeywordIndex(get_keywords_list(keywords_file))
+    keywords_file.close()
+    prefilter = KeywordPrefilter(keyword_index.keywords)
+
+    notes_file = open(shard_notes_filename, encoding='utf-8', errors='replace')
+    notes_dict = get_notes_dict(notes_file)
+    notes_file.close()
+
+    temp_filename = output_filename + '.tmp'
+    output_file = open(temp_filename, 'w')
+    for MRN in sorted(notes_dict):
+        output_file.write(format_output_line(MRN, extract_events(notes_dict[MRN], keyword_index, filter, n, prefilter)) + '\n')
+    output_file.flush()
+    os.fsync(output_file.fileno())
+    output_file.close()
+    os.replace(temp_filename, output_filename)
+
+    return (output_filename, prefilter.notes_seen, prefilter.notes_skipped)
+
+
+def run_shards(notes_filename, keywords_filename, filter, n, workdir, shards, processes):
+    '''
+    This method takes as input the arguments of a run (see main()), partitions the notes file, and runs extract_shard() on every shard that does not already have a completed output in the working directory, using a pool of 'processes' worker processes (or the current process if 'processes' is 1). It returns the list of per-shard output paths, in shard order.
+    '''
+    reuse = prepare_workdir(workdir, get_manifest(notes_filename, keywords_filename, filter, n, shards))
+    partition_notes(notes_filename, workdir, shards)
+
+    output_filenames = [get_shard_filename(workdir, shard, 'out') for shard in range(shards)]
+    tasks = []
+    for shard in range(shards):
+        if reuse and os.path.exists(output_filenames[shard]):
+            LOG.debug("Shard %s already extracted; skipping" % shard)
+        else:
+            tasks.append((get_shard_filename(workdir, shard, 'notes'), keywords_filename, filter, n, output_filenames[shard]))
+    if len(tasks) < shards:
+        stderr.write("Resuming: %s of %s shards already extracted\n" % (shards-len(tasks), shards))
+
+    if processes == 1 or len(tasks) <= 1:
+        results = [extract_shard(task) for task in tasks]
+    else:
+        # Imported here so that single-process runs do not pay for it
+        import multiprocessing
+        pool = multiprocessing.Pool(min(processes, len(tasks)))
+        try:
+            results = list(pool.imap_unordered(extract_shard, tasks))
+        finally:
+            pool.close()
+            pool.join()
+
+    if results:
+        notes_seen = sum([result[1] for result in results])
+        notes_skipped = sum([result[2] for result in results])
+        stderr.write("Prefilter skipped %s of %s notes (%.1f%%) in %s shards\n" % (notes_skipped, notes_seen, 100.0*notes_skipped/notes_seen if notes_seen else 0.0, len(results)))
+
+    return output_filenames
+
+
+def merge_shard_outputs(output_filenames, file):
+    '''
+    This method takes as input a list of paths to per-shard output files, each sorted by MRN, and an open file object, and writes to the file object the lines of all the shard outputs, sorted by MRN. The shard outputs are merged as streams, one line per shard in memory at a time.
+    '''
+    shard_files = [open(filename) for filename in output_filenames]
+    try:
+        for line in heapq.merge(*shard_files, key=get_line_MRN):
+            file.write(line)
+    finally:
+        for shard_file in shard_files:
+            shard_file.close()
+
+
+def get_line_MRN(line):
+    '''
+    This method takes as input an output line and returns its MRN.
+    '''
+    return line.split('\t', 1)[0]
+
+
+if __name__=='__main__':
+    main()
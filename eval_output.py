@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 
 # Written by Andrea Kahn
 # Last updated Aug. 28, 2014
@@ -9,66 +9,373 @@ This script takes as input:
 2) A path to the gold data file, where each line corresponds with a patient and takes the format: MRN[tab]gold_date_1[tab]gold_date_2 ...
 
 It then calculates various evaluation metrics and prints them to standard out.
+
+Alternatively, it takes as input a match matrix file previously written with --write-matrix (see write_match_matrix()), so that reports can be regenerated without reparsing the output and gold data files.
+
+With --cache, each patient's contributions to the metrics are kept in a cache file keyed by a hash of the patient's output and gold data lines, so that rerunning the evaluation after only some patients' output changed only rematches those patients (see get_incremental_tally()).
+
+With '-' as the output file (or with --progress), output lines are evaluated one patient at a time as they are read, e.g. from extract_events.py through a pipe, and running metrics can be written to standard error along the way (see evaluate_output_stream()).
+
+With --keyword-report, a hits file written by extract_events.py --hits-file is also read, and what each keyword contributes to the metrics is printed (see get_keyword_report()), as an ablation of every keyword from a single extraction run.
+
+With --sample, only a stratified sample of the patients is evaluated (see patient_sample.py), and each metric is printed as an estimate for all the patients with a bootstrap interval (see print_sample_results()). With the same fraction and seed, and the notes and gold data files it was drawn from, the sample is the one extract_events.py --sample processes, so a quick run on a small sample can be evaluated on its own.
 '''
 
-from sys import argv
+import argparse
+import hashlib
 import logging
-from date_candidate import *
+import math
+import os
+from datetime import datetime
+from sys import stdin, stderr
+from date import Date, DateIntervalIndex, make_dates
+from date_candidate import CandidateColumns, DateCandidate, get_packed_date_expression, rerank_candidate_columns
+from patient_sample import PatientSample, count_notes, get_bootstrap_intervals, get_gold_MRNs
 
 LOG = logging.getLogger(__name__)
 LOG.setLevel(logging.WARNING)
 
+# Values of PatientMatches.candidate_matches
+NO_MATCH = 0
+LENIENT_MATCH = 1
+STRICT_MATCH = 2
+
+# print_matrix_results() reports how many patients have a match in the top 1, 2, ..., MAX_TOP_N dates returned
+MAX_TOP_N = 5
+
+# Names of the per-patient counts returned by get_patient_counts(), in order
+COUNT_NAMES = ['gold', 'strict_recalled', 'lenient_recalled', 'returned', 'strict_correct', 'lenient_correct'] + ['%s_top_%d' % (measure, n) for measure in ['strict', 'lenient'] for n in range(1, MAX_TOP_N+1)]
+
+# Part of every row hash in an evaluation cache, so that caches written by a version that matched dates differently are not reused
+EVAL_CACHE_VERSION = '1'
+
+# Start of the field that extract_events.py --flag-limited adds to the end of the output line of a patient that reached an extraction limit
+LIMITED_FIELD_PREFIX = 'LIMITED='
+
 
 def main():
     logging.basicConfig()
+
+    parser = argparse.ArgumentParser(description='Evaluate extract_events.py output against gold data.')
+    parser.add_argument('output_filename', nargs='?', help="non-verbose output of extract_events.py ('-' for standard in, e.g. piped from extract_events.py)")
+    parser.add_argument('gold_data_filename', nargs='?', help='gold data file')
+    parser.add_argument('--matrix', metavar='MATRIX_FILE', help='read a precomputed match matrix instead of the output and gold data files')
+    parser.add_argument('--write-matrix', metavar='MATRIX_FILE', help='write the match matrix to this file for later use with --matrix')
+    parser.add_argument('--cache', metavar='CACHE_FILE', help='reuse the match results in this file for patients whose output and gold data lines have not changed, and update it')
+    parser.add_argument('--progress', type=int, default=0, metavar='K', help='evaluate the output one patient at a time as it is read, writing running metrics to standard error every K patients')
+    parser.add_argument('--keyword-report', metavar='HITS_FILE', help='also print what each keyword contributes to the metrics, from this hits file (written by extract_events.py --hits-file)')
+    parser.add_argument('--sample', type=float, metavar='FRACTION', help='only evaluate a stratified sample of this fraction of the patients, and print estimates of the metrics with bootstrap intervals')
+    parser.add_argument('--sample-seed', type=int, default=0, help='seed of the sample (default: 0)')
+    parser.add_argument('--sample-notes', metavar='NOTES_FILE', help='the notes file the output was extracted from, whose patients make up the population and are stratified by their number of notes, as extract_events.py --sample does (a warning is logged if it is not given)')
+    parser.add_argument('--bootstrap', type=int, default=200, metavar='B', help='number of bootstrap replicates for the intervals with --sample (default: 200)')
+    args = parser.parse_args()
+
+    stream = args.output_filename == '-' or args.progress > 0
+    if args.cache and (args.matrix or args.write_matrix):
+        parser.error("--cache cannot be used with --matrix or --write-matrix")
+    if not (args.matrix or (args.output_filename and args.gold_data_filename)):
+        parser.error("an output file and a gold data file are required unless --matrix is given")
+    if stream and (args.matrix or args.write_matrix or args.cache):
+        parser.error("streaming evaluation (output file '-' or --progress) cannot be used with --matrix, --write-matrix, or --cache")
+    if args.keyword_report and not args.gold_data_filename:
+        parser.error("--keyword-report requires a gold data file")
+    if args.sample is not None and not 0 < args.sample <= 1:
+        parser.error("--sample must be greater than 0 and at most 1")
+    if args.sample is not None and (args.matrix or args.cache or stream):
+        parser.error("--sample cannot be used with --matrix, --cache, or streaming evaluation")
+
+    if args.matrix:
+        matrix_file = open(args.matrix)
+        matrix = get_match_matrix_from_file(matrix_file)
+        matrix_file.close()
+
+    elif stream:
+        # The gold data is indexed up front, so that each patient can be evaluated as soon as its output line arrives
+        gold_data_file = open(args.gold_data_filename)
+        gold_data_dict = get_data_dict(gold_data_file)
+        gold_data_file.close()
+
+        if args.output_filename == '-':
+            tally = evaluate_output_stream(stdin, gold_data_dict, args.progress)
+        else:
+            output_file = open(args.output_filename)
+            tally = evaluate_output_stream(output_file, gold_data_dict, args.progress)
+            output_file.close()
+
+    elif args.cache:
+        if os.path.exists(args.cache):
+            cache_file = open(args.cache)
+            cache = read_eval_cache(cache_file)
+            cache_file.close()
+        else:
+            cache = {}
+
+        output_file = open(args.output_filename)
+        output_lines = get_lines_by_MRN(output_file)
+        output_file.close()
+        gold_data_file = open(args.gold_data_filename)
+        gold_lines = get_lines_by_MRN(gold_data_file)
+        gold_data_file.close()
+
+        tally, cache_lines, reused = get_incremental_tally(output_lines, gold_lines, cache)
+        stderr.write("Re-evaluated %s of %s patients (%s reused from cache %s)\n" % (len(cache_lines)-reused, len(cache_lines), reused, args.cache))
+        write_eval_cache(args.cache, cache_lines)
+
+    elif args.sample is not None:
+        output_file = open(args.output_filename)
+        output_lines = output_file.readlines()
+        output_file.close()
+        gold_data_file = open(args.gold_data_filename)
+        gold_lines = gold_data_file.readlines()
+        gold_data_file.close()
+        if args.sample_notes:
+            notes_file = open(args.sample_notes, encoding='utf-8', errors='replace')
+            note_counts = count_notes(notes_file)
+            notes_file.close()
+        else:
+            note_counts = None
+            LOG.warning("--sample without --sample-notes: the patients are taken to be those in the output or the gold data, without their note volumes, so the strata and weights are not those of the corpus and the sample is not the one extract_events.py --sample processes; give the notes file with --sample-notes")
+
+        MRNs = set([line.strip().split('\t', 1)[0] for line in output_lines + gold_lines])
+        MRNs.update(note_counts or [])
+        sample = PatientSample(sorted(MRNs), args.sample, args.sample_seed, note_counts, get_gold_MRNs(gold_lines))
+        # Only the sampled patients' lines are interpreted, which is most of the time of a full evaluation
+        output_dict = get_output_dict([line for line in output_lines if line.strip().split('\t', 1)[0] in sample])
+        gold_data_dict = get_data_dict([line for line in gold_lines if line.strip().split('\t', 1)[0] in sample])
+        if note_counts is not None:
+            missing = len([MRN for MRN in sample.MRNs if MRN in note_counts and MRN not in output_dict])
+            if missing:
+                LOG.warning("%s sampled patients with notes are not in the output; was it extracted with the same --sample options?" % missing)
+        matrix = get_match_matrix(gold_data_dict, output_dict)
+
+    else:
+        output_file = open(args.output_filename)
+        output_dict = get_output_dict(output_file)
+        output_file.close()
+        LOG.debug("Here is the output dictionary: %s" % output_dict)
+        LOG.debug("%s items in output dictionary" % len(output_dict))
+
+        gold_data_file = open(args.gold_data_filename)
+        gold_data_dict = get_data_dict(gold_data_file)
+        gold_data_file.close()
+        LOG.debug("Here is the gold data dictionary: %s" % gold_data_dict)
+        LOG.debug("%s items in gold data dictionary" % len(gold_data_dict))
+
+        matrix = get_match_matrix(gold_data_dict, output_dict)
+
+    if args.write_matrix:
+        matrix_file = open(args.write_matrix, 'w')
+        write_match_matrix(matrix_file, matrix)
+        matrix_file.close()
     
-    output_filename = argv[1]
-    gold_data_filename = argv[2]
-    
-    output_file = open(output_filename)
-    output_dict = get_output_dict(output_file)
-    output_file.close()
-    LOG.debug("Here is the output dictionary: %s" % output_dict)
-    LOG.debug("%s items in output dictionary" % len(output_dict))
-
-    gold_data_file = open(gold_data_filename)
-    gold_data_dict = get_data_dict(gold_data_file)
-    gold_data_file.close()
-    LOG.debug("Here is the gold data dictionary: %s" % gold_data_dict)
-    LOG.debug("%s items in gold data dictionary" % len(gold_data_dict))
-    
-    print_results(gold_data_dict, output_dict)
-#   print_output_comparison(gold_data_dict, output_dict)
-#   print_output_not_in_top_n(gold_data_dict, output_dict, 5, 'lenient')
+    if args.cache or stream:
+        print_tally_results(tally)
+    elif args.sample is not None:
+        print_sample_results(sample, matrix, args.bootstrap, args.sample_seed)
+    else:
+        print_matrix_results(matrix)
+
+    if args.keyword_report:
+        hits_file = open(args.keyword_report)
+        filter, n, hits = read_hits_file(hits_file)
+        hits_file.close()
+        gold_data_file = open(args.gold_data_filename)
+        gold_data_dict = get_data_dict(gold_data_file)
+        gold_data_file.close()
+        print_keyword_report(get_keyword_report(hits, gold_data_dict, filter, n), gold_data_dict)
+#   print_matrix_comparison(matrix)
+#   print_matrix_not_in_top_n(matrix, 5, 'lenient')
+
+
+class PatientMatches(object):
+    '''
+    A PatientMatches object stores the gold-vs-system match matrix for a single patient. It has attributes 'gold' (a list of gold Date objects), 'candidates' (a list of the DateCandidate objects returned by the system, in descending order by score), 'gold_strict_ranks' and 'gold_lenient_ranks' (lists giving, for each gold date, the 0-based rank of the highest-ranked candidate that is a strict or lenient match for it, or None if there is none), 'candidate_matches' (a list giving, for each candidate, NO_MATCH, LENIENT_MATCH, or STRICT_MATCH against the gold dates), and 'has_gold' and 'has_output' (booleans that are set to False if the patient is absent from the gold data or the system output, respectively).
+    NB: A strict match is also counted as a lenient match, i.e. gold_lenient_ranks[i] <= gold_strict_ranks[i] whenever the latter is not None.
+    '''
+    def __init__(self, gold, candidates, gold_strict_ranks, gold_lenient_ranks, candidate_matches, has_gold=True, has_output=True):
+        self.gold = gold
+        self.candidates = candidates
+        self.gold_strict_ranks = gold_strict_ranks
+        self.gold_lenient_ranks = gold_lenient_ranks
+        self.candidate_matches = candidate_matches
+        self.has_gold = has_gold
+        self.has_output = has_output
+
+    def __repr__(self):
+        return "gold: %s; strict ranks: %s; lenient ranks: %s; candidate matches: %s" % (self.gold, self.gold_strict_ranks, self.gold_lenient_ranks, self.candidate_matches)
+
+    def has_match_in_top_n(self, n, measure='strict'):
+        '''
+        This method takes as input an int n and an optional measure (string 'strict' or 'lenient'; default is 'strict'), and returns True if a match for any gold date appears in the top n candidates, else False.
+        '''
+        if measure == 'lenient':
+            ranks = self.gold_lenient_ranks
+        else:
+            ranks = self.gold_strict_ranks
+        return any(rank is not None and rank < n for rank in ranks)
+
+
+class EvaluationTally(object):
+    '''
+    An EvaluationTally holds the sufficient statistics for the metrics printed by print_matrix_results(), summed over the patients added to it, so that the metrics can be computed without keeping every patient's PatientMatches object. It has attributes 'counts' (a hash of the names in COUNT_NAMES mapped to their sums over the patients; see get_patient_counts()), 'gold_patients' (the number of patients in the gold data), 'dateless_patients' (the number of patients with gold dates for whom no date was returned), 'dates_per_patient' (a list of the number of dates returned for each patient in the output), and 'strict_tp_scores', 'strict_fp_scores', 'lenient_tp_scores', and 'lenient_fp_scores' (the lists returned by get_scores()).
+    NB: Patients are added one at a time, and the score lists are kept in the order in which they were added.
+    '''
+    def __init__(self):
+        self.counts = dict([(name, 0) for name in COUNT_NAMES])
+        self.gold_patients = 0
+        self.dateless_patients = 0
+        self.dates_per_patient = []
+        self.strict_tp_scores = []
+        self.strict_fp_scores = []
+        self.lenient_tp_scores = []
+        self.lenient_fp_scores = []
+
+    def __repr__(self):
+        return "counts: %s; gold patients: %s; dateless patients: %s" % (self.counts, self.gold_patients, self.dateless_patients)
+
+    def add_patient(self, patient):
+        '''
+        This method takes as input a PatientMatches object and adds the patient's contributions to the tally.
+        '''
+        if patient.gold:
+            scores = [(c.score, match) for c, match in zip(patient.candidates, patient.candidate_matches)]
+        else:
+            scores = []
+        self.add_counts(patient.has_gold, patient.has_output, get_patient_counts(patient), scores)
+
+    def add_counts(self, has_gold, has_output, counts, scores):
+        '''
+        This method takes as input booleans specifying whether a patient appears in the gold data and the system output, the patient's list of counts (see get_patient_counts()), and a list of (score, match) 2-tuples for the dates returned for the patient (empty if the patient has no gold dates), and adds the patient's contributions to the tally.
+        '''
+        for name, count in zip(COUNT_NAMES, counts):
+            self.counts[name] += count
+        if has_gold:
+            self.gold_patients += 1
+        if has_output:
+            self.dates_per_patient.append(counts[3])
+            if counts[0] and not counts[3]:
+                self.dateless_patients += 1
+        for score, match in scores:
+            if match == STRICT_MATCH:
+                self.strict_tp_scores.append(score)
+                self.lenient_tp_scores.append(score)
+            elif match == LENIENT_MATCH:
+                self.strict_fp_scores.append(score)
+                self.lenient_tp_scores.append(score)
+            else:
+                self.strict_fp_scores.append(score)
+                self.lenient_fp_scores.append(score)
+
+    def get_recall(self):
+        '''
+        This method returns a 2-tuple of the strict recall and lenient recall, respectively (see get_recall()).
+        '''
+        if self.counts['gold'] == 0:
+            return (0, 0)
+        return (float(self.counts['strict_recalled'])/self.counts['gold'], float(self.counts['lenient_recalled'])/self.counts['gold'])
+
+    def get_precision(self):
+        '''
+        This method returns a 2-tuple of the strict precision and lenient precision, respectively (see get_precision()).
+        '''
+        if self.counts['returned'] == 0:
+            return (0, 0)
+        return (float(self.counts['strict_correct'])/self.counts['returned'], float(self.counts['lenient_correct'])/self.counts['returned'])
+
+    def get_progress_line(self, patients):
+        '''
+        This method takes as input the number of patients evaluated so far and returns a one-line summary (without a trailing newline) of the strict and lenient recall, precision, F1 score, and percentage of patients whose first date returned is a match, over those patients.
+        '''
+        strict_recall, lenient_recall = self.get_recall()
+        strict_precision, lenient_precision = self.get_precision()
+        strict_rank_eval1, lenient_rank_eval1 = self.get_rank_eval(1)
+        return "%s patients: strict R %.4f P %.4f F1 %.4f top-1 %.4f; lenient R %.4f P %.4f F1 %.4f top-1 %.4f" % (patients, strict_recall, strict_precision, get_f1_score(strict_recall, strict_precision), strict_rank_eval1, lenient_recall, lenient_precision, get_f1_score(lenient_recall, lenient_precision), lenient_rank_eval1)
+
+    def get_rank_eval(self, n):
+        '''
+        This method takes as input an int n between 1 and MAX_TOP_N and returns the same 2-tuple as get_rank_eval().
+        '''
+        if self.gold_patients == 0:
+            return (1.0, 1.0)
+        return (float(self.counts['strict_top_%d' % n])/self.gold_patients, float(self.counts['lenient_top_%d' % n])/self.gold_patients)
+
+
+class KeywordContribution(object):
+    '''
+    A KeywordContribution holds what a keyword contributes to the evaluation metrics (see get_keyword_report()). It has attributes 'text' and 'position' (those of the keyword), 'hits' (the number of the keyword's hits that a date was found near), 'patients' (the number of patients with such hits), 'strict_tp' and 'strict_fp' (the number of its hits, in patients with gold dates, supporting a date returned that is or is not a strict match, as in get_scores()), 'lenient_tp' and 'lenient_fp' (the same for lenient matches), and 'deltas' (a list of how much each of the counts named in COUNT_NAMES, summed over the patients, changes when the keyword's hits are removed).
+    NB: A hit supporting several dates returned (a fuzzy date split among more precise ones) counts once for each.
+    '''
+    def __init__(self, text, position):
+        self.text = text
+        self.position = position
+        self.hits = 0
+        self.patients = 0
+        self.strict_tp = 0
+        self.strict_fp = 0
+        self.lenient_tp = 0
+        self.lenient_fp = 0
+        self.deltas = [0] * len(COUNT_NAMES)
+
+    def __repr__(self):
+        return "(%s, %s): %s hits in %s patients" % (self.text, self.position, self.hits, self.patients)
+
+    def add_match(self, match):
+        '''
+        This method takes as input NO_MATCH, LENIENT_MATCH, or STRICT_MATCH for a date returned that one of the keyword's hits supports, and counts the hit as a true or false positive.
+        '''
+        if match == STRICT_MATCH:
+            self.strict_tp += 1
+            self.lenient_tp += 1
+        elif match == LENIENT_MATCH:
+            self.strict_fp += 1
+            self.lenient_tp += 1
+        else:
+            self.strict_fp += 1
+            self.lenient_fp += 1
 
 
 def get_output_dict(file):
     '''
     This method takes as input an open file object and returns a dictionary of MRNs mapped to lists of DateCandidate objects corresponding to the dates returned for that patient.
+    NB: All the date expressions in the file are interpreted in one batch, with make_dates(). There is one line per patient; a later line for an MRN already read is skipped with a warning, as in evaluate_output_stream().
     '''
     output_dict = {}
+    # (MRN, list of date expressions, list of scores) 3-tuples for the well-formed lines, in file order
+    rows = []
+    date_strings = []
     
     for line in file:
         line_elements = line.strip().split('\t')
         MRN = line_elements[0]
+        if line_elements[-1].startswith(LIMITED_FIELD_PREFIX):
+            # The limits the patient reached (extract_events.py --flag-limited)
+            line_elements.pop()
 #       LOG.debug("MRN is %s" % MRN)
-        if not output_dict.get(MRN):
-            output_dict[MRN] = []
+        if MRN in output_dict:
+            LOG.warning("More than one output line for MRN %s; skipping: %s" % (MRN, line))
+            continue
+        output_dict[MRN] = []
         
         if len(line_elements) % 2 != 1:
             LOG.warning("Bad output file line format; skipping: %s" % line)
         else:
 #           LOG.debug("Processing line: %s" % line)
-            for i in xrange(1, len(line_elements), 2):
-                date_vals = make_date(line_elements[i])
-                if date_vals:
-                    date = date_vals[0]
-                else:
-                    LOG.warning("Could not make date: %s" % line_elements[i])
-                    date = None
-                score = float(line_elements[i+1])
-                candidate = DateCandidate(date, [], score)
-                output_dict[MRN].append(candidate)
+            rows.append((MRN, line_elements[1::2], line_elements[2::2]))
+            date_strings.extend(line_elements[1::2])
+
+    date_array = make_dates(date_strings)
+    i = 0
+    for MRN, expressions, scores in rows:
+        candidates = output_dict[MRN]
+        for expression, score in zip(expressions, scores):
+            date_vals = date_array.get_dates(i)
+            if date_vals:
+                date = date_vals[0]
+            else:
+                LOG.warning("Could not make date: %s" % expression)
+                date = None
+            candidates.append(DateCandidate(date, [], float(score)))
+            i += 1
             
     return output_dict
 
@@ -76,8 +383,12 @@ def get_output_dict(file):
 def get_data_dict(file):
     '''
     This method takes as input an open file object and returns a dictionary of MRNs mapped to lists of Date objects corresponding to the gold dates for that patient for the event being evaluated.
+    NB: All the date expressions in the file are interpreted in one batch, with make_dates().
     '''
     data_dict = {}
+    # (MRN, line, number of date expressions) 3-tuples for the well-formed lines, in file order
+    rows = []
+    date_strings = []
     
     for line in file:
         line = line.strip()
@@ -85,60 +396,556 @@ def get_data_dict(file):
         if len(tokens) < 2:
             LOG.warning("Unexpected line format (should be MRN[tab]date ... ); skipping line: %s" % line)
         else:
-            MRN = tokens[0]
-            for i in xrange(1, len(tokens)):
-#               LOG.debug("Trying to make date from: %s" % tokens[i])
-                date_vals = make_date(tokens[i])
-                if not date_vals:
-                    LOG.warning("Could not interpret date expression; skipping line: %s" % line)
-                else:
-                    if data_dict.get(MRN) == None:
-                        data_dict[MRN] = []
-                    data_dict[MRN].extend(date_vals)
+            rows.append((tokens[0], line, len(tokens)-1))
+            date_strings.extend(tokens[1:])
+
+    date_array = make_dates(date_strings)
+    first = 0
+    for MRN, line, count in rows:
+        for i in range(first, first+count):
+#           LOG.debug("Trying to make date from: %s" % date_strings[i])
+            date_vals = date_array.get_dates(i)
+            if not date_vals:
+                LOG.warning("Could not interpret date expression; skipping line: %s" % line)
+            else:
+                if data_dict.get(MRN) == None:
+                    data_dict[MRN] = []
+                data_dict[MRN].extend(date_vals)
+        first += count
     
     return data_dict
 
 
+def get_match_matrix(gold_data, sys_output):
+    '''
+    This method takes as input a hash of MRN mapped to gold dates (Date objects) and a hash of MRNs mapped to lists of DateCandidate objects returned by the system, and returns a hash of MRNs mapped to PatientMatches objects (one for every MRN in either input).
+    '''
+    matrix = {}
+    for MRN in set(gold_data) | set(sys_output):
+        matrix[MRN] = get_patient_matches(gold_data.get(MRN) or [], sys_output.get(MRN) or [], MRN in gold_data, MRN in sys_output)
+    return matrix
+
+
+def get_patient_matches(gold_dates, candidates, has_gold=True, has_output=True):
+    '''
+    This method takes as input a list of gold Date objects and a list of DateCandidate objects returned by the system for a single patient (and optionally, booleans specifying whether the patient appears in the gold data and the system output), and returns a PatientMatches object.
+    Each pair of dates is compared at most once: exact matches are found with a hash lookup, and fuzzy matches are only looked for among the dates returned whose intervals overlap that of the gold date (see date.DateIntervalIndex), since Dates that are fuzzy matches for one another always do.
+    '''
+    ranked = sorted(candidates, key=lambda candidate: candidate.score, reverse=True)
+
+    # Map each date returned to the rank of its first occurrence
+    first_ranks = {}
+    for rank, candidate in enumerate(ranked):
+        if candidate.date not in first_ranks:
+            first_ranks[candidate.date] = rank
+    index = DateIntervalIndex([candidate.date for candidate in ranked])
+
+    candidate_matches = [NO_MATCH] * len(ranked)
+    gold_strict_ranks = []
+    gold_lenient_ranks = []
+
+    for e in gold_dates:
+        strict_rank = first_ranks.get(e)
+        lenient_rank = strict_rank
+        if e is not None and e.dt is not None:
+            for rank in index.get_overlapping(e.get_interval()):
+                if e == ranked[rank].date:
+                    candidate_matches[rank] = STRICT_MATCH
+                elif e.is_fuzzy_match(ranked[rank].date):
+                    if candidate_matches[rank] == NO_MATCH:
+                        candidate_matches[rank] = LENIENT_MATCH
+                else:
+                    continue
+                if lenient_rank is None or rank < lenient_rank:
+                    lenient_rank = rank
+        elif strict_rank is not None:
+            for rank in range(len(ranked)):
+                if e == ranked[rank].date:
+                    candidate_matches[rank] = STRICT_MATCH
+        gold_strict_ranks.append(strict_rank)
+        gold_lenient_ranks.append(lenient_rank)
+
+    return PatientMatches(list(gold_dates), ranked, gold_strict_ranks, gold_lenient_ranks, candidate_matches, has_gold, has_output)
+
+
+def write_match_matrix(file, matrix):
+    '''
+    This method takes as input an open file object and a hash of MRNs mapped to PatientMatches objects, and writes one line per patient in the following format:
+    MRN [tab] has_gold has_output [tab] gold_date,strict_rank,lenient_rank ... [tab] date,score,match ...
+    ...where dates are written as a day ordinal followed by a precision character (see pack_date()), missing ranks are written as '-', and snippets are not preserved.
+    '''
+    for MRN in sorted(matrix):
+        patient = matrix[MRN]
+        flags = '%d%d' % (patient.has_gold, patient.has_output)
+        gold = ' '.join(['%s,%s,%s' % (pack_date(e), pack_rank(strict_rank), pack_rank(lenient_rank)) for e, strict_rank, lenient_rank in zip(patient.gold, patient.gold_strict_ranks, patient.gold_lenient_ranks)])
+        returned = ' '.join(['%s,%r,%d' % (pack_date(c.date), c.score, match) for c, match in zip(patient.candidates, patient.candidate_matches)])
+        file.write('\t'.join([MRN, flags, gold, returned]) + '\n')
+
+
+def get_match_matrix_from_file(file):
+    '''
+    This method takes as input an open file object containing a match matrix written by write_match_matrix() and returns a hash of MRNs mapped to PatientMatches objects.
+    '''
+    matrix = {}
+
+    for line in file:
+        line_elements = line.rstrip('\n').split('\t')
+        if len(line_elements) != 4:
+            LOG.warning("Bad match matrix line format; skipping: %s" % line)
+            continue
+
+        MRN, flags, gold, returned = line_elements
+        gold_dates = []
+        gold_strict_ranks = []
+        gold_lenient_ranks = []
+        for entry in gold.split():
+            packed_date, strict_rank, lenient_rank = entry.split(',')
+            gold_dates.append(unpack_date(packed_date))
+            gold_strict_ranks.append(unpack_rank(strict_rank))
+            gold_lenient_ranks.append(unpack_rank(lenient_rank))
+
+        candidates = []
+        candidate_matches = []
+        for entry in returned.split():
+            packed_date, score, match = entry.split(',')
+            candidates.append(DateCandidate(unpack_date(packed_date), [], float(score)))
+            candidate_matches.append(int(match))
+
+        matrix[MRN] = PatientMatches(gold_dates, candidates, gold_strict_ranks, gold_lenient_ranks, candidate_matches, flags[0]=='1', flags[1]=='1')
+
+    return matrix
+
+
+def evaluate_output_stream(file, gold_data, progress=0, progress_file=stderr):
+    '''
+    This method takes as input an open file object (or stream) of output lines in the format read by get_output_dict(), one line per patient, a hash of MRNs mapped to gold dates (Date objects), and optionally an int 'progress' and a file object to which a line of running metrics (see EvaluationTally.get_progress_line()) is written every 'progress' patients (never if it is 0). Each patient is matched against the gold data as soon as its line is read, so evaluation can keep pace with extract_events.py writing into a pipe.
+    It returns an EvaluationTally. Once the whole stream has been read, the gold patients absent from the output are added, so that the tally is the same as get_eval_tally() returns for the match matrix of the whole output; if the stream is interrupted (KeyboardInterrupt, e.g. to stop a tuning run that is clearly worse), the tally only covers the patients read so far.
+    '''
+    tally = EvaluationTally()
+    seen = set()
+    try:
+        for line in file:
+            MRN = line.strip().split('\t', 1)[0]
+            if MRN in seen:
+                LOG.warning("More than one output line for MRN %s; skipping: %s" % (MRN, line))
+                continue
+            seen.add(MRN)
+            candidates = get_output_dict([line])[MRN]
+            tally.add_patient(get_patient_matches(gold_data.get(MRN) or [], candidates, MRN in gold_data, True))
+            if progress and len(seen) % progress == 0:
+                progress_file.write(tally.get_progress_line(len(seen)) + '\n')
+                progress_file.flush()
+    except KeyboardInterrupt:
+        LOG.warning("Interrupted after %s patients; metrics only cover the patients evaluated so far" % len(seen))
+        return tally
+
+    for MRN in gold_data:
+        if MRN not in seen:
+            tally.add_patient(get_patient_matches(gold_data[MRN], [], True, False))
+    return tally
+
+
+def get_lines_by_MRN(file):
+    '''
+    This method takes as input an open output or gold data file and returns a hash of MRNs mapped to the lists of lines (stripped of surrounding whitespace) for that patient, in file order. The lines are not interpreted.
+    '''
+    lines_by_MRN = {}
+    for line in file:
+        line = line.strip()
+        lines_by_MRN.setdefault(line.split('\t', 1)[0], []).append(line)
+    return lines_by_MRN
+
+
+def get_row_hash(output_lines, gold_lines):
+    '''
+    This method takes as input the lists of a patient's output lines and gold data lines (either of which is None if the patient is absent from that file), and returns a hex digest identifying them, for the evaluation cache.
+    '''
+    digest = hashlib.sha1(EVAL_CACHE_VERSION.encode('utf-8'))
+    for lines in [output_lines, gold_lines]:
+        if lines is None:
+            digest.update(b'\x00-')
+        else:
+            digest.update(b'\x00' + '\n'.join(lines).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def read_eval_cache(file):
+    '''
+    This method takes as input an open evaluation cache file (see format_eval_cache_line()) and returns a hash of MRNs mapped to (row hash, line) 2-tuples, where the line is the whole cache line (without its trailing newline).
+    '''
+    cache = {}
+    for line in file:
+        line = line.rstrip('\n')
+        line_elements = line.split('\t', 2)
+        if len(line_elements) != 3:
+            LOG.warning("Bad evaluation cache line format; skipping: %s" % line)
+            continue
+        cache[line_elements[1]] = (line_elements[0], line)
+    return cache
+
+
+def format_eval_cache_line(row_hash, MRN, patient):
+    '''
+    This method takes as input a row hash (see get_row_hash()), an MRN, and the PatientMatches object for that patient, and returns a line (without a trailing newline) holding the patient's contributions to the evaluation metrics, in the following format:
+    row hash [tab] MRN [tab] has_gold has_output [tab] counts [tab] score,match ...
+    ...where the counts are those returned by get_patient_counts(), separated by spaces, and the scores and matches of the dates returned are only listed if the patient has gold dates.
+    '''
+    counts = get_patient_counts(patient)
+    if patient.gold:
+        scores = ' '.join(['%r,%d' % (c.score, match) for c, match in zip(patient.candidates, patient.candidate_matches)])
+    else:
+        scores = ''
+    return '\t'.join([row_hash, MRN, '%d%d' % (patient.has_gold, patient.has_output), ' '.join([str(count) for count in counts]), scores])
+
+
+def parse_eval_cache_line(line):
+    '''
+    This method takes as input an evaluation cache line (see format_eval_cache_line()) and returns the arguments of EvaluationTally.add_counts() for the patient, as a 4-tuple, or None if the line is malformed.
+    '''
+    line_elements = line.split('\t')
+    if len(line_elements) != 5 or len(line_elements[2]) != 2:
+        return None
+    counts = [int(count) for count in line_elements[3].split()]
+    if len(counts) != len(COUNT_NAMES):
+        return None
+    scores = []
+    for entry in line_elements[4].split():
+        score, match = entry.split(',')
+        scores.append((float(score), int(match)))
+    return (line_elements[2][0]=='1', line_elements[2][1]=='1', counts, scores)
+
+
+def get_incremental_tally(output_lines, gold_lines, cache):
+    '''
+    This method takes as input hashes of MRNs mapped to their output lines and gold data lines (see get_lines_by_MRN()) and an evaluation cache (see read_eval_cache()), and returns a 3-tuple of an EvaluationTally for all the patients (the same as get_eval_tally() returns for the match matrix of the whole files), a hash of MRNs mapped to their updated cache lines, and the number of patients whose contributions were taken from the cache.
+    Only the patients whose output or gold data lines changed since the cache was written (or who are not in it) have their lines interpreted and their dates matched; the others only have their cached counts and scores added to the tally.
+    '''
+    tally = EvaluationTally()
+    cache_lines = {}
+    row_hashes = {}
+    changed_output_lines = []
+    changed_gold_lines = []
+    reused = 0
+
+    for MRN in set(output_lines) | set(gold_lines):
+        row_hash = get_row_hash(output_lines.get(MRN), gold_lines.get(MRN))
+        cached = cache.get(MRN)
+        contributions = None
+        if cached and cached[0] == row_hash:
+            contributions = parse_eval_cache_line(cached[1])
+        if contributions:
+            tally.add_counts(*contributions)
+            cache_lines[MRN] = cached[1]
+            reused += 1
+        else:
+            row_hashes[MRN] = row_hash
+            changed_output_lines.extend(output_lines.get(MRN, []))
+            changed_gold_lines.extend(gold_lines.get(MRN, []))
+
+    output_dict = get_output_dict(changed_output_lines)
+    gold_data_dict = get_data_dict(changed_gold_lines)
+    for MRN in row_hashes:
+        # A patient whose gold data lines are all malformed and who has no output is not in the match matrix, so it contributes nothing
+        if MRN in gold_data_dict or MRN in output_dict:
+            patient = get_patient_matches(gold_data_dict.get(MRN) or [], output_dict.get(MRN) or [], MRN in gold_data_dict, MRN in output_dict)
+            tally.add_patient(patient)
+            cache_lines[MRN] = format_eval_cache_line(row_hashes[MRN], MRN, patient)
+
+    return (tally, cache_lines, reused)
+
+
+def write_eval_cache(filename, cache_lines):
+    '''
+    This method takes as input a path and a hash of MRNs mapped to evaluation cache lines, and writes the lines to the path, sorted by MRN. The file is written under a temporary name and then renamed, so that an interrupted run leaves the previous cache intact.
+    '''
+    temp_filename = filename + '.tmp'
+    file = open(temp_filename, 'w')
+    for MRN in sorted(cache_lines):
+        file.write(cache_lines[MRN] + '\n')
+    file.close()
+    os.replace(temp_filename, filename)
+
+
+# Helper methods for the compact on-disk match matrix format
+# Dates are packed as their day ordinal plus a character for the known fields: 'd' (day and month known), 'm' (month known), 'y' (neither known), or 'x' (day known without month)
+
+def pack_date(date):
+    if date is None or date.dt is None:
+        return '-'
+    elif date.month_known:
+        return str(date.dt.toordinal()) + ('d' if date.day_known else 'm')
+    else:
+        return str(date.dt.toordinal()) + ('x' if date.day_known else 'y')
+
+
+def unpack_date(string):
+    if string == '-':
+        return None
+    dt = datetime.fromordinal(int(string[:-1]))
+    return Date(dt, string[-1] in 'dx', string[-1] in 'dm')
+
+
+def pack_rank(rank):
+    if rank is None:
+        return '-'
+    return str(rank)
+
+
+def unpack_rank(string):
+    if string == '-':
+        return None
+    return int(string)
+
+
+def read_hits_file(file):
+    '''
+    This method takes as input an open hits file written by extract_events.py --hits-file (see extract_events.format_hit_lines()) and returns a 3-tuple of the minimum score and minimum number of dates of the extraction run, and a hash of MRNs mapped to lists of (keyword text, position, packed date, weight) 4-tuples, one per hit.
+    '''
+    filter = 0.0
+    n = 0
+    hits = {}
+    for line in file:
+        line_elements = line.rstrip('\n').split('\t')
+        if line_elements[0] == '#':
+            header = dict([item.split('=', 1) for item in line_elements[1:] if '=' in item])
+            filter = float(header.get('filter', filter))
+            n = int(header.get('n', n))
+        elif len(line_elements) != 5:
+            LOG.warning("Bad hits file line format; skipping: %s" % line)
+        else:
+            hits.setdefault(line_elements[0], []).append((line_elements[1], line_elements[2], int(line_elements[3]), float(line_elements[4])))
+    return (filter, n, hits)
+
+
+def get_keyword_report(hits, gold_data, filter=0.0, n=0):
+    '''
+    This method takes as input a hash of MRNs mapped to lists of keyword hits (see read_hits_file()), a hash of MRNs mapped to gold dates (Date objects), and the minimum score and minimum number of dates of the extraction run, and returns a list of KeywordContribution objects, one per keyword with any hits, in the order in which they first appear.
+    Each patient's dates are scored from its hits as the extraction run scored them (see date_candidate.rerank_candidate_columns()), once with all of them and once without each keyword's hits, and the dates returned are matched against the gold dates as in get_patient_matches(), so that a single extraction run gives what would otherwise take one run per keyword left out.
+    NB: The hits of the other keywords are taken as they are, so leaving a keyword out is only exactly the same as extracting without it if no other keyword's hit would have been found in its place (a keyword overlapping it in the text) and no extraction limit was reached.
+    '''
+    report = {}
+    base_columns = CandidateColumns()
+    base_MRNs = []
+    variant_columns = CandidateColumns()
+    # (position in base_MRNs, KeywordContribution) 2-tuples, one per patient of variant_columns
+    variants = []
+    # The same for the patients left with no hits without a keyword, who have no dates returned
+    empty_variants = []
+
+    for MRN in sorted(hits):
+        patient_hits = hits[MRN]
+        keys = []
+        for text, position, packed_date, weight in patient_hits:
+            key = (text, position)
+            if key not in report:
+                report[key] = KeywordContribution(text, position)
+            report[key].hits += 1
+            if key not in keys:
+                keys.append(key)
+        for key in keys:
+            report[key].patients += 1
+
+        base_columns.add_rows([hit[2] for hit in patient_hits], [hit[3] for hit in patient_hits])
+        for key in keys:
+            kept = [hit for hit in patient_hits if (hit[0], hit[1]) != key]
+            if kept:
+                variant_columns.add_rows([hit[2] for hit in kept], [hit[3] for hit in kept])
+                variants.append((len(base_MRNs), report[key]))
+            else:
+                empty_variants.append((len(base_MRNs), report[key]))
+        base_MRNs.append(MRN)
+
+    dates = get_packed_dates(set(base_columns.dates))
+    base_counts = []
+    for k, reranked in enumerate(rerank_candidate_columns(base_columns, filter, n, True)):
+        MRN = base_MRNs[k]
+        start = base_columns.starts[k]
+        # The snippets of each date returned stand for the keywords of the hits that support it
+        candidates = [DateCandidate(dates[base_columns.dates[row]], [hits[MRN][i-start][:2] for i in rows], score) for row, score, rows in reranked]
+        patient = get_patient_matches(gold_data.get(MRN) or [], candidates, MRN in gold_data)
+        if patient.gold:
+            for candidate, match in zip(patient.candidates, patient.candidate_matches):
+                for key in candidate.snippets:
+                    report[key].add_match(match)
+        base_counts.append(get_patient_counts(patient))
+
+    for (k, contribution), reranked in list(zip(variants, rerank_candidate_columns(variant_columns, filter, n))) + [(variant, []) for variant in empty_variants]:
+        candidates = [DateCandidate(dates[variant_columns.dates[row]], [], score) for row, score, rows in reranked]
+        counts = get_patient_counts(get_patient_matches(gold_data.get(base_MRNs[k]) or [], candidates, base_MRNs[k] in gold_data))
+        for i, count in enumerate(counts):
+            contribution.deltas[i] += count - base_counts[k][i]
+
+    return list(report.values())
+
+
+def get_packed_dates(packed_dates):
+    '''
+    This method takes as input a collection of dates packed with date_candidate.pack_candidate_date() and returns a hash of them mapped to the Date objects that their date expressions in the output file would be read as (see get_output_dict()).
+    '''
+    packed_dates = list(packed_dates)
+    date_array = make_dates([get_packed_date_expression(packed) for packed in packed_dates])
+    dates = {}
+    for i, packed in enumerate(packed_dates):
+        date_vals = date_array.get_dates(i)
+        dates[packed] = date_vals[0] if date_vals else None
+    return dates
+
+
+def print_keyword_report(report, gold_data):
+    '''
+    This method takes as input a list of KeywordContribution objects and a hash of MRNs mapped to gold dates (Date objects), and prints to standard out a header line and a line per keyword in the following format:
+    keyword [tab] position [tab] hits [tab] patients [tab] strict TP [tab] strict FP [tab] lenient TP [tab] lenient FP [tab] strict top 1 [tab] lenient top 1 [tab] strict top MAX_TOP_N [tab] lenient top MAX_TOP_N [tab] strict recall [tab] lenient recall
+    ...where the last six columns are how much the percentages of patients with a match in the top n dates returned, and the recall, printed by print_matrix_results() would change if the keyword were left out (a negative change means that the keyword helps).
+    '''
+    names = ['strict_top_1', 'lenient_top_1', 'strict_top_%d' % MAX_TOP_N, 'lenient_top_%d' % MAX_TOP_N]
+    gold_patients = len(gold_data)
+    gold = sum([len(gold_dates) for gold_dates in gold_data.values()])
+    print('\t'.join(['keyword', 'position', 'hits', 'patients', 'strict_tp', 'strict_fp', 'lenient_tp', 'lenient_fp'] + names + ['strict_recall', 'lenient_recall']))
+    for contribution in report:
+        deltas = dict(zip(COUNT_NAMES, contribution.deltas))
+        columns = [contribution.text, contribution.position] + [str(count) for count in [contribution.hits, contribution.patients, contribution.strict_tp, contribution.strict_fp, contribution.lenient_tp, contribution.lenient_fp]]
+        columns += ['%+.4f' % (float(deltas[name])/gold_patients if gold_patients else 0.0) for name in names]
+        columns += ['%+.4f' % (float(deltas[name])/gold if gold else 0.0) for name in ['strict_recalled', 'lenient_recalled']]
+        print('\t'.join(columns))
+
+
 def print_results(gold_data, sys_output):
     '''
     This method takes as input a hash of MRN mapped to gold dates (Date objects) and a hash of MRNs mapped to lists of DateCandidate objects returned by the system. It then prints various evaluation metrics to standard out.
     '''
-    strict_recall, lenient_recall = get_recall(gold_data, sys_output)
-    strict_precision, lenient_precision = get_precision(gold_data, sys_output)
+    print_matrix_results(get_match_matrix(gold_data, sys_output))
+
+
+def print_matrix_results(matrix):
+    '''
+    This method takes as input a hash of MRNs mapped to PatientMatches objects and prints various evaluation metrics to standard out.
+    '''
+    print_tally_results(get_eval_tally(matrix))
+
+
+def print_tally_results(tally):
+    '''
+    This method takes as input an EvaluationTally and prints the same evaluation metrics as print_matrix_results() to standard out.
+    '''
+    strict_recall, lenient_recall = tally.get_recall()
+    strict_precision, lenient_precision = tally.get_precision()
     strict_f1 = get_f1_score(strict_recall, strict_precision)
     lenient_f1 = get_f1_score(lenient_recall, lenient_precision)
-    strict_rank_eval1, lenient_rank_eval1 = get_rank_eval(gold_data, sys_output, 1)
-    strict_rank_eval2, lenient_rank_eval2 = get_rank_eval(gold_data, sys_output, 2)
-    strict_rank_eval3, lenient_rank_eval3 = get_rank_eval(gold_data, sys_output, 3)
-    strict_rank_eval4, lenient_rank_eval4 = get_rank_eval(gold_data, sys_output, 4)
-    strict_rank_eval5, lenient_rank_eval5 = get_rank_eval(gold_data, sys_output, 5)
-    strict_tp_scores, strict_fp_scores, lenient_tp_scores, lenient_fp_scores = get_scores(gold_data, sys_output)
+    strict_rank_eval1, lenient_rank_eval1 = tally.get_rank_eval(1)
+    strict_rank_eval2, lenient_rank_eval2 = tally.get_rank_eval(2)
+    strict_rank_eval3, lenient_rank_eval3 = tally.get_rank_eval(3)
+    strict_rank_eval4, lenient_rank_eval4 = tally.get_rank_eval(4)
+    strict_rank_eval5, lenient_rank_eval5 = tally.get_rank_eval(5)
+    strict_tp_scores, strict_fp_scores, lenient_tp_scores, lenient_fp_scores = tally.strict_tp_scores, tally.strict_fp_scores, tally.lenient_tp_scores, tally.lenient_fp_scores
+    num_gold_patients = tally.gold_patients
     
-    print "Strict recall: %s" % strict_recall
-    print "Strict precision: %s" % strict_precision
-    print "Strict F1 score: %s" % strict_f1
-    print "Percentage of patients for whom 1st date returned is strict match: %s" % strict_rank_eval1
-    print "Percentage of patients for whom a strict match appears in the top 2 dates returned: %s" % strict_rank_eval2
-    print "Percentage of patients for whom a strict match appears in the top 3 dates returned: %s" % strict_rank_eval3
-    print "Percentage of patients for whom a strict match appears in the top 4 dates returned: %s" % strict_rank_eval4
-    print "Percentage of patients for whom a strict match appears in the top 5 dates returned: %s" % strict_rank_eval5
-    print "Scores of dates that are strict matches: %s" % get_mmmm_string(strict_tp_scores)
-    print "Scores of dates that are not strict matches: %s" % get_mmmm_string(strict_fp_scores)
-    print
-    print "Lenient recall: %s" % lenient_recall
-    print "Lenient precision: %s" % lenient_precision
-    print "Lenient F1 score: %s" % lenient_f1
-    print "Percentage of patients for whom 1st date returned is lenient match: %s" % lenient_rank_eval1
-    print "Percentage of patients for whom a lenient match appears in the top 2 dates returned: %s" % lenient_rank_eval2
-    print "Percentage of patients for whom a lenient match appears in the top 3 dates returned: %s" % lenient_rank_eval3
-    print "Percentage of patients for whom a lenient match appears in the top 4 dates returned: %s" % lenient_rank_eval4
-    print "Percentage of patients for whom a lenient match appears in the top 5 dates returned: %s" % lenient_rank_eval5
-    print "Scores of dates that are lenient matches: %s" % get_mmmm_string(lenient_tp_scores)
-    print "Scores of dates that are not lenient matches: %s" % get_mmmm_string(lenient_fp_scores)
-    print
-    print "No date: %s" % (str(len(get_dateless_patients(gold_data, sys_output))/float(len(gold_data))))
-    print "Dates returned per patient: %s" % get_dates_per_patient(sys_output)
-    print
+    print("Strict recall: %s" % strict_recall)
+    print("Strict precision: %s" % strict_precision)
+    print("Strict F1 score: %s" % strict_f1)
+    print("Percentage of patients for whom 1st date returned is strict match: %s" % strict_rank_eval1)
+    print("Percentage of patients for whom a strict match appears in the top 2 dates returned: %s" % strict_rank_eval2)
+    print("Percentage of patients for whom a strict match appears in the top 3 dates returned: %s" % strict_rank_eval3)
+    print("Percentage of patients for whom a strict match appears in the top 4 dates returned: %s" % strict_rank_eval4)
+    print("Percentage of patients for whom a strict match appears in the top 5 dates returned: %s" % strict_rank_eval5)
+    print("Scores of dates that are strict matches: %s" % get_mmmm_string(strict_tp_scores))
+    print("Scores of dates that are not strict matches: %s" % get_mmmm_string(strict_fp_scores))
+    print()
+    print("Lenient recall: %s" % lenient_recall)
+    print("Lenient precision: %s" % lenient_precision)
+    print("Lenient F1 score: %s" % lenient_f1)
+    print("Percentage of patients for whom 1st date returned is lenient match: %s" % lenient_rank_eval1)
+    print("Percentage of patients for whom a lenient match appears in the top 2 dates returned: %s" % lenient_rank_eval2)
+    print("Percentage of patients for whom a lenient match appears in the top 3 dates returned: %s" % lenient_rank_eval3)
+    print("Percentage of patients for whom a lenient match appears in the top 4 dates returned: %s" % lenient_rank_eval4)
+    print("Percentage of patients for whom a lenient match appears in the top 5 dates returned: %s" % lenient_rank_eval5)
+    print("Scores of dates that are lenient matches: %s" % get_mmmm_string(lenient_tp_scores))
+    print("Scores of dates that are not lenient matches: %s" % get_mmmm_string(lenient_fp_scores))
+    print()
+    print("No date: %s" % (str(tally.dateless_patients/float(num_gold_patients))))
+    print("Dates returned per patient: %s" % get_mmmm_string(tally.dates_per_patient))
+    print()
+
+
+def print_sample_results(sample, matrix, replicates=200, seed=0):
+    '''
+    This method takes as input a PatientSample, a hash of the sampled patients' MRNs mapped to PatientMatches objects, a number of bootstrap replicates, and a seed, and prints to standard out a description of the sample, followed by the metrics printed by print_matrix_results() (other than the distributions of scores and dates returned), each estimated for all the patients (see get_sample_metrics()) with its 95% stratified bootstrap interval.
+    '''
+    rows = get_sample_rows(sample, matrix)
+    metrics = get_sample_metrics(rows)
+    intervals = get_bootstrap_intervals(sample.get_stratum_sizes(), lambda factors: [value for name, value in get_sample_metrics(rows, factors)], replicates, seed)
+
+    print("Sample: %s" % sample)
+    print()
+    for (name, value), (low, high) in zip(metrics, intervals or [(value, value) for name, value in metrics]):
+        if name in ["Lenient recall", "No date"]:
+            print()
+        print("%s: %.4f (95%% interval: %.4f to %.4f)" % (name, value, low, high))
+    print()
+
+
+def get_sample_rows(sample, matrix):
+    '''
+    This method takes as input a PatientSample and a hash of the sampled patients' MRNs mapped to PatientMatches objects, and returns a hash of the sample's strata mapped to lists of (weight, has_gold, has_output, counts) 4-tuples, one per sampled patient, in sample order (see get_patient_counts()), for get_sample_metrics(). A sampled patient in neither the gold data nor the output counts zero for everything.
+    '''
+    rows = {}
+    for stratum, MRNs in sample.sampled.items():
+        rows[stratum] = [(sample.weights[MRN], matrix[MRN].has_gold, matrix[MRN].has_output, get_patient_counts(matrix[MRN])) if MRN in matrix else (sample.weights[MRN], False, False, [0] * len(COUNT_NAMES)) for MRN in MRNs]
+    return rows
+
+
+def get_sample_metrics(rows, factors=None):
+    '''
+    This method takes as input a hash of strata mapped to lists of (weight, has_gold, has_output, counts) 4-tuples (see get_sample_rows()) and optionally a hash of the same strata mapped to lists of factors by which the weights are multiplied (see patient_sample.get_bootstrap_intervals()), and returns a list of (name, value) 2-tuples of the metrics printed by print_matrix_results() (other than the distributions of scores and dates returned), in order, computed as in EvaluationTally but with each patient's contributions multiplied by the number of patients it stands for.
+    '''
+    counts = dict([(name, 0.0) for name in COUNT_NAMES])
+    gold_patients = 0.0
+    dateless_patients = 0.0
+    for stratum, stratum_rows in rows.items():
+        for i, (weight, has_gold, has_output, patient_counts) in enumerate(stratum_rows):
+            if factors is not None:
+                weight *= factors[stratum][i]
+            for name, count in zip(COUNT_NAMES, patient_counts):
+                counts[name] += weight*count
+            if has_gold:
+                gold_patients += weight
+            if has_output and patient_counts[0] and not patient_counts[3]:
+                dateless_patients += weight
+
+    metrics = []
+    for measure in ['strict', 'lenient']:
+        recall = counts['%s_recalled' % measure]/counts['gold'] if counts['gold'] else 0
+        precision = counts['%s_correct' % measure]/counts['returned'] if counts['returned'] else 0
+        metrics.append(("%s recall" % measure.capitalize(), recall))
+        metrics.append(("%s precision" % measure.capitalize(), precision))
+        metrics.append(("%s F1 score" % measure.capitalize(), get_f1_score(recall, precision)))
+        for n in range(1, MAX_TOP_N+1):
+            if n == 1:
+                name = "Percentage of patients for whom 1st date returned is %s match" % measure
+            else:
+                name = "Percentage of patients for whom a %s match appears in the top %d dates returned" % (measure, n)
+            metrics.append((name, counts['%s_top_%d' % (measure, n)]/gold_patients if gold_patients else 1.0))
+    metrics.append(("No date", dateless_patients/gold_patients if gold_patients else 0))
+    return metrics
+
+
+def get_eval_tally(matrix):
+    '''
+    This method takes as input a hash of MRNs mapped to PatientMatches objects and returns an EvaluationTally of all the patients.
+    '''
+    tally = EvaluationTally()
+    for patient in matrix.values():
+        tally.add_patient(patient)
+    return tally
+
+
+def get_patient_counts(patient):
+    '''
+    This method takes as input a PatientMatches object and returns the list of the patient's contributions to the counts named in COUNT_NAMES: the number of gold dates, the number of them with a strict and a lenient match, the number of dates returned, the number of them that are strict and lenient matches, and, for n from 1 to MAX_TOP_N, the number of gold dates with a strict match among the top n dates returned, followed by the same for lenient matches.
+    '''
+    counts = [len(patient.gold), len([rank for rank in patient.gold_strict_ranks if rank is not None]), len([rank for rank in patient.gold_lenient_ranks if rank is not None]), len(patient.candidates), patient.candidate_matches.count(STRICT_MATCH), len(patient.candidate_matches) - patient.candidate_matches.count(NO_MATCH)]
+    for ranks in [patient.gold_strict_ranks, patient.gold_lenient_ranks]:
+        counts.extend([len([rank for rank in ranks if rank is not None and rank < n]) for n in range(1, MAX_TOP_N+1)])
+    return counts
 
 
 def print_output_comparison(gold_data, sys_output):
@@ -146,71 +953,64 @@ def print_output_comparison(gold_data, sys_output):
     This method takes as input a hash of MRN mapped to gold dates (Date objects), a hash of MRNs mapped to hashes of information about the patient returned by the system, and a string corresponding with the type of date being evaluated.
     For each patient, it prints to standard out: MRN ground_truth extracted_by_sys
     '''
-    for MRN in sorted(gold_data.keys()):
-        print MRN+'\t'+str([str(x) for x in gold_data[MRN]])+'\t'+str([str(x.date)+' '+str(x.score)+' '+str(x.snippets) for x in sorted(sys_output[MRN], key=lambda d: d.score)])
+    print_matrix_comparison(get_match_matrix(gold_data, sys_output))
+
+
+def print_matrix_comparison(matrix):
+    '''
+    This method takes as input a hash of MRNs mapped to PatientMatches objects. For each patient in the gold data, it prints to standard out: MRN ground_truth extracted_by_sys
+    '''
+    for MRN in sorted([MRN for MRN in matrix if matrix[MRN].has_gold]):
+        print_patient_comparison(MRN, matrix[MRN])
+
+
+def print_patient_comparison(MRN, patient):
+    '''
+    This method takes as input an MRN and the PatientMatches object for that patient and prints to standard out: MRN ground_truth extracted_by_sys (where extracted_by_sys is in ascending order by score).
+    '''
+    print(MRN+'\t'+str([str(x) for x in patient.gold])+'\t'+str([str(x.date)+' '+str(x.score)+' '+str(x.snippets) for x in sorted(patient.candidates, key=lambda d: d.score)]))
 
 
 def print_output_not_in_top_n(gold_data, sys_output, n, measure='strict'):
     '''
     This method takes as input a hash of MRN mapped to gold dates (Date objects), a hash of MRNs mapped to lists of DateCandidate objects returned by the system, an int n, and an optional measure (string 'strict' or 'lenient'; default is 'strict'). It then prints to standard out, for each patient for whom A correct date does not appear in the top n dates returned: MRN ground_truth extracted_by_sys (where extracted_by_sys is all dates returned, including the top n).
     '''
+    print_matrix_not_in_top_n(get_match_matrix(gold_data, sys_output), n, measure)
+
+
+def print_matrix_not_in_top_n(matrix, n, measure='strict'):
+    '''
+    This method takes as input a hash of MRNs mapped to PatientMatches objects, an int n, and an optional measure (string 'strict' or 'lenient'; default is 'strict'), and prints the same report as print_output_not_in_top_n().
+    '''
     if measure not in ['strict', 'lenient']:
         LOG.warning("Measure must be 'strict' or 'lenient'; defaulting to 'strict'")
         measure = 'strict'
     
     not_in_top_n = []
     
-    for MRN in gold_data:
-        returned = sorted(sys_output[MRN], key=lambda candidate: candidate.score, reverse=True)
-        
-        top_n_returned = returned[:n]
-        LOG.debug("Top %s date(s) returned: %s" % (n, [d.date for d in top_n_returned]))
-
-        strict_match = False
-        lenient_match = False
-        
-        for e in gold_data[MRN]:
-            
-            if e in [d.date for d in top_n_returned]:
-                LOG.debug("Gold date %s in top %s date(s) returned" % (e, n))
-                strict_match = True
-                lenient_match = True
-
-            elif any(e.is_fuzzy_match(d.date) for d in top_n_returned):
-                LOG.debug("Gold date %s has lenient match in top %s date(s) returned" % (e, n))
-                lenient_match = True
-            
-        if not lenient_match:
-            LOG.debug("No lenient match for MRN %s" % MRN)
-            not_in_top_n.append(MRN)
-            
-        elif measure=='strict' and not strict_match:
-            LOG.debug("No lenient match for MRN %s" % MRN)
+    for MRN in matrix:
+        if matrix[MRN].has_gold and not matrix[MRN].has_match_in_top_n(n, measure):
+            LOG.debug("No %s match in top %s for MRN %s" % (measure, n, MRN))
             not_in_top_n.append(MRN)
                 
     for MRN in sorted(not_in_top_n):
-        print MRN+'\t'+str([str(x) for x in gold_data[MRN]])+'\t'+str([str(x.date)+' '+str(x.score)+' '+str(x.snippets) for x in sorted(sys_output[MRN], key=lambda d: d.score)])
-        if sum([x.score for x in sys_output[MRN]]) - 1.0 > 0.0001:
-        	print "Scores do not add up to 1.0 for MRN %s" % MRN
+        print_patient_comparison(MRN, matrix[MRN])
+        if sum([x.score for x in matrix[MRN].candidates]) - 1.0 > 0.0001:
+            print("Scores do not add up to 1.0 for MRN %s" % MRN)
 
 
-def get_recall(gold_data, sys_output):
+def get_recall(matrix):
     '''
-    This method takes as input a hash of MRN mapped to gold dates (Date objects), a hash of MRNs mapped to lists of Date objects, and a string corresponding with the type of date being evaluated. It then returns a 2-tuple of the strict recall and lenient recall, respectively. (Lenient measures count fuzzy Date matches as matches; strict measures only count exact matches as matches.)
+    This method takes as input a hash of MRNs mapped to PatientMatches objects. It then returns a 2-tuple of the strict recall and lenient recall, respectively. (Lenient measures count fuzzy Date matches as matches; strict measures only count exact matches as matches.)
     '''
     num_gold = 0
     strict_matches = 0
     lenient_matches = 0
 
-    for MRN in gold_data:
-        if gold_data.get(MRN):
-            num_gold += len(gold_data[MRN])
-            for e in gold_data[MRN]:
-                if e in [d.date for d in sys_output[MRN]]:
-                    strict_matches += 1
-                    lenient_matches += 1
-                elif any(e.is_fuzzy_match(d.date) for d in sys_output[MRN]):
-                        lenient_matches += 1
+    for patient in matrix.values():
+        num_gold += len(patient.gold)
+        strict_matches += len([rank for rank in patient.gold_strict_ranks if rank is not None])
+        lenient_matches += len([rank for rank in patient.gold_lenient_ranks if rank is not None])
     
     if num_gold == 0:
         return (0, 0)
@@ -218,23 +1018,18 @@ def get_recall(gold_data, sys_output):
         return (float(strict_matches)/num_gold, float(lenient_matches)/num_gold)
 
 
-def get_precision(gold_data, sys_output):
+def get_precision(matrix):
     '''
-    This method takes as input a hash of MRN mapped to gold dates (Date objects), a hash of MRNs mapped to lists of Date objects, and a string corresponding with the type of date being evaluated. It then returns a 2-tuple of the strict precision and lenient precision, respectively. (Lenient measures count fuzzy Date matches as matches; strict measures only count exact matches as matches.)
+    This method takes as input a hash of MRNs mapped to PatientMatches objects. It then returns a 2-tuple of the strict precision and lenient precision, respectively. (Lenient measures count fuzzy Date matches as matches; strict measures only count exact matches as matches.)
     '''
     num_returned = 0
     strict_matches = 0
     lenient_matches = 0
     
-    for MRN in sys_output:
-        num_returned += len(sys_output[MRN])
-        for d in sys_output[MRN]:
-            if gold_data.get(MRN):
-                if d.date in gold_data[MRN]:
-                    strict_matches += 1
-                    lenient_matches += 1
-                elif any(d.date.is_fuzzy_match(e) for e in gold_data[MRN]):
-                    lenient_matches += 1
+    for patient in matrix.values():
+        num_returned += len(patient.candidates)
+        strict_matches += patient.candidate_matches.count(STRICT_MATCH)
+        lenient_matches += len(patient.candidate_matches) - patient.candidate_matches.count(NO_MATCH)
     
     if num_returned == 0:
         return (0, 0)
@@ -252,11 +1047,11 @@ def get_f1_score(recall, precision):
         return float(2*recall*precision)/(recall + precision)
 
 
-def get_rank_eval(gold_data, sys_output, n):
+def get_rank_eval(matrix, n):
     '''
-    This method takes as input a hash of MRN mapped to gold dates (Date objects), a hash of MRNs mapped to lists of Date objects, a string corresponding with the type of date being evaluated, and an int n. It then returns a 2-tuple of the percentage of patients for whom the first, second, ... OR nth date returned is an exact match to A true date, and the percentage of patients for whom the first, second, ... OR nth date returned is a fuzzy match to A true date, respectively.
+    This method takes as input a hash of MRNs mapped to PatientMatches objects and an int n. It then returns a 2-tuple of the percentage of patients for whom the first, second, ... OR nth date returned is an exact match to A true date, and the percentage of patients for whom the first, second, ... OR nth date returned is a fuzzy match to A true date, respectively.
     '''
-    num_patients = len(gold_data)
+    num_patients = len([patient for patient in matrix.values() if patient.has_gold])
     
     if num_patients == 0:
         return (1.0, 1.0)
@@ -265,45 +1060,30 @@ def get_rank_eval(gold_data, sys_output, n):
         strict_matches = 0
         lenient_matches = 0
 
-        for MRN in gold_data:
-            returned = sorted(sys_output[MRN], key=lambda candidate: candidate.score, reverse=True)
-            
-            top_n_returned = returned[:n]
-            LOG.debug("Top %s date(s) returned: %s" % (n, [d.date for d in top_n_returned]))
-            
-            for e in gold_data[MRN]:
-
-                if e in [d.date for d in top_n_returned]:
-                    LOG.debug("Gold date %s in top %s date(s) returned" % (e, n))
-                    strict_matches += 1
-                    lenient_matches += 1
-                    LOG.debug("Updated strict matches to %s" % strict_matches)
-                    LOG.debug("Updated lenient matches to %s" % lenient_matches)
-
-                elif any(e.is_fuzzy_match(d.date) for d in top_n_returned):
-                    LOG.debug("Gold date %s has fuzzy match in top %s date(s) returned" % (e, n))
-                    lenient_matches += 1
-                    LOG.debug("Updated lenient matches to %s" % lenient_matches)
+        for patient in matrix.values():
+            strict_matches += len([rank for rank in patient.gold_strict_ranks if rank is not None and rank < n])
+            lenient_matches += len([rank for rank in patient.gold_lenient_ranks if rank is not None and rank < n])
                     
         return (float(strict_matches)/num_patients, float(lenient_matches)/num_patients)
 
 
-def get_scores(gold_data, sys_output):
+def get_scores(matrix):
     '''
-    This method takes as input a hash of MRN mapped to gold dates (Date objects), a hash of MRNs mapped to lists of Date objects, a string corresponding with the type of date being evaluated, and returns a tuple of four lists: of the scores of DateCandidates returned that are strict matches, of the scores of DateCandidates returned that are not strict matches, of the scores of DateCandidates returned that are lenient matches, and of the scores of DateCandidates returned that are not lenient matches, respectively.
+    This method takes as input a hash of MRNs mapped to PatientMatches objects, and returns a tuple of four lists: of the scores of DateCandidates returned that are strict matches, of the scores of DateCandidates returned that are not strict matches, of the scores of DateCandidates returned that are lenient matches, and of the scores of DateCandidates returned that are not lenient matches, respectively.
+    NB: Only patients with gold dates are taken into account.
     '''
     strict_tp_scores = []
     strict_fp_scores = []
     lenient_tp_scores = []
     lenient_fp_scores = []
     
-    for MRN in sys_output:
-        for d in sys_output[MRN]:
-            if gold_data.get(MRN):
-                if d.date in gold_data[MRN]:
+    for patient in matrix.values():
+        if patient.gold:
+            for d, match in zip(patient.candidates, patient.candidate_matches):
+                if match == STRICT_MATCH:
                     strict_tp_scores.append(d.score)
                     lenient_tp_scores.append(d.score)
-                elif any(d.date.is_fuzzy_match(e) for e in gold_data[MRN]):
+                elif match == LENIENT_MATCH:
                     strict_fp_scores.append(d.score)
                     lenient_tp_scores.append(d.score)
                 else:
@@ -313,26 +1093,27 @@ def get_scores(gold_data, sys_output):
     return (strict_tp_scores, strict_fp_scores, lenient_tp_scores, lenient_fp_scores)
 
 
-def get_dateless_patients(gold_data, sys_output):
+def get_dateless_patients(matrix):
     '''
-    This method takes as input a hash of MRN mapped to gold dates (Date objects) and a hash of MRNs mapped to DateCandidates returned by the system for that patient, and returns a list of MRNs for patients for whom no date is returned.
+    This method takes as input a hash of MRNs mapped to PatientMatches objects, and returns a list of MRNs for patients with gold dates for whom no date is returned.
     '''
     dateless = []
-    for MRN in sys_output:
+    for MRN in matrix:
         # If there exist gold-standard dates for this event for this patient
-        if gold_data[MRN]:
-            if not sys_output[MRN]:
+        if matrix[MRN].has_output and matrix[MRN].gold:
+            if not matrix[MRN].candidates:
                 dateless.append(MRN)
     return dateless
 
 
-def get_dates_per_patient(sys_output):
+def get_dates_per_patient(matrix):
     '''
-    This method takes as input a hash of MRNs mapped to hashes of information about the patient returned by the system; calculates the minimum, maximum, mean, and median dates returned per patient; and returns a string containing this information.
+    This method takes as input a hash of MRNs mapped to PatientMatches objects; calculates the minimum, maximum, mean, and median dates returned per patient; and returns a string containing this information.
     '''
     num_dates = []
-    for MRN in sys_output:
-        num_dates.append(len(sys_output[MRN]))
+    for MRN in matrix:
+        if matrix[MRN].has_output:
+            num_dates.append(len(matrix[MRN].candidates))
         
     return get_mmmm_string(num_dates)
 
@@ -340,8 +1121,9 @@ def get_dates_per_patient(sys_output):
 def get_mmmm_string(input_list):
     '''
     This method takes a list of ints or floats; calculates the minimum, maximum, mean, and median dates returned per patient; and returns a string containing this information.
+    NB: The mean is computed with an exactly rounded sum, so it does not depend on the order of the list (which follows the order of a hash of MRNs).
     '''
-    return 'Min %s; Max %s; Mean %s; Median %s' % (min(input_list), max(input_list), float(sum(input_list))/len(input_list), get_median(input_list))
+    return 'Min %s; Max %s; Mean %s; Median %s' % (min(input_list), max(input_list), math.fsum(input_list)/len(input_list), get_median(input_list))
 
 
 def get_median(list):
@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 
 # Written by Andrea Kahn
 # Last updated Aug. 29, 2014
@@ -7,7 +7,7 @@
 '''
 This script takes as input:
 1) A path to a file containing patients' clinic notes, each line having the format: MRN [tab] date [tab] description [tab] note (one note per line; date must be in format YYYY-MM-DD, YYYY-MM, or YYYY)
-2) A path to the file containing keywords to search on, each line having the format: keyword [tab] position ([tab] window size), where position is PRE-DATE or POST-DATE and the parenthesized content is optional (default window size = 100) (NB: casing of keywords is ignored)
+2) A path to the file containing keywords to search on, each line having the format: keyword [tab] position ([tab] window size ([tab] weight)), where position is PRE-DATE or POST-DATE and the parenthesized content is optional (default window size = 100; default weight = 1.0) (NB: casing of keywords is ignored; each date found near a keyword counts toward that date's score in proportion to the keyword's weight)
 3) Optionally, a float corresponding to the minimum score a date candidate must have in order to be output (default = 0.0)
 4) Optionally, an int corresponding to the minimum number of dates to be output, regardless of whether they all have the minimum score (NB: if the number of date candidates extracted is lower than this int, only the number of date candidates extracted will be output) (default = 0)
 
@@ -16,50 +16,233 @@ MRN [tab] date1 [tab] score1 [tab] date2 [tab] score2 ...
 
 ...where MRNs are sorted alphabetically, and dates for a particular patient appear in descending order by score.
 
-To switch to verbose output (lists of supporting snippets are printed after scores), comment line 61 and uncomment line 62.
+Patients are processed in MRN order and each line is printed as soon as the patient is done. With --checkpoint FILE, each line is also appended to FILE, which is flushed to disk every --checkpoint-interval patients; rerunning with --checkpoint FILE --resume reprints the lines in FILE and only processes the remaining patients.
+
+To switch to verbose output (lists of supporting snippets are printed after scores), use --verbose.
 '''
 
 
-from sys import argv
+from sys import stdout, stderr
+import argparse
+from itertools import islice
+from bisect import bisect_left, bisect_right
+import hashlib
 import logging
-from date import *
-from date_candidate import *
+import os
+import re
+import time
+from date import DATE_MATCHERS, date_matcher, extract_date_match, extract_dates_and_char_indices, extract_relative_dates, make_anchor_date, make_date, set_date_matcher
+from date_candidate import CandidateColumns, DateCandidate, get_packed_date_expression, pack_candidate_date, rerank_candidate_columns, rerank_candidates
 
 LOG = logging.getLogger(__name__)
 LOG.setLevel(logging.WARNING)
 
+# Values of CopyForwardPolicy.policy
+COPY_FORWARD_POLICIES = ['all', 'once', 'decay']
+
+# Start of the last field of the output line of a patient that reached an extraction limit, with --flag-limited (see eval_output.get_output_dict())
+LIMITED_FIELD_PREFIX = 'LIMITED='
+
+# Snippets end at the first (PRE-DATE) or begin after the last (POST-DATE) match of these in the keyword window
+pre_date_snippet_regex = re.compile('[.]|[a-z],|dmitted|:.*:')
+post_date_snippet_regex = re.compile('[.]|[a-z],|<%END%>|ischarge|dmitted.{20}')
+# The same, for note texts held as ASCII bytes (see get_notes_dict_bytes())
+pre_date_snippet_bytes_regex = re.compile(pre_date_snippet_regex.pattern.encode('ascii'))
+post_date_snippet_bytes_regex = re.compile(post_date_snippet_regex.pattern.encode('ascii'))
+
+# The characters str.strip() removes from an ASCII string
+ASCII_WHITESPACE = b' \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f'
+
 
 def main():
     logging.basicConfig()
 
-    notes_filename = argv[1]
-    keywords_filename = argv[2]
-    if len(argv) > 3:
-        filter = argv[3]
-        if len(argv) > 4:
-            n = argv[4]
-        else:
-            n = 0
-    else:
-        filter = 0.0
-        n = 0
-    
-    notes_file = open(notes_filename)
-    notes_dict = get_notes_dict(notes_file)
-    notes_file.close()
-    LOG.debug("Here is the notes dictionary: %s" % notes_dict)
+    parser = argparse.ArgumentParser(description='Extract dates of clinical events from clinic notes.')
+    parser.add_argument('notes_filename', help='notes file')
+    parser.add_argument('keywords_filename', help='keywords file')
+    parser.add_argument('filter', nargs='?', type=float, default=0.0, help='minimum score of a date candidate (default: 0.0)')
+    parser.add_argument('n', nargs='?', type=int, default=0, help='minimum number of dates output per patient (default: 0)')
+    parser.add_argument('--verbose', action='store_true', help='print the supporting snippets after each score')
+    parser.add_argument('--checkpoint', metavar='CHECKPOINT_FILE', help='also append each output line to this file, flushing it to disk periodically')
+    parser.add_argument('--checkpoint-interval', type=int, default=100, help='number of patients between flushes of the checkpoint file (default: 100)')
+    parser.add_argument('--resume', action='store_true', help='reuse the output lines in the checkpoint file and only process the remaining patients')
+    parser.add_argument('--date-matcher', choices=DATE_MATCHERS, default=date_matcher, help='regex backend used to find date expressions (default: %s)' % date_matcher)
+    parser.add_argument('--processes', type=int, default=1, help='number of worker processes; note texts are shared with the workers through shared memory (default: 1)')
+    parser.add_argument('--max-hits-per-note', type=int, help='process at most this many keyword hits per note')
+    parser.add_argument('--max-hits-per-patient', type=int, help='process at most this many keyword hits per patient')
+    parser.add_argument('--time-budget', type=float, metavar='SECONDS', help='stop processing keyword hits for a patient after this many seconds')
+    parser.add_argument('--flag-limited', action='store_true', help='end the output line of a patient that reached one of the limits above with a %slimits field' % LIMITED_FIELD_PREFIX)
+    parser.add_argument('--copy-forward', choices=COPY_FORWARD_POLICIES, help='search each distinct sentence once per patient, and count repeated snippets (e.g. in copied-forward text) fully, once, or with decaying weight')
+    parser.add_argument('--copy-forward-decay', type=float, default=0.5, help="weight multiplier per repeat for --copy-forward decay (default: 0.5)")
+    parser.add_argument('--rerank-batch', type=int, default=1, metavar='K', help='find the date candidates of K patients at a time and rerank them together in flat columns (default: 1, i.e. one patient at a time)')
+    parser.add_argument('--pipeline', action='store_true', help='read the notes file (which must be sorted by MRN), extract dates, and write the output in separate threads connected by bounded queues')
+    parser.add_argument('--pipeline-workers', type=int, default=1, help='number of extraction threads with --pipeline (default: 1)')
+    parser.add_argument('--pipeline-queue-size', type=int, default=64, help='number of patients read ahead of the output with --pipeline (default: 64)')
+    parser.add_argument('--bytes', action='store_true', help='read the notes file as bytes and search the notes of patients whose notes are all ASCII without decoding them')
+    parser.add_argument('--sample', type=float, metavar='FRACTION', help='only process a stratified sample of this fraction of the patients (see patient_sample.py)')
+    parser.add_argument('--sample-seed', type=int, default=0, help='seed of the sample (default: 0)')
+    parser.add_argument('--sample-gold', metavar='GOLD_FILE', help='also stratify the sample by whether patients have gold dates in this file, as eval_output.py --sample does')
+    parser.add_argument('--hits-file', help="write every keyword hit that a date was found near (MRN, keyword, position, date, and weight) to this file, for eval_output.py's --keyword-report")
+    parser.add_argument('--stats-file', help='write per-patient statistics (notes, hits, candidates, time, and limits reached) to this file')
+    args = parser.parse_args()
 
-    keywords_file = open(keywords_filename)
+    if args.resume and not args.checkpoint:
+        parser.error("--resume requires --checkpoint")
+    if args.rerank_batch > 1 and args.processes > 1:
+        parser.error("--rerank-batch cannot be used with --processes")
+    if args.pipeline and (args.processes > 1 or args.rerank_batch > 1):
+        parser.error("--pipeline cannot be used with --processes or --rerank-batch")
+    if args.pipeline_workers < 1 or args.pipeline_queue_size < 1:
+        parser.error("--pipeline-workers and --pipeline-queue-size must be at least 1")
+    if args.bytes and (args.pipeline or args.processes > 1):
+        parser.error("--bytes cannot be used with --pipeline or --processes")
+    if args.hits_file and (args.pipeline or args.processes > 1):
+        parser.error("--hits-file cannot be used with --pipeline or --processes")
+    if args.sample is not None and not 0 < args.sample <= 1:
+        parser.error("--sample must be greater than 0 and at most 1")
+    if (args.max_hits_per_note is not None and args.max_hits_per_note < 0) or (args.max_hits_per_patient is not None and args.max_hits_per_patient < 0) or (args.time_budget is not None and args.time_budget < 0):
+        parser.error("--max-hits-per-note, --max-hits-per-patient, and --time-budget cannot be negative")
+    if args.flag_limited and args.max_hits_per_note is None and args.max_hits_per_patient is None and args.time_budget is None:
+        parser.error("--flag-limited requires --max-hits-per-note, --max-hits-per-patient, or --time-budget")
+    if args.sample is not None and args.pipeline:
+        parser.error("--sample cannot be used with --pipeline")
+    try:
+        set_date_matcher(args.date_matcher)
+    except ImportError:
+        parser.error("--date-matcher %s requires the %s module, which is not installed" % (args.date_matcher, args.date_matcher))
+    
+    keywords_file = open(args.keywords_filename)
     keywords_list = get_keywords_list(keywords_file)
     keywords_file.close()
-    LOG.debug("Here is the keywords list: %s" % keywords_list)
+    LOG.debug("Here is the keywords list: %s", keywords_list)
     
-    extracted = {}
-    for MRN in notes_dict:
-        extracted[MRN] = extract_events(notes_dict[MRN], keywords_list, filter, n)
+    keyword_index = KeywordIndex(keywords_list)
+    prefilter = KeywordPrefilter(keyword_index.keywords)
 
-    print_output(extracted)
-#   print_output(extracted, True)
+    if args.bytes and not keyword_index.ascii:
+        LOG.warning("Keywords that are not ASCII cannot be matched in bytes; reading the notes as text")
+        args.bytes = False
+    # With --pipeline, the notes are read by the pipeline's reader thread instead
+    if args.bytes:
+        notes_file = open(args.notes_filename, 'rb')
+        notes_dict = get_notes_dict_bytes(notes_file)
+        notes_file.close()
+        LOG.debug("Here is the notes dictionary: %s", notes_dict)
+    elif not args.pipeline:
+        notes_file = open(args.notes_filename, encoding='utf-8', errors='replace')
+        notes_dict = get_notes_dict(notes_file)
+        notes_file.close()
+        LOG.debug("Here is the notes dictionary: %s", notes_dict)
+    if args.checkpoint:
+        try:
+            checkpoint = ExtractionCheckpoint(args.checkpoint, args.resume, args.checkpoint_interval, get_checkpoint_header(args))
+        except ValueError as e:
+            parser.error(str(e))
+        if checkpoint.rows:
+            stderr.write("Resuming: %s patients already in checkpoint %s\n" % (len(checkpoint.rows), args.checkpoint))
+    else:
+        checkpoint = None
+
+    if args.max_hits_per_note is not None or args.max_hits_per_patient is not None or args.time_budget is not None:
+        limits = ExtractionLimits(args.max_hits_per_note, args.max_hits_per_patient, args.time_budget)
+    else:
+        limits = None
+    if args.copy_forward:
+        copy_forward = CopyForwardPolicy(args.copy_forward, args.copy_forward_decay)
+    else:
+        copy_forward = None
+    if args.stats_file:
+        # Statistics of the patients in the checkpoint were written by the run being resumed
+        stats_file = open(args.stats_file, 'a' if args.resume else 'w')
+    else:
+        stats_file = None
+    if args.hits_file:
+        # As for the stats file, the hits of the patients in the checkpoint were written by the run being resumed
+        hits_file = open(args.hits_file, 'a' if args.resume else 'w')
+        if not args.resume:
+            hits_file.write('#\tfilter=%r\tn=%d\n' % (args.filter, args.n))
+    else:
+        hits_file = None
+    flagged = 0
+
+    # 'patients' generates an (MRN, result) 2-tuple per patient, where result is None unless the pipeline has already extracted the patient's dates
+    results = None
+    if args.pipeline:
+        # Imported here so that other runs do not pay for threading
+        from extraction_pipeline import extract_events_pipelined
+        patients = ((result[0], result) for result in extract_events_pipelined(args.notes_filename, keyword_index.keywords, args.filter, args.n, args.verbose, limits, copy_forward, set(checkpoint.rows) if checkpoint else None, args.pipeline_workers, args.pipeline_queue_size))
+    else:
+        if args.sample is not None:
+            # Imported here so that full runs do not pay for it
+            from patient_sample import PatientSample, get_gold_MRNs
+            if args.sample_gold:
+                gold_data_file = open(args.sample_gold)
+                gold_MRNs = get_gold_MRNs(gold_data_file)
+                gold_data_file.close()
+            else:
+                gold_MRNs = None
+            sample = PatientSample(notes_dict, args.sample, args.sample_seed, dict([(MRN, len(notes)) for MRN, notes in notes_dict.items()]), gold_MRNs)
+            stderr.write("Sample: %s\n" % sample)
+            MRNs = sorted(sample.MRNs)
+        else:
+            MRNs = sorted(notes_dict)
+        patients = ((MRN, None) for MRN in MRNs)
+        if args.processes > 1:
+            # Imported here so that single-process runs do not pay for multiprocessing
+            from shared_corpus import extract_events_parallel
+            results = extract_events_parallel(notes_dict, [MRN for MRN in MRNs if not (checkpoint and MRN in checkpoint.rows)], keyword_index.keywords, args.filter, args.n, args.verbose, args.processes, args.date_matcher, limits, copy_forward)
+
+    # Patients are processed and printed one at a time, in MRN order, so output is not lost if the run is interrupted
+    # (with --rerank-batch, a batch at a time: the output rows and statistics of the rest of the batch wait in 'batch')
+    batch = {}
+    for position, (MRN, result) in enumerate(patients):
+        if checkpoint and MRN in checkpoint.rows:
+            line = checkpoint.rows[MRN]
+        else:
+            if results:
+                result = next(results)
+            if result:
+                prefilter.notes_seen += result[2]
+                prefilter.notes_skipped += result[3]
+                stats = result[4]
+                line = format_output_rows(result[0], result[1])
+            elif args.rerank_batch > 1:
+                if MRN not in batch:
+                    batch_MRNs = list(islice((other for other in MRNs[position:] if not (checkpoint and other in checkpoint.rows)), args.rerank_batch))
+                    batch_stats = [PatientStats() for other in batch_MRNs]
+                    batch_hits = [[] for other in batch_MRNs]
+                    batch_rows = extract_events_batch([notes_dict[other] for other in batch_MRNs], keyword_index, args.filter, args.n, prefilter, limits, batch_stats, copy_forward, args.verbose, batch_hits if hits_file else None)
+                    batch = dict(zip(batch_MRNs, zip(batch_rows, batch_stats, batch_hits)))
+                rows, stats, hits = batch.pop(MRN)
+                line = format_output_rows(MRN, rows)
+            else:
+                stats = PatientStats()
+                hits = []
+                line = format_output_line(MRN, extract_events(notes_dict[MRN], keyword_index, args.filter, args.n, prefilter, limits, stats, copy_forward, hits if hits_file else None), args.verbose)
+            if hits_file:
+                hits_file.writelines(format_hit_lines(MRN, hits))
+            if stats.flags:
+                LOG.warning("Patient %s reached %s (%s keyword hits processed in %.1f seconds); output is based on the hits found so far" % (MRN, ', '.join(stats.flags), stats.hits, stats.seconds))
+                flagged += 1
+                if args.flag_limited:
+                    line += '\t' + LIMITED_FIELD_PREFIX + ','.join(stats.flags)
+            if stats_file:
+                stats_file.write(stats.format_line(MRN) + '\n')
+            if checkpoint:
+                checkpoint.add(MRN, line)
+                if checkpoint.unsynced == 0:
+                    stdout.flush()
+        print(line)
+
+    if checkpoint:
+        checkpoint.close()
+    if stats_file:
+        stats_file.close()
+    if hits_file:
+        hits_file.close()
+    if flagged:
+        stderr.write("%s patients reached an extraction limit\n" % flagged)
+    stderr.write("Prefilter skipped %s of %s notes (%.1f%%)\n" % (prefilter.notes_skipped, prefilter.notes_seen, 100*prefilter.get_skipped_fraction()))
 
 
 class ClinicNote(object):
@@ -79,19 +262,352 @@ class ClinicNote(object):
 
 class Keyword(object):
     '''
-    A Keyword has 'text' (the keyword itself), 'position' (the string 'PRE-DATE' or 'POST-DATE'), an int 'window' (the number of characters before or after the keyword in which to look for a date). The last attribute, if not passed into the __init__ method, defaults to 100.
+    A Keyword has 'text' (the keyword itself), 'position' (the string 'PRE-DATE' or 'POST-DATE'), an int 'window' (the number of characters before or after the keyword in which to look for a date), and a float 'weight' (how much each date found near the keyword counts toward the score of that date). The last two attributes, if not passed into the __init__ method, default to 100 and 1.0, respectively.
     '''
-    def __init__(self, text, position, window=100):
+    def __init__(self, text, position, window=100, weight=1.0):
         if position not in ['PRE-DATE', 'POST-DATE']:
             LOG.warning("Bad position value %s; setting position to None)" % str(position))
         
         self.text = text
         self.position = position
         self.window = int(window)
+        self.weight = float(weight)
     
     def __repr__(self):
-        return "(%s, %s, %s)" % (self.text, self.position, str(self.window))
+        return "(%s, %s, %s, %s)" % (self.text, self.position, str(self.window), str(self.weight))
+
+
+
+class KeywordIndex(object):
+    '''
+    A KeywordIndex compiles a list of Keyword objects into one case-insensitive regex per position, in which each keyword is escaped and wrapped in its own capture group, so that a match identifies the keyword that produced it without any per-match lookup: the keyword is keywords[match.lastindex-1], where keywords is 'pre_date_keywords' or 'post_date_keywords'.
+    It has attributes 'keywords' (the list of Keyword objects, without duplicates), 'pre_date_keywords' and 'post_date_keywords' (the PRE-DATE and POST-DATE keywords, in the order of their capture groups), 'pre_date_regex' and 'post_date_regex' (compiled regexes, or None if there are no keywords for that position), 'ascii' (True if every keyword is ASCII, so that the keywords can also be matched in ASCII bytes), and 'bytes_regexes' (the two regexes compiled to match bytes, built on first use; see get_regexes()).
+    NB: Keywords are matched case-insensitively. If a keyword appears more than once with the same position, it keeps the place of its first appearance and the window of its last one.
+    '''
+    def __init__(self, keywords):
+        self.keywords = []
+        positions = {}
+        for keyword in keywords:
+            if not keyword.text:
+                LOG.warning("Empty keyword text; skipping keyword %s" % keyword)
+                continue
+            key = (keyword.text.lower(), keyword.position)
+            if key in positions:
+                self.keywords[positions[key]] = keyword
+            else:
+                positions[key] = len(self.keywords)
+                self.keywords.append(keyword)
+
+        self.pre_date_keywords = [keyword for keyword in self.keywords if keyword.position=='PRE-DATE']
+        self.post_date_keywords = [keyword for keyword in self.keywords if keyword.position=='POST-DATE']
+        self.pre_date_regex = compile_keyword_regex(self.pre_date_keywords)
+        self.post_date_regex = compile_keyword_regex(self.post_date_keywords)
+        self.ascii = all([keyword.text.isascii() for keyword in self.keywords])
+        self.bytes_regexes = None
+
+    def __repr__(self):
+        return "PRE-DATE: %s; POST-DATE: %s" % (self.pre_date_keywords, self.post_date_keywords)
+
+    def get_regexes(self, binary=False):
+        '''
+        This method takes as input an optional boolean and returns a 2-tuple of the PRE-DATE and POST-DATE keyword regexes, compiled to match bytes if binary is True. It raises ValueError for bytes if a keyword is not ASCII.
+        NB: In ASCII text, the bytes regexes find the same matches as the str ones, but faster, since case-insensitive matching of bytes only has to fold ASCII letters.
+        '''
+        if not binary:
+            return (self.pre_date_regex, self.post_date_regex)
+        if self.bytes_regexes is None:
+            if not self.ascii:
+                raise ValueError("Keywords that are not ASCII cannot be matched in bytes")
+            self.bytes_regexes = (compile_keyword_regex(self.pre_date_keywords, True), compile_keyword_regex(self.post_date_keywords, True))
+        return self.bytes_regexes
+
+
+
+class KeywordPrefilter(object):
+    '''
+    A KeywordPrefilter finds, with a literal scan of the lowercased note text, which keywords can match in a note, so that notes without any keyword never reach the keyword regexes, windowing, or date parsing. It has attributes 'literals' (the lowercased keyword texts), 'bytes_literals' (the same as ASCII bytes, for note texts held as bytes, or None if a keyword is not ASCII), 'pre_date_mask' and 'post_date_mask' (bitmaps of the PRE-DATE and POST-DATE keywords), and 'notes_seen' and 'notes_skipped' (the number of notes checked and the number found to contain no keyword).
+    '''
+    def __init__(self, keywords):
+        self.literals = [keyword.text.lower() for keyword in keywords]
+        self.bytes_literals = [literal.encode('ascii') for literal in self.literals] if all([literal.isascii() for literal in self.literals]) else None
+        self.pre_date_mask = 0
+        self.post_date_mask = 0
+        for i, keyword in enumerate(keywords):
+            if keyword.position == 'PRE-DATE':
+                self.pre_date_mask |= 1 << i
+            elif keyword.position == 'POST-DATE':
+                self.post_date_mask |= 1 << i
+        self.notes_seen = 0
+        self.notes_skipped = 0
+
+    def __repr__(self):
+        return "literals: %s; %s of %s notes skipped" % (self.literals, self.notes_skipped, self.notes_seen)
+
+    def get_mask(self, note):
+        '''
+        This method takes as input a ClinicNote object and returns the bitmap of the keywords whose text appears in it (bit i is set for the ith keyword), updating the counts of notes seen and skipped. The bitmap is not kept, so the prefilter holds no reference to the notes it has checked.
+        '''
+        text = note.text.lower()
+        mask = 0
+        for i, literal in enumerate(self.bytes_literals if isinstance(text, bytes) else self.literals):
+            if literal in text:
+                mask |= 1 << i
+
+        self.notes_seen += 1
+        if not mask:
+            self.notes_skipped += 1
+        return mask
+
+    def get_skipped_fraction(self):
+        '''
+        This method returns the fraction of the notes checked so far that contained no keyword (0.0 if no notes have been checked).
+        '''
+        if self.notes_seen == 0:
+            return 0.0
+        return float(self.notes_skipped)/self.notes_seen
+
+
+
+class ExtractionCheckpoint(object):
+    '''
+    An ExtractionCheckpoint records the output lines of a run as they are produced, so that an interrupted run can be resumed without reprocessing the patients it finished. It has attributes 'filename' (the path of the checkpoint file), 'header' (a list of (name, value) 2-tuples identifying the inputs and options of the run; see get_checkpoint_header()), 'rows' (a hash of MRNs mapped to the output lines read back from the checkpoint file when resuming), 'interval' (the number of lines written between flushes to disk), and 'unsynced' (the number of lines written since the last flush).
+    The checkpoint file starts with a header line in the format # [tab] name=value [tab] name=value ..., followed by lines in the same format as the output (one line per patient). A checkpoint is only resumed if its header is the same as that of the run resuming it; otherwise a ValueError is raised, naming the inputs and options that differ. A line is only considered complete once its newline has been written; a partial line left by an interrupted run is discarded when resuming.
+    '''
+    def __init__(self, filename, resume=False, interval=100, header=None):
+        self.filename = filename
+        self.header = header or []
+        self.rows = {}
+        self.interval = max(int(interval), 1)
+        self.unsynced = 0
+
+        header_line = '\t'.join(['#'] + ['%s=%s' % item for item in self.header])
+        data = b''
+        if resume and os.path.exists(filename):
+            checkpoint_file = open(filename, 'rb')
+            data = checkpoint_file.read()
+            checkpoint_file.close()
+        complete = data.rfind(b'\n') + 1
+        if complete:
+            lines = data[:complete].decode('utf-8').split('\n')[:-1]
+            if lines[0] != header_line:
+                raise ValueError("Checkpoint %s is from a run with different inputs or options (%s); rerun without --resume to start over" % (filename, ', '.join(get_header_differences(lines[0], self.header))))
+            if complete < len(data):
+                LOG.warning("Discarding incomplete last line of checkpoint %s" % filename)
+            for line in lines[1:]:
+                self.rows[line.split('\t', 1)[0]] = line
+            self.file = open(filename, 'r+b')
+            self.file.truncate(complete)
+            self.file.seek(complete)
+        else:
+            if resume and not os.path.exists(filename):
+                LOG.warning("No checkpoint %s to resume from; starting from the beginning" % filename)
+            self.file = open(filename, 'wb')
+            self.file.write(header_line.encode('utf-8') + b'\n')
+            self.sync()
+
+    def __repr__(self):
+        return "checkpoint: %s; %s patients read back" % (self.filename, len(self.rows))
+    def add(self, MRN, line):
+        '''
+        This method takes as input an MRN and its output line (without a trailing newline), and appends the line to the checkpoint file, flushing the file to disk every 'interval' lines.
+        '''
+        self.file.write(line.encode('utf-8') + b'\n')
+        self.unsynced += 1
+        if self.unsynced >= self.interval:
+            self.sync()
+
+    def sync(self):
+        '''
+        This method flushes the lines written so far to disk.
+        '''
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        '''
+        This method flushes the checkpoint file to disk and closes it.
+        '''
+        self.sync()
+        self.file.close()
+
+
+def get_checkpoint_header(args):
+    '''
+    This method takes as input the parsed arguments of a run and returns a list of (name, value) 2-tuples identifying the inputs (the notes file, by path, size, and modification time, and the keywords file, by a hash of its contents) and the options that its output lines depend on, like the manifest of distributed_extract.py, so that a checkpoint is only resumed by a run that would write the same lines (see ExtractionCheckpoint).
+    '''
+    notes_stat = os.stat(args.notes_filename)
+    keywords_file = open(args.keywords_filename, 'rb')
+    keywords_hash = hashlib.sha1(keywords_file.read()).hexdigest()
+    keywords_file.close()
+    header = [('notes', os.path.abspath(args.notes_filename)), ('notes_size', str(notes_stat.st_size)), ('notes_mtime', str(notes_stat.st_mtime_ns)), ('keywords_sha1', keywords_hash), ('filter', repr(args.filter)), ('n', str(args.n)), ('verbose', str(args.verbose))]
+    for name in ['max_hits_per_note', 'max_hits_per_patient', 'time_budget', 'flag_limited', 'copy_forward', 'copy_forward_decay', 'sample', 'sample_seed']:
+        header.append((name, repr(getattr(args, name))))
+    header.append(('sample_gold', os.path.abspath(args.sample_gold) if args.sample_gold else 'None'))
+    return header
+
+
+def get_header_differences(line, header):
+    '''
+    This method takes as input the header line of a checkpoint file and the header of a run (see get_checkpoint_header()), and returns the list of the names whose values differ between them (or are missing from either).
+    '''
+    if not line.startswith('#'):
+        return ['no header']
+    old_header = dict([item.split('=', 1) for item in line.split('\t')[1:] if '=' in item])
+    new_header = dict(header)
+    names = [name for name, value in header] + sorted([name for name in old_header if name not in new_header])
+    return [name for name in names if old_header.get(name) != new_header.get(name)]
+
+
+
+class ExtractionLimits(object):
+    '''
+    An ExtractionLimits object holds the guards applied to each patient, so that a patient with pathological notes (e.g. enormous copy-forwarded notes with thousands of keyword hits) degrades to a partial result instead of stalling the run. It has attributes 'max_hits_per_note' and 'max_hits_per_patient' (the number of keyword hits after which the rest of a note, or the rest of the patient's notes, is skipped) and 'time_budget' (the number of seconds after which no further keyword hits are processed for the patient), each of which is None if there is no limit.
+    A patient that reaches a limit is still scored, from the hits found so far, and is flagged in its PatientStats.
+    '''
+    def __init__(self, max_hits_per_note=None, max_hits_per_patient=None, time_budget=None):
+        self.max_hits_per_note = max_hits_per_note
+        self.max_hits_per_patient = max_hits_per_patient
+        self.time_budget = time_budget
+
+    def __repr__(self):
+        return "max hits per note: %s; max hits per patient: %s; time budget: %s" % (self.max_hits_per_note, self.max_hits_per_patient, self.time_budget)
+
+
+
+class CopyForwardPolicy(object):
+    '''
+    A CopyForwardPolicy sets how keyword hits are counted when their snippet repeats one already seen for the same patient (typically because text was copied forward from an earlier note). It has attributes 'policy' (one of COPY_FORWARD_POLICIES) and 'decay' (a float between 0 and 1, used by the 'decay' policy).
+    With any policy, a repeated sentence (with the same surrounding text within reach of the keyword windows) is not searched again, and the date expression of a repeated snippet is not looked for again; relative dates and two-digit years are still resolved against the note each occurrence is in, so every hit has the dates it would have without a policy. The policies then differ in how much a repeat counts toward the score of its dates: 'all' counts every repeat with the full keyword weight, 'once' does not count repeats at all, and 'decay' counts the kth repeat with the keyword weight multiplied by decay**k.
+    '''
+    def __init__(self, policy='all', decay=0.5):
+        if policy not in COPY_FORWARD_POLICIES:
+            LOG.warning("Bad copy-forward policy %s; setting policy to 'all'" % policy)
+            policy = 'all'
+        self.policy = policy
+        self.decay = float(decay)
+
+    def __repr__(self):
+        return "copy-forward policy: %s; decay: %s" % (self.policy, self.decay)
+
+    def get_weight(self, weight, repeats):
+        '''
+        This method takes as input the weight of a keyword and the number of earlier occurrences of a snippet, and returns the weight with which this occurrence counts, or None if it does not count at all.
+        '''
+        if repeats == 0 or self.policy == 'all':
+            return weight
+        elif self.policy == 'once':
+            return None
+        else:
+            return weight * self.decay**repeats
+
+
+
+class PatientStats(object):
+    '''
+    A PatientStats object records how much work extraction took for one patient. It has attributes 'notes' (the number of notes), 'hits' (the number of keyword hits processed), 'repeated_hits' (the number of those whose snippet had already been seen for the patient; only counted with a CopyForwardPolicy), 'candidates' (the number of date candidates found, before reranking), 'output_candidates' (the number left after reranking and filtering), 'seconds' (the time taken), and 'flags' (a list of the limits the patient reached: 'max_hits_per_note', 'max_hits_per_patient', and/or 'time_budget'; see ExtractionLimits).
+    '''
+    def __init__(self):
+        self.notes = 0
+        self.hits = 0
+        self.repeated_hits = 0
+        self.candidates = 0
+        self.output_candidates = 0
+        self.seconds = 0.0
+        self.flags = []
+
+    def __repr__(self):
+        return "notes: %s; hits: %s; repeated hits: %s; candidates: %s; output candidates: %s; seconds: %s; flags: %s" % (self.notes, self.hits, self.repeated_hits, self.candidates, self.output_candidates, self.seconds, self.flags)
+
+    def flag(self, limit):
+        '''
+        This method takes as input the name of a limit and records that the patient reached it.
+        '''
+        if limit not in self.flags:
+            self.flags.append(limit)
+
+    def format_line(self, MRN):
+        '''
+        This method takes as input the patient's MRN and returns a line (without a trailing newline) in the format: MRN [tab] notes [tab] hits [tab] repeated hits [tab] candidates [tab] output candidates [tab] seconds [tab] flags, where flags are comma-separated, or '-' if there are none.
+        '''
+        return '\t'.join([MRN, str(self.notes), str(self.hits), str(self.repeated_hits), str(self.candidates), str(self.output_candidates), '%.6f' % self.seconds, ','.join(self.flags) or '-'])
+
+
+
+class NoteDateIndex(object):
+    '''
+    A NoteDateIndex indexes a patient's ClinicNote objects by document creation date. It has attributes 'notes' (the list of ClinicNote objects), 'anchors' (a list of the Date objects corresponding to the creation dates of the notes, in the same order), and 'sorted_anchors' (a list of (day ordinal, note index) 2-tuples for the notes whose creation dates could be interpreted, in ascending order).
+    The anchor of a note is the Date against which two-digit years and relative date expressions in the note are resolved; a note whose creation date cannot be interpreted is anchored to the patient's most recent note.
+    '''
+    def __init__(self, notes):
+        self.notes = notes
+        self.anchors = [make_anchor_date(note.date) for note in notes]
+        self.sorted_anchors = sorted([(anchor.dt.toordinal(), i) for i, anchor in enumerate(self.anchors) if anchor])
+
+        if self.sorted_anchors:
+            latest = self.anchors[self.sorted_anchors[-1][1]]
+            self.anchors = [anchor or latest for anchor in self.anchors]
+
+        # Relative date expressions are resolved in one pass per note, the first time the note is queried
+        self.relative_dates = {}
+        # Hash of note indices mapped to the (start, end) span of the note text to which the pass is restricted (see set_span())
+        self.spans = {}
+
+    def __repr__(self):
+        return "anchors: %s" % self.anchors
+
+    def get_relative_dates(self, i):
+        '''
+        This method takes as input the index of a note and returns a 3-tuple of the list of (Date, start_index, end_index) 3-tuples for the relative date expressions in the note, the list of their start indices, and the list of their end indices.
+        '''
+        if i not in self.relative_dates:
+            if self.anchors[i] and i in self.spans:
+                start, end = self.spans[i]
+                dates = [(date, start+date_start, start+date_end) for date, date_start, date_end in extract_relative_dates(self.notes[i].text[start:end], self.anchors[i])]
+            elif self.anchors[i]:
+                dates = extract_relative_dates(self.notes[i].text, self.anchors[i])
+            else:
+                dates = []
+            self.relative_dates[i] = (dates, [x[1] for x in dates], [x[2] for x in dates])
+        return self.relative_dates[i]
 
+    def set_span(self, i, start, end):
+        '''
+        This method takes as input the index of a note and the start and end indices of a span of its text, and restricts the note's relative date expressions to those within the span, so that later queries only about the span do not pay for a pass over the whole note (restricting it again to the same span keeps the expressions already found). Relative date expressions never contain a period, so for a span that starts and ends at periods (or at the ends of the text), the expressions found are the same as in the whole note.
+        '''
+        if self.spans.get(i) != (start, end):
+            self.spans[i] = (start, end)
+            self.relative_dates.pop(i, None)
+
+    def find_relative_date(self, i, span_start, span_end, position):
+        '''
+        This method takes as input the index of a note, the start and end indices of a span of its text, and either 'first' or 'last', and returns the (Date, start_index, end_index) 3-tuple for the first or last relative date expression that lies entirely within the span (or None if there is none).
+        '''
+        dates, starts, ends = self.get_relative_dates(i)
+        if not dates:
+            return None
+
+        # Relative date expressions do not overlap, so both their starts and their ends are in ascending order
+        if position=='first':
+            j = bisect_left(starts, span_start)
+            if j < len(dates) and ends[j] <= span_end:
+                return dates[j]
+        else:
+            j = bisect_right(ends, span_end) - 1
+            if j >= 0 and starts[j] >= span_start:
+                return dates[j]
+
+
+
+def compile_keyword_regex(keywords, binary=False):
+    '''
+    This method takes as input a list of Keyword objects and an optional boolean, and returns a compiled case-insensitive regex matching any of them, with one capture group per keyword (or None if the list is empty), matching ASCII bytes if binary is True.
+    '''
+    if keywords:
+        pattern = '|'.join(['(' + re.escape(keyword.text) + ')' for keyword in keywords])
+        if binary:
+            pattern = pattern.encode('ascii')
+        return re.compile(pattern, re.IGNORECASE)
 
 
 def get_notes_dict(file):
@@ -101,22 +617,66 @@ def get_notes_dict(file):
     notes_dict = {}
     
     for line in file:
-        line_elements = line.strip().split('\t')
-        if len(line_elements) not in [3, 4]:
-            LOG.warning("Bad notes file line format; skipping: %s" % line)
-        else:
-            if len(line_elements) == 3:
-                note = ClinicNote(line_elements[1], line_elements[2], '')
+        MRN, note = get_note_from_line(line)
+        if note:
+            if notes_dict.get(MRN):
+                notes_dict[MRN].append(note)
             else:
-                note = ClinicNote(line_elements[1], line_elements[2], line_elements[3])
-            if notes_dict.get(line_elements[0]):
-                notes_dict[line_elements[0]].append(note)
-            else:
-                notes_dict[line_elements[0]] = [note]
+                notes_dict[MRN] = [note]
             
     return notes_dict
 
 
+def get_note_from_line(line):
+    '''
+    This method takes as input a line of a notes file and returns a 2-tuple of the MRN and a ClinicNote object, or (None, None) (with a warning) if the line is not in the right format.
+    '''
+    line_elements = line.strip().split('\t')
+    if len(line_elements) not in [3, 4]:
+        LOG.warning("Bad notes file line format; skipping: %s" % line)
+        return (None, None)
+    elif len(line_elements) == 3:
+        return (line_elements[0], ClinicNote(line_elements[1], line_elements[2], ''))
+    else:
+        return (line_elements[0], ClinicNote(line_elements[1], line_elements[2], line_elements[3]))
+
+
+def get_notes_dict_bytes(file):
+    '''
+    This method takes as input a notes file opened in binary mode and returns the same dictionary as get_notes_dict() does for the file opened as text (UTF-8, with undecodable bytes replaced), except that the text of the notes of a patient whose note lines are all ASCII is kept as bytes rather than decoded. Such notes are searched with bytes regexes (see get_date_candidates()), and only the date expressions and snippets that are needed are decoded.
+    Lines that are not ASCII, or that hold a carriage return other than a final CRLF (which text mode would split into several lines), are decoded and read as text, and the notes of their patients are all decoded, so that a patient's notes are either all bytes or all str.
+    '''
+    notes_dict = {}
+    decoded_MRNs = set()
+
+    for line in file:
+        if line.isascii() and (b'\r' not in line or (line.endswith(b'\r\n') and line.count(b'\r') == 1)):
+            line_elements = line.strip(ASCII_WHITESPACE).split(b'\t')
+            if len(line_elements) not in [3, 4]:
+                LOG.warning("Bad notes file line format; skipping: %s" % line.decode('ascii'))
+                continue
+            MRN = line_elements[0].decode('ascii')
+            note = ClinicNote(line_elements[1].decode('ascii'), line_elements[2].decode('ascii'), line_elements[3] if len(line_elements) == 4 else b'')
+            notes_dict.setdefault(MRN, []).append(note)
+        else:
+            # Decoded as in text mode, with universal newlines
+            text_lines = line.decode('utf-8', errors='replace').replace('\r\n', '\n').replace('\r', '\n').split('\n')
+            if text_lines[-1] == '':
+                text_lines.pop()
+            for text_line in text_lines:
+                MRN, note = get_note_from_line(text_line + '\n')
+                if note:
+                    notes_dict.setdefault(MRN, []).append(note)
+                    decoded_MRNs.add(MRN)
+
+    for MRN in decoded_MRNs:
+        for note in notes_dict[MRN]:
+            if isinstance(note.text, bytes):
+                note.text = note.text.decode('ascii')
+
+    return notes_dict
+
+
 def get_keywords_list(file):
     '''
     This method takes as input an open file object and returns a list of Keyword objects.
@@ -125,12 +685,14 @@ def get_keywords_list(file):
     
     for line in file:
         line_elements = line.strip().split('\t')
-        if len(line_elements) not in [2, 3]:
+        if len(line_elements) not in [2, 3, 4]:
             LOG.warning("Bad keywords file line format; skipping: %s" % line)
         else:
             text = line_elements[0]
             position = line_elements[1]
-            if len(line_elements) == 3:
+            if len(line_elements) == 4:
+                keyword = Keyword(text, position, line_elements[2], line_elements[3])
+            elif len(line_elements) == 3:
                 keyword = Keyword(text, position, line_elements[2])
             else:
                 keyword = Keyword(text, position)
@@ -139,125 +701,421 @@ def get_keywords_list(file):
     return keywords
 
 
-def extract_events(notes_list, keywords_list, filter=0.0, n=0):
+def extract_events(notes_list, keywords_list, filter=0.0, n=0, prefilter=None, limits=None, stats=None, copy_forward=None, hits=None):
     '''
-    This function takes as input a list of ClinicNote objects, a list of Keyword objects, an optional minimum confidence score (float; default = 0.0), and an optional int 'n' referring to the minimum number of candidate dates to be returned (default = 0), and returns a list of DateCandidate objects corresponding with date expressions that the system has identified in the patient's clinic notes based on Keyword objects.
+    This function takes as input a list of ClinicNote objects, a list of Keyword objects (or a KeywordIndex built from them), an optional minimum confidence score (float; default = 0.0), an optional int 'n' referring to the minimum number of candidate dates to be returned (default = 0), an optional KeywordPrefilter built from the same keywords, an optional ExtractionLimits object, an optional PatientStats object to be filled in, an optional CopyForwardPolicy (see get_date_candidates()), and an optional list to which the patient's keyword hits are appended (see get_hits()), and returns a list of DateCandidate objects corresponding with date expressions that the system has identified in the patient's clinic notes based on Keyword objects.
     '''
-    extracted = get_date_candidates(notes_list, keywords_list)
+    if stats:
+        start = time.perf_counter()
+    extracted = get_date_candidates(notes_list, keywords_list, prefilter, limits, stats, copy_forward)
+    if stats:
+        stats.candidates = len(extracted)
+    if hits is not None:
+        hits.extend(get_hits(extracted))
     rerank_candidates(extracted, filter, n)
+    if stats:
+        stats.output_candidates = len(extracted)
+        stats.seconds = time.perf_counter() - start
     return extracted
     
 
-def naive_extract_events(notes):
+def extract_events_batch(notes_lists, keywords_list, filter=0.0, n=0, prefilter=None, limits=None, stats_list=None, copy_forward=None, verbose=False, hits_list=None):
     '''
-    This function takes as input a list of ClinicNote objects and returns a list of DateCandidate objects corresponding with ALL date expressions that the system has identified in the patient's clinic notes. (Not called in current code, it is intended to be used to establish a recall ceiling for evaluation -- i.e., to see how many of the gold dates actually appear in the notes at all.)
+    This function takes as input a list of lists of ClinicNote objects (one list per patient), the same optional arguments as extract_events() (but with lists of PatientStats objects and of lists of keyword hits, one per patient, in place of a single one), and a boolean specifying whether snippets are kept (default: False). It finds every patient's date candidates, reranks them all at once with date_candidate.rerank_candidate_columns(), and returns, for each patient, the list of (date expression, score, snippets) 3-tuples that get_output_rows() returns for the list extract_events() returns.
+    NB: A patient's recorded time covers finding its candidates, but not reranking, which is done for the whole batch.
     '''
+    columns = CandidateColumns()
     candidates = []
+    for k, notes_list in enumerate(notes_lists):
+        stats = stats_list[k] if stats_list else None
+        if stats:
+            start = time.perf_counter()
+        extracted = get_date_candidates(notes_list, keywords_list, prefilter, limits, stats, copy_forward)
+        if stats:
+            stats.candidates = len(extracted)
+            stats.seconds = time.perf_counter() - start
+        if hits_list:
+            hits_list[k].extend(get_hits(extracted))
+        columns.add_patient(extracted)
+        if verbose:
+            candidates.extend(extracted)
+
+    rows_list = []
+    for k, reranked in enumerate(rerank_candidate_columns(columns, filter, n, verbose)):
+        if stats_list:
+            stats_list[k].output_candidates = len(reranked)
+        if verbose:
+            rows_list.append([(get_packed_date_expression(columns.dates[row]), score, decode_snippets([snippet for i in rows for snippet in candidates[i].snippets])) for row, score, rows in reranked])
+        else:
+            rows_list.append([(get_packed_date_expression(columns.dates[row]), score, None) for row, score, rows in reranked])
+    return rows_list
 
-    for note in notes:
-        dates = [x[0] for x in extract_dates_and_char_indices(note.text)]
 
-        for d in dates:
+def get_hits(candidates):
+    '''
+    This method takes as input a list of DateCandidate objects as returned by get_date_candidates(), before they are reranked, and returns a list of (Keyword, packed date, weight) 3-tuples, one per candidate, where the date is packed with date_candidate.pack_candidate_date(). These are the keyword hits from which the patient's dates are scored, so the scores can be recomputed without any one keyword's hits (see eval_output.get_keyword_report()).
+    '''
+    return [(candidate.keyword, pack_candidate_date(candidate.date), candidate.weight) for candidate in candidates]
+
+
+def naive_extract_events(notes):
+    '''
+    This function takes as input a list of ClinicNote objects and returns a list of DateCandidate objects corresponding with ALL date expressions that the system has identified in the patient's clinic notes. (Not called in current code, it is intended to be used to establish a recall ceiling for evaluation -- i.e., to see how many of the gold dates actually appear in the notes at all. See also mention_index.py, which answers the same question from an index built once for the whole corpus.)
+    '''
+    candidates = []
+
+    for note, mentions in zip(notes, get_date_mentions(notes)):
+        for d, start, end in mentions:
             date_candidate = DateCandidate(d, [note.text])
             candidates.append(date_candidate)
     
-    rerank_candidates(candidates)
+    rerank_candidates(candidates, 0.0, 0)
     return candidates
 
 
-def get_date_candidates(notes, keywords):
+def get_date_mentions(notes):
     '''
-    This method takes as input a list of ClinicNote objects and a list of Keyword objects. It then returns a list of DateCandidate objects representing dates that appear in the clinic notes correlated with the input keywords.
+    This method takes as input a list of ClinicNote objects and returns, for each note, the list of (Date, start_index, end_index) 3-tuples for ALL the date expressions in the note: first the absolute ones, then the relative ones, each in the order in which they appear. Two-digit years and relative date expressions are resolved against the anchor date of the note (see NoteDateIndex).
     '''
-    candidates = []
-    pre_date_keywords = filter(lambda x: x.position=='PRE-DATE', keywords)
-    post_date_keywords = filter(lambda x: x.position=='POST-DATE', keywords)
-    LOG.debug("Here are the pre-date keywords: %s" % pre_date_keywords)
-    LOG.debug("Here are the post-date keywords: %s" % post_date_keywords)
+    date_index = NoteDateIndex(notes)
+    mentions = []
+
+    for i, note in enumerate(notes):
+        anchor = date_index.anchors[i]
+        if anchor:
+            mentions.append(extract_dates_and_char_indices(note.text, anchor.dt.year) + date_index.get_relative_dates(i)[0])
+        else:
+            mentions.append(extract_dates_and_char_indices(note.text))
+
+    return mentions
+
+
+def get_date_candidates(notes, keywords, prefilter=None, limits=None, stats=None, copy_forward=None):
+    '''
+    This method takes as input a list of ClinicNote objects, a list of Keyword objects (or a KeywordIndex built from them, which avoids recompiling the keyword regexes for every patient), and optionally a KeywordPrefilter built from the same keywords, an ExtractionLimits object, a PatientStats object, and a CopyForwardPolicy. It then returns a list of DateCandidate objects representing dates that appear in the clinic notes correlated with the input keywords.
+    If a prefilter is given, the PRE-DATE (POST-DATE) keyword regex is only run over notes that contain the text of at least one PRE-DATE (POST-DATE) keyword.
+    If limits are given, keyword hits beyond them are not processed (PRE-DATE hits in a note are processed before its POST-DATE hits), and the limits reached are flagged in the stats. The number of notes and of keyword hits processed are also recorded in the stats.
+    If a copy-forward policy is given, each distinct sentence (see get_sentence_spans()) is only searched once per patient: a sentence seen again with the same text around it (see get_sentence_key(); typically text copied forward from an earlier note) counts the hits found in it the first time without being searched, in the same order and against the same limits. The date expression of each distinct snippet is likewise only looked for once (see get_span_dates()), and repeats are weighted according to the policy, so that with the 'all' policy the candidates are the same as without one. (If a keyword contains a period, notes are searched whole and only snippets are deduplicated.)
+    '''
+    if not isinstance(keywords, KeywordIndex):
+        keywords = KeywordIndex(keywords)
+    LOG.debug("Here are the pre-date keywords: %s", keywords.pre_date_keywords)
+    LOG.debug("Here are the post-date keywords: %s", keywords.post_date_keywords)
     
-    # Store the window sizes in a dictionary that maps (keyword text, position) tuples to window sizes
-    window_sizes = {}
-    for keyword in keywords:
-        window_sizes[(keyword.text.lower(), keyword.position)] = keyword.window
+    candidates = []
+    # Notes read with get_notes_dict_bytes() hold ASCII bytes, which are searched with bytes regexes
+    binary = bool(notes) and isinstance(notes[0].text, bytes)
+    pre_date_regex, post_date_regex = keywords.get_regexes(binary)
+    pre_date_snippet_split = (pre_date_snippet_bytes_regex if binary else pre_date_snippet_regex).split
+    post_date_snippet_split = (post_date_snippet_bytes_regex if binary else post_date_snippet_regex).split
+    pre_date_keywords = keywords.pre_date_keywords
+    post_date_keywords = keywords.post_date_keywords
     
-    if pre_date_keywords:
-#       pre_date_regex = re.compile('|'.join(['['+keyword[0].upper()+keyword[0]+']'+keyword[1:] for keyword in pre_date_keywords]))
-        pre_date_keywords = map(lambda w: ''.join(map(lambda x: '[' + x.upper() + x + ']', w.text)), pre_date_keywords)
-        pre_date_regex = re.compile('|'.join(pre_date_keywords))
-
-    if post_date_keywords:
-#       post_date_regex = re.compile('|'.join(['['+keyword[0].upper()+keyword[0]+']'+keyword[1:] for keyword in post_date_keywords]))
-        post_date_keywords = map(lambda w: ''.join(map(lambda x: '[' + x.upper() + x + ']', w.text)), post_date_keywords)
-        post_date_regex = re.compile('|'.join(post_date_keywords))
+    date_index = NoteDateIndex(notes)
+
+    # The remaining number of hits allowed for the patient, and the time after which no more hits are processed (None if unlimited)
+    if limits:
+        patient_hits_left = limits.max_hits_per_patient
+        deadline = time.perf_counter() + limits.time_budget if limits.time_budget is not None else None
+    else:
+        patient_hits_left = None
+        deadline = None
+    hits = 0
+    # For the copy-forward policy: hash of (Keyword, snippet) pairs mapped to their numbers of occurrences, hash of (snippet, 'first' or 'last') pairs mapped to what find_event_date() found in them (whether it is relative, and the absolute expression), and hash of (absolute expression, anchor year) pairs mapped to their dates
+    spans = {}
+    expressions = {}
+    dates = {}
+    # Hash of sentence keys (see get_sentence_key()) mapped to the (Keyword, snippet, snippet offset) 3-tuples of the hits in them, for the copy-forward policy (None if notes are searched whole)
+    sentences = {} if copy_forward and not [keyword for keyword in keywords.keywords if '.' in keyword.text] else None
+    # The farthest a PRE-DATE window reaches past a hit, and a POST-DATE window before one
+    windows = {'first': max([keyword.window for keyword in pre_date_keywords] or [0]), 'last': max([keyword.window for keyword in post_date_keywords] or [0])}
+    # The limit that stopped processing of the patient, and of the current note
+    patient_limit_reached = None
     
-    for note in notes:
-        
-        if pre_date_keywords:
-            pre_date_matches = pre_date_regex.finditer(note.text)
-            for match in pre_date_matches:
-                LOG.debug("Found pre-date keyword match: %s" % match.group(0))
-                window_size = window_sizes[(match.group(0).lower(), 'PRE-DATE')]
-                
-                # Set the window beginning at the start of the match to pre_date_window_size characters or all remaining characters, whichever is less
-                window = note.text[match.start(0):(match.end(0)+window_size)]
-        
-                # Look for first date in window -- do not pass a period or the end of the text
-                snippet = re.split('[.]|[a-z],|dmitted|:.*:', window)[0]
-                LOG.debug("Looking for date in: %s" % snippet)
-
-                event_date_str = extract_date(snippet, 'first')
-                LOG.debug("Extracted: %s" % event_date_str)
-                if event_date_str:
-                    LOG.debug("Found date expression: %s" % event_date_str)
-                    event_dates = make_date(event_date_str)
-                
+    for i, note in enumerate(notes):
+        if deadline is not None and time.perf_counter() > deadline:
+            patient_limit_reached = 'time_budget'
+        if patient_limit_reached:
+            break
+
+        # The number of hits allowed in this note (None if unlimited), and the limit that sets it
+        note_hits_left = limits.max_hits_per_note if limits else None
+        note_limit = 'max_hits_per_note'
+        if patient_hits_left is not None and (note_hits_left is None or patient_hits_left < note_hits_left):
+            note_hits_left = patient_hits_left
+            note_limit = 'max_hits_per_patient'
+        note_limit_reached = None
+        note_hits = 0
+
+        if prefilter:
+            mask = prefilter.get_mask(note)
+            search_pre_date = pre_date_regex and (mask & prefilter.pre_date_mask)
+            search_post_date = post_date_regex and (mask & prefilter.post_date_mask)
+        else:
+            search_pre_date = pre_date_regex
+            search_post_date = post_date_regex
+        if not (search_pre_date or search_post_date):
+            continue
+
+        if sentences is None:
+            note_spans = [(0, len(note.text))]
+        else:
+            note_spans = get_sentence_spans(note.text)
+
+        # As when the note is searched whole, all of its PRE-DATE hits are processed before its POST-DATE hits
+        for search, position, regex, direction_keywords, snippet_split in [(search_pre_date, 'first', pre_date_regex, pre_date_keywords, pre_date_snippet_split), (search_post_date, 'last', post_date_regex, post_date_keywords, post_date_snippet_split)]:
+            if not search or note_limit_reached:
+                continue
+            if position == 'last':
+                LOG.debug("Looking for postdate matches")
+
+            for span_start, span_end in note_spans:
+                if note_limit_reached:
+                    break
+
+                sentence_key = None
+                sentence_hits = None
+                if sentences is not None:
+                    sentence_key = get_sentence_key(note.text, span_start, span_end, position, windows[position])
+                    sentence_hits = sentences.get(sentence_key) if sentence_key is not None else None
+                if sentence_hits is not None:
+                    # The same text was already searched for this patient, so its hits are counted again without searching it
+                    span_hits = [(keyword, snippet, span_start+offset) for keyword, snippet, offset in sentence_hits]
+                    sentence_key = None
+                else:
+                    span_hits = get_keyword_hits(note.text, span_start, span_end, regex, direction_keywords, snippet_split, position)
+                    sentence_hits = []
+
+                for keyword, snippet, snippet_start in span_hits:
+                    if note_hits == note_hits_left:
+                        note_limit_reached = note_limit
+                        break
+                    if deadline is not None and time.perf_counter() > deadline:
+                        note_limit_reached = 'time_budget'
+                        break
+                    note_hits += 1
+                    if sentence_key is not None:
+                        sentence_hits.append((keyword, snippet, snippet_start-span_start))
+                    if sentences is not None:
+                        date_index.set_span(i, span_start, span_end)
+
+                    event_dates, weight = get_span_dates(spans, expressions, dates, keyword, snippet, snippet_start, position, date_index, i, copy_forward, stats)
                     # FIXME: Consider alternatives that keep coordinated dates together (or throw them out entirely)
-                    if event_dates:
-                        for event_date in event_dates:
-                            date_candidate = DateCandidate(event_date, [snippet])
-                            candidates.append(date_candidate)
-            
-            else:
-                LOG.debug("No date expression found")
-        
-        if post_date_keywords:      
-            LOG.debug("Looking for postdate matches")
-            post_date_matches = post_date_regex.finditer(note.text)
-            for match in post_date_matches:
-                LOG.debug("Found post-date keyword match: %s" % match.group(0))
-                window_size = window_sizes[(match.group(0).lower(), 'POST-DATE')]
-                
-                # Set the window to include the event expression and the prewindow_size characters before the event expression or all preceding characters, whichever is less
-                window = note.text[(match.start(0)-window_size):match.end(0)]
-        
-                # Look for the last date in the window -- do not pass a period
-                snippet = re.split('[.]|[a-z],|<%END%>|ischarge|dmitted.{20}', window)[-1]
-                LOG.debug("Looking for date in: %s" % snippet)
-            
-                event_date_str = extract_date(snippet, 'last')
-                LOG.debug("Extracted: %s" % event_date_str)        
-                if event_date_str:
-                    LOG.debug("Found date expression: %s" % event_date_str)
-                    event_dates = make_date(event_date_str)
-                                          
-                    if event_dates:
+                    if event_dates and weight is not None:
                         for event_date in event_dates:
-                            date_candidate = DateCandidate(event_date, [snippet])
+                            date_candidate = DateCandidate(event_date, [snippet], weight=weight, keyword=keyword)
                             candidates.append(date_candidate)
 
+                # Text cut short by a limit is not reused, since its list of hits is incomplete
+                if sentence_key is not None and not note_limit_reached:
+                    sentences[sentence_key] = sentence_hits
+
+        hits += note_hits
+        if patient_hits_left is not None:
+            patient_hits_left -= note_hits
+        if note_limit_reached:
+            LOG.debug("Reached %s in note %s", note_limit_reached, i)
+            if stats:
+                stats.flag(note_limit_reached)
+            if note_limit_reached != 'max_hits_per_note':
+                patient_limit_reached = note_limit_reached
+
+    if stats:
+        stats.notes = len(notes)
+        stats.hits = hits
+        if patient_limit_reached:
+            stats.flag(patient_limit_reached)
     return candidates
 
 
+def get_sentence_spans(text):
+    '''
+    This method takes as input a note text (str or bytes) and returns a list of (start, end) 2-tuples splitting it into sentences, each of which ends just after a period (or at the end of the text).
+    '''
+    period = b'.' if isinstance(text, bytes) else '.'
+    sentence_spans = []
+    start = 0
+    end = text.find(period) + 1
+    while end:
+        sentence_spans.append((start, end))
+        start = end
+        end = text.find(period, start) + 1
+    if start < len(text):
+        sentence_spans.append((start, len(text)))
+    return sentence_spans
+
+
+def get_sentence_key(text, span_start, span_end, position, window):
+    '''
+    This method takes as input a note text, the start and end indices of a sentence in it, either 'first' (for PRE-DATE hits) or 'last' (for POST-DATE hits), and the farthest a window of that kind reaches from a hit (see get_keyword_hits()), and returns a key under which the sentence's hits of that kind can be reused wherever the same key recurs, or None if they cannot be.
+    The key holds the sentence together with all the text the keyword regex and the windows of hits in it can see (the character before the sentence, and the window size after it for PRE-DATE hits or before it for POST-DATE hits), since the snippets are split out of the windows, and the split can depend on text past the period. A POST-DATE window that would start before the start of the note wraps around to its end (see the FIXME in get_keyword_hits()), so sentences closer than that to the start of the note are not reused.
+    '''
+    if position == 'first':
+        context_start = max(span_start-1, 0)
+        context_end = span_end + window
+    else:
+        if span_start < window:
+            return None
+        context_start = max(span_start-max(window, 1), 0)
+        context_end = span_end
+    return (position, span_start-context_start, span_end-span_start, text[context_start:context_end])
+
+
+def get_keyword_hits(text, span_start, span_end, regex, keywords, snippet_split, position):
+    '''
+    This method takes as input a note text, the start and end indices of the span of it to search, the PRE-DATE or POST-DATE keyword regex and list of Keyword objects, the split() method of the matching snippet regex, and either 'first' (PRE-DATE) or 'last' (POST-DATE), and generates a (Keyword, snippet, snippet start index) 3-tuple for each keyword hit in the span, in order.
+    A PRE-DATE snippet starts at the hit and runs up to the keyword's window size past it; a POST-DATE snippet ends with the hit and starts up to the keyword's window size before it. Either way, it stops at the first period (or other snippet boundary; see pre_date_snippet_regex and post_date_snippet_regex).
+    '''
+    for match in regex.finditer(text, span_start, span_end):
+        LOG.debug("Found %s keyword match: %s", 'pre-date' if position == 'first' else 'post-date', match.group(0))
+        keyword = keywords[match.lastindex-1]
+        window_size = keyword.window
+        if position == 'first':
+            # Set the window beginning at the start of the match to window_size characters past its end or all remaining characters, whichever is less
+            window = text[match.start(0):(match.end(0)+window_size)]
+            # Look for first date in window -- do not pass a period or the end of the text
+            snippet = snippet_split(window)[0]
+            snippet_start = match.start(0)
+        else:
+            # Set the window to include the event expression and the window_size characters before the event expression or all preceding characters, whichever is less
+            # FIXME: A match less than window_size characters from the start of the note gives a negative start index, which wraps around to the end of the note (usually leaving an empty snippet)
+            window = text[(match.start(0)-window_size):match.end(0)]
+            # Look for the last date in the window -- do not pass a period
+            snippet = snippet_split(window)[-1]
+            snippet_start = match.end(0)-len(snippet)
+        LOG.debug("Looking for date in: %s", snippet)
+        yield (keyword, snippet, snippet_start)
+
+
+def get_span_dates(spans, expressions, dates, keyword, snippet, snippet_start, position, date_index, i, copy_forward=None, stats=None):
+    '''
+    This method takes as input the hashes of spans, date expressions, and dates seen so far for the patient (see get_date_candidates()), the Keyword that was hit, the arguments of get_event_dates(), and optionally a CopyForwardPolicy and a PatientStats object. It returns a 2-tuple of the event dates for the hit and the weight with which they count (None if they do not count).
+    Without a copy-forward policy, this is get_event_dates() with the keyword weight. With one, the weight of a (keyword, snippet) pair already in spans is set by the policy, and the date expression found in a snippet (see find_event_date()) is reused for its later occurrences, and so are the dates of an absolute expression in notes whose anchors have the same year (which resolves two-digit years), so that every occurrence has the dates it would have without a policy.
+    '''
+    if not copy_forward:
+        return (get_event_dates(snippet, snippet_start, position, date_index, i), keyword.weight)
+
+    key = (keyword, snippet)
+    repeats = spans.get(key, 0)
+    spans[key] = repeats + 1
+    if repeats:
+        if stats:
+            stats.repeated_hits += 1
+        weight = copy_forward.get_weight(keyword.weight, repeats)
+        if weight is None:
+            return (None, None)
+    else:
+        weight = keyword.weight
+
+    expression_key = (snippet, position)
+    if expression_key not in expressions:
+        relative_date, expression = find_event_date(snippet, snippet_start, position, date_index, i)
+        expressions[expression_key] = (relative_date is not None, expression)
+        if relative_date is not None:
+            return ([relative_date], weight)
+    is_relative, expression = expressions[expression_key]
+    if is_relative:
+        # Relative dates are resolved against the whole anchor date, so they are looked for again
+        return (get_event_dates(snippet, snippet_start, position, date_index, i), weight)
+    if expression is None:
+        return (None, weight)
+
+    anchor_year = get_anchor_year(date_index, i)
+    if (expression, anchor_year) not in dates:
+        dates[(expression, anchor_year)] = make_date(expression, anchor_year)
+    return (dates[(expression, anchor_year)], weight)
+
+
+def get_event_dates(snippet, snippet_start, position, date_index, i):
+    '''
+    This method takes as input a snippet, the index in the note text at which the snippet starts, either 'first' or 'last', the NoteDateIndex for the patient, and the index of the note. It returns a list of Date objects for the first or last date expression (absolute or relative) in the snippet, or None if there is none. Two-digit years and relative date expressions are resolved against the anchor date of the note.
+    '''
+    relative_date, expression = find_event_date(snippet, snippet_start, position, date_index, i)
+    if relative_date:
+        return [relative_date]
+    if expression:
+        return make_date(expression, get_anchor_year(date_index, i))
+
+
+def find_event_date(snippet, snippet_start, position, date_index, i):
+    '''
+    This method takes as input the same arguments as get_event_dates() and returns a 2-tuple of the Date object for the relative date expression that get_event_dates() returns the date of, or the absolute date expression (a str) that it interprets, and None. Both are None if the snippet has no date expression.
+    NB: Which expression is chosen only depends on the text of the snippet, not on the anchor of the note.
+    '''
+    event_date_match = extract_date_match(snippet, position)
+    relative_date = date_index.find_relative_date(i, snippet_start, snippet_start+len(snippet), position)
+    
+    if relative_date:
+        relative_date_start = relative_date[1] - snippet_start
+        if (not event_date_match) or (position=='first' and relative_date_start < event_date_match.start()) or (position=='last' and relative_date_start > event_date_match.start()):
+            LOG.debug("Found relative date expression: %s", snippet[relative_date_start:relative_date[2]-snippet_start])
+            return (relative_date[0], None)
+    
+    if event_date_match:
+        LOG.debug("Found date expression: %s", event_date_match.group(0))
+        expression = event_date_match.group(0)
+        if isinstance(expression, bytes):
+            expression = expression.decode('ascii')
+        return (None, expression)
+    
+    LOG.debug("No date expression found")
+    return (None, None)
+
+
+def get_anchor_year(date_index, i):
+    '''
+    This method takes as input a NoteDateIndex and the index of a note, and returns the year of the note's anchor date (against which two-digit years are resolved), or None if it has none.
+    '''
+    anchor = date_index.anchors[i]
+    return anchor.dt.year if anchor else None
+
+
 def print_output(output_dict, verbose=False):
     '''
     This method takes as input a hash of MRNs mapped to lists of DateCandidate objects and a boolean True or False specifying whether or not supporting snippets should be printed (default: False), and prints to standard out lines in the following format: MRN [tab] date1 [tab] score1 [tab] (snippets_list1 [tab]) date2 [tab] score2 (snippets_list2 [tab])... , where dates appear in descending order by score.
     '''
     for MRN in output_dict:
-        sorted_candidates = sorted(output_dict[MRN], key=lambda candidate: candidate.score, reverse=True)
-        if verbose:
-            print MRN+'\t'+'\t'.join([c.date.make_date_expression()+'\t'+str(c.score)+'\t'+str(c.snippets) for c in sorted_candidates])
-        else:
-            print MRN+'\t'+'\t'.join([c.date.make_date_expression()+'\t'+str(c.score) for c in sorted_candidates])
+        print(format_output_line(MRN, output_dict[MRN], verbose))
+
+
+def format_output_line(MRN, candidates, verbose=False):
+    '''
+    This method takes as input an MRN, a list of DateCandidate objects, and a boolean True or False specifying whether or not supporting snippets should be included (default: False), and returns the output line for the patient (without a trailing newline) in the format described in print_output().
+    '''
+    return format_output_rows(MRN, get_output_rows(candidates, verbose))
+
+
+def get_output_rows(candidates, verbose=False):
+    '''
+    This method takes as input a list of DateCandidate objects and a boolean True or False specifying whether or not supporting snippets should be kept (default: False), and returns a list of (date expression, score, snippets) 3-tuples in descending order by score, where snippets is None unless verbose is True. These tuples carry everything format_output_rows() needs, so they can stand in for the candidates when results are passed between processes.
+    '''
+    sorted_candidates = sorted(candidates, key=lambda candidate: candidate.score, reverse=True)
+    if verbose:
+        return [(c.date.make_date_expression(), c.score, decode_snippets(c.snippets)) for c in sorted_candidates]
+    else:
+        return [(c.date.make_date_expression(), c.score, None) for c in sorted_candidates]
+
+
+def decode_snippets(snippets):
+    '''
+    This method takes as input a list of snippets and returns it with the snippets that are ASCII bytes (see get_notes_dict_bytes()) decoded to str. Snippets are only decoded here, for output.
+    '''
+    return [snippet.decode('ascii') if isinstance(snippet, bytes) else snippet for snippet in snippets]
+
+
+def format_hit_lines(MRN, hits):
+    '''
+    This method takes as input an MRN and a list of the patient's keyword hits (see get_hits()), and returns a list of lines (each with a trailing newline) for the hits file, in the following format:
+    MRN [tab] keyword [tab] position [tab] packed date [tab] weight
+    '''
+    return ['%s\t%s\t%s\t%d\t%r\n' % (MRN, keyword.text, keyword.position, packed_date, weight) for keyword, packed_date, weight in hits]
+
+
+def format_output_rows(MRN, rows):
+    '''
+    This method takes as input an MRN and a list of (date expression, score, snippets) 3-tuples as returned by get_output_rows(), and returns the output line for the patient (without a trailing newline).
+    '''
+    return MRN+'\t'+'\t'.join([row[0]+'\t'+str(row[1]) if row[2] is None else row[0]+'\t'+str(row[1])+'\t'+str(row[2]) for row in rows])
 
 
 if __name__=='__main__':
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+'''
+This module lets extract_events.py run as a pipeline of threads connected by bounded queues, so that reading the notes file, extracting dates, and writing the output overlap instead of running one after the other, and only a bounded number of patients are held in memory at a time.
+
+A reader thread reads the notes file line by line and groups the lines of each patient into a list of ClinicNote objects; one or more worker threads extract each patient's dates and turn them into compact (date expression, score, snippets) tuples (see extract_events.get_output_rows()); and the calling thread, as the writer, receives the results in the order of the notes file, formats them, and writes them (see extract_events_pipelined()). A patient is complete once a line with a different MRN is read, so the notes file must list each patient's notes together, and for the output to be in the same order as without the pipeline, in MRN order.
+NB: The threads share the interpreter lock, which the regex engine does not release, so more than one worker does not make extraction itself faster; what the pipeline overlaps is extraction with reading and writing.
+'''
+
+import logging
+import threading
+from queue import Queue
+from extract_events import KeywordIndex, KeywordPrefilter, PatientStats, extract_events, get_note_from_line, get_output_rows
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.WARNING)
+
+
+def read_patients(notes_filename, skip, slots, patient_queue, result_queue, workers, stop):
+    '''
+    This method is run in the reader thread. It takes as input a path to a notes file, a set of MRNs whose notes are not needed (or None), a semaphore holding one slot per patient allowed in the pipeline at a time, the queues to the workers and to the writer, the number of workers, and an event set when the writer stops. It puts a (sequence number, MRN, notes) 3-tuple on the patient queue for every patient in the notes file, in file order, with notes None for the patients in skip, followed by one None per worker. An error (including a notes file that is not sorted by MRN) is passed to the writer as a (None, exception) 2-tuple.
+    '''
+    try:
+        notes_file = open(notes_filename, encoding='utf-8', errors='replace')
+        try:
+            sequence = 0
+            current_MRN = None
+            current_notes = []
+            for line in notes_file:
+                MRN, note = get_note_from_line(line)
+                if not note:
+                    continue
+                if MRN != current_MRN:
+                    if current_MRN is not None:
+                        if MRN < current_MRN:
+                            raise ValueError("Notes file %s is not sorted by MRN (%s follows %s); sort it or run without --pipeline" % (notes_filename, MRN, current_MRN))
+                        if not put_patient(patient_queue, slots, stop, (sequence, current_MRN, None if skip and current_MRN in skip else current_notes)):
+                            return
+                        sequence += 1
+                    current_MRN = MRN
+                    current_notes = []
+                current_notes.append(note)
+            if current_MRN is not None:
+                put_patient(patient_queue, slots, stop, (sequence, current_MRN, None if skip and current_MRN in skip else current_notes))
+        finally:
+            notes_file.close()
+    except Exception as e:
+        result_queue.put((None, e))
+    finally:
+        for i in range(workers):
+            patient_queue.put(None)
+
+
+def put_patient(patient_queue, slots, stop, item):
+    '''
+    This method takes as input the patient queue, the semaphore of patient slots, the stop event, and a patient's (sequence number, MRN, notes) 3-tuple, and puts the patient on the queue once a slot is free. It returns False (without putting it) if the writer stopped first.
+    '''
+    while not slots.acquire(timeout=0.1):
+        if stop.is_set():
+            return False
+    patient_queue.put(item)
+    return True
+
+
+def extract_patients(keyword_index, filter, n, verbose, limits, copy_forward, patient_queue, result_queue):
+    '''
+    This method is run in each worker thread. It takes as input a KeywordIndex, a minimum score, a minimum number of dates, a boolean specifying whether snippets are kept, an optional ExtractionLimits object, an optional CopyForwardPolicy, and the queues from the reader and to the writer. For each patient taken from the patient queue, it puts on the result queue a (sequence number, result) 2-tuple, where the result is the 5-tuple returned by shared_corpus.extract_patient() (or (MRN, None, 0, 0, None) for a patient whose notes are not needed), and it puts None on the result queue when the reader is done. An error is passed to the writer as a (None, exception) 2-tuple.
+    Each worker has its own KeywordPrefilter, since the prefilter's counts and cache change as it is used.
+    '''
+    prefilter = KeywordPrefilter(keyword_index.keywords)
+    try:
+        while True:
+            item = patient_queue.get()
+            if item is None:
+                break
+            sequence, MRN, notes = item
+            if notes is None:
+                result_queue.put((sequence, (MRN, None, 0, 0, None)))
+                continue
+
+            notes_seen = prefilter.notes_seen
+            notes_skipped = prefilter.notes_skipped
+            stats = PatientStats()
+            candidates = extract_events(notes, keyword_index, filter, n, prefilter, limits, stats, copy_forward)
+            result_queue.put((sequence, (MRN, get_output_rows(candidates, verbose), prefilter.notes_seen-notes_seen, prefilter.notes_skipped-notes_skipped, stats)))
+    except Exception as e:
+        result_queue.put((None, e))
+    finally:
+        result_queue.put(None)
+
+
+def extract_events_pipelined(notes_filename, keywords_list, filter=0.0, n=0, verbose=False, limits=None, copy_forward=None, skip=None, workers=1, queue_size=64):
+    '''
+    This method takes as input a path to a notes file (see the NB at the top of this module), a list of Keyword objects, a minimum score, a minimum number of dates, a boolean specifying whether snippets are kept, an optional ExtractionLimits object, an optional CopyForwardPolicy, an optional set of MRNs whose notes are not needed (e.g. those already in a checkpoint), a number of worker threads, and the number of patients allowed in the pipeline at a time. It starts the reader and worker threads and generates, in the order of the notes file, a 5-tuple for every patient as returned by shared_corpus.extract_patient(), or (MRN, None, 0, 0, None) for the patients in skip. An error in the reader or a worker is raised here.
+    At most queue_size patients are read ahead of the one being written, so the reader waits while the workers or the writer fall behind.
+    '''
+    keyword_index = KeywordIndex(keywords_list)
+    slots = threading.Semaphore(queue_size)
+    stop = threading.Event()
+    # Every patient in the pipeline holds a slot, so the queues never block a thread that holds a patient
+    patient_queue = Queue(queue_size + workers)
+    result_queue = Queue()
+
+    threads = [threading.Thread(target=read_patients, args=(notes_filename, skip, slots, patient_queue, result_queue, workers, stop), daemon=True)]
+    for i in range(workers):
+        threads.append(threading.Thread(target=extract_patients, args=(keyword_index, filter, n, verbose, limits, copy_forward, patient_queue, result_queue), daemon=True))
+    for thread in threads:
+        thread.start()
+
+    # Results arrive in the order the workers finish them and are held until the ones before them have been written
+    pending = {}
+    next_sequence = 0
+    finished = 0
+    try:
+        while finished < workers:
+            item = result_queue.get()
+            if item is None:
+                finished += 1
+                continue
+            sequence, result = item
+            if sequence is None:
+                raise result
+            pending[sequence] = result
+            while next_sequence in pending:
+                yield pending.pop(next_sequence)
+                next_sequence += 1
+                slots.release()
+    finally:
+        stop.set()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+'''
+This script takes as input a path to a notes file, a path to a keywords file (both in the formats read by extract_events.py), and optionally a path to a gold data file (in the format read by eval_output.py), runs extraction (and evaluation) on them with memory allocations traced (see tracemalloc), and prints to standard out where the memory goes.
+
+The run is split into stages: load notes (get_notes_dict()), extract (get_date_candidates() for every patient), rerank (rerank_candidates() for every patient), output (the output lines, as extract_events.py writes them), and, with a gold data file, eval (the output and gold data dictionaries and the match matrix, as eval_output.py builds them). At the end of each stage, it prints a line in the following format:
+stage [tab] traced MB [tab] peak traced MB [tab] max RSS MB [tab] bytes per note
+
+...where traced is the memory allocated by python and still held at the end of the stage, peak traced is the most held at any time during the stage, max RSS is the peak resident memory of the process so far (as reported by the operating system), and bytes per note is traced divided by the number of notes. It then prints the number of objects of each class of interest (ClinicNote, DateCandidate, Date, datetime, snippets, str, and bytes) reachable from the results of the stages so far (see count_objects()), and the source lines that allocated the most memory during the stage (see get_top_sites()).
+
+NB: Every patient's results are kept until the end of the run, so that each stage's objects can be counted, whereas extract_events.py only holds one patient's (or one --rerank-batch batch's) candidates at a time; and tracing makes the run several times slower.
+
+With --max-bytes-per-note, the script also runs the stages over every other patient and over all of them again, and exits with an error if the growth of the peak traced memory per note between the two runs is above that budget (see get_growth_per_note()), so that it can be run as a regression check. The peak of a single run is not used, since it is dominated by costs that do not depend on the number of notes.
+'''
+
+import argparse
+import gc
+import logging
+import sys
+import tracemalloc
+from types import BuiltinFunctionType, FunctionType, ModuleType
+from eval_output import get_data_dict, get_match_matrix, get_output_dict
+from extract_events import KeywordIndex, KeywordPrefilter, format_output_line, get_date_candidates, get_keywords_list, get_notes_dict
+from date_candidate import rerank_candidates
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; max RSS is then not reported
+    resource = None
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.WARNING)
+
+# Classes whose objects are counted after each stage, in the order they are printed ('snippets' counts the snippets of the DateCandidate objects)
+COUNTED_CLASSES = ['ClinicNote', 'DateCandidate', 'Date', 'datetime', 'snippets', 'str', 'bytes']
+
+
+def main():
+    logging.basicConfig()
+
+    parser = argparse.ArgumentParser(description='Report the memory used by each stage of extraction and evaluation.')
+    parser.add_argument('notes_filename', help='notes file')
+    parser.add_argument('keywords_filename', help='keywords file')
+    parser.add_argument('gold_data_filename', nargs='?', help='gold data file (to also report evaluation)')
+    parser.add_argument('--filter', type=float, default=0.0, help='minimum score, as in extract_events.py (default: 0.0)')
+    parser.add_argument('--n', type=int, default=0, help='minimum number of dates, as in extract_events.py (default: 0)')
+    parser.add_argument('--verbose', action='store_true', help='keep snippets in the output lines, as extract_events.py --verbose does')
+    parser.add_argument('--top', type=int, default=10, metavar='K', help='number of allocation sites to print per stage (default: 10)')
+    parser.add_argument('--frames', type=int, default=1, help='number of stack frames recorded per allocation, to group allocation sites by their callers (default: 1)')
+    parser.add_argument('--max-bytes-per-note', type=float, metavar='B', help='exit with an error if the growth of the peak traced memory per note is above this budget')
+    args = parser.parse_args()
+
+    keywords_file = open(args.keywords_filename)
+    keyword_index = KeywordIndex(get_keywords_list(keywords_file))
+    keywords_file.close()
+    prefilter = KeywordPrefilter(keyword_index.keywords)
+
+    profile, notes = profile_stages(args.notes_filename, keyword_index, prefilter, args.filter, args.n, args.verbose, args.gold_data_filename, args.frames)
+    print_memory_profile(profile, notes, args.top)
+
+    if args.max_bytes_per_note is not None:
+        # The run above has paid the costs that are only paid once (such as compiling regexes on first use), so neither of the runs compared pays them
+        MRNs = get_MRNs(args.notes_filename)
+        if len(MRNs) < 2:
+            sys.exit("The growth per note cannot be measured with fewer than 2 patients")
+        growth = get_growth_per_note(profile_stages(args.notes_filename, keyword_index, prefilter, args.filter, args.n, args.verbose, args.gold_data_filename, args.frames, set(MRNs[::2])), profile_stages(args.notes_filename, keyword_index, prefilter, args.filter, args.n, args.verbose, args.gold_data_filename, args.frames))
+        print("Peak traced memory growth: %.0f bytes per note" % growth)
+        if growth > args.max_bytes_per_note:
+            sys.exit("Peak traced memory growth of %.0f bytes per note is over the budget of %.0f bytes per note" % (growth, args.max_bytes_per_note))
+
+
+def profile_stages(notes_filename, keyword_index, prefilter, filter=0.0, n=0, verbose=False, gold_data_filename=None, frames=1, MRNs=None):
+    '''
+    This method takes as input a path to a notes file, a KeywordIndex and a KeywordPrefilter built from the same keywords, a minimum score, a minimum number of dates, a boolean specifying whether snippets are kept in the output lines, an optional path to a gold data file, the number of stack frames recorded per allocation, and an optional set of MRNs (only the notes and gold dates of those patients are read; all of them if None). It runs the stages described at the top of this module with memory allocations traced, and returns a 2-tuple of the MemoryProfile of the run and the number of notes.
+    NB: The keywords are compiled before tracing starts, so that the stages are not charged for the regexes.
+    '''
+    tracemalloc.start(frames)
+    profile = MemoryProfile()
+
+    notes_file = open(notes_filename, encoding='utf-8', errors='replace')
+    notes_dict = get_notes_dict(notes_file if MRNs is None else [line for line in notes_file if line.split('\t', 1)[0] in MRNs])
+    notes_file.close()
+    sorted_MRNs = sorted(notes_dict)
+    notes = sum([len(notes_dict[MRN]) for MRN in sorted_MRNs])
+    profile.end_stage('load notes', [notes_dict])
+
+    candidates_dict = {}
+    for MRN in sorted_MRNs:
+        candidates_dict[MRN] = get_date_candidates(notes_dict[MRN], keyword_index, prefilter)
+    profile.end_stage('extract', [notes_dict, candidates_dict])
+
+    for MRN in sorted_MRNs:
+        rerank_candidates(candidates_dict[MRN], filter, n)
+    profile.end_stage('rerank', [notes_dict, candidates_dict])
+
+    output_lines = [format_output_line(MRN, candidates_dict[MRN], verbose) for MRN in sorted_MRNs]
+    profile.end_stage('output', [notes_dict, candidates_dict, output_lines])
+
+    if gold_data_filename:
+        # Evaluation reads the non-verbose output, as eval_output.py does
+        output_dict = get_output_dict(output_lines if not verbose else [format_output_line(MRN, candidates_dict[MRN]) for MRN in sorted_MRNs])
+        gold_data_file = open(gold_data_filename)
+        gold_data_dict = get_data_dict(gold_data_file if MRNs is None else [line for line in gold_data_file if line.split('\t', 1)[0] in MRNs])
+        gold_data_file.close()
+        matrix = get_match_matrix(gold_data_dict, output_dict)
+        profile.end_stage('eval', [notes_dict, candidates_dict, output_lines, matrix])
+    tracemalloc.stop()
+
+    return (profile, notes)
+
+
+def get_MRNs(notes_filename):
+    '''
+    This method takes as input a path to a notes file and returns the sorted list of the MRNs in it.
+    '''
+    notes_file = open(notes_filename, encoding='utf-8', errors='replace')
+    MRNs = sorted(set([line.split('\t', 1)[0] for line in notes_file]))
+    notes_file.close()
+    return MRNs
+
+
+def get_growth_per_note(smaller, larger):
+    '''
+    This method takes as input two (MemoryProfile, number of notes) 2-tuples, as returned by profile_stages() for a smaller and a larger set of patients, and returns the growth of the peak traced memory per note between them: the difference between the peaks divided by the difference between the numbers of notes. Memory that does not grow with the notes, such as the report's own bookkeeping, cancels out; costs that are only paid once per process (such as compiling regexes on first use) must have been paid before both runs.
+    '''
+    (smaller_profile, smaller_notes), (larger_profile, larger_notes) = smaller, larger
+    if larger_notes <= smaller_notes:
+        raise ValueError("The larger run must have more notes than the smaller one")
+    return float(larger_profile.peak - smaller_profile.peak)/(larger_notes - smaller_notes)
+
+
+class MemoryProfile(object):
+    '''
+    A MemoryProfile records the memory use at the end of each stage of a traced run. It has attributes 'stages' (a list of (name, traced bytes, peak traced bytes, max RSS bytes or None, object counts, top allocation sites) 6-tuples, in order; see count_objects() and get_top_sites()), 'peak' (the peak traced bytes over all the stages), and 'snapshot' (the tracemalloc snapshot taken at the end of the last stage, or at the start).
+    NB: tracemalloc must be started before the MemoryProfile is created.
+    '''
+    def __init__(self):
+        self.stages = []
+        self.peak = 0
+        self.snapshot = tracemalloc.take_snapshot()
+        reset_peak()
+
+    def __repr__(self):
+        return "memory profile of %s stages (peak traced: %s bytes)" % (len(self.stages), self.peak)
+
+    def end_stage(self, name, roots):
+        '''
+        This method takes as input the name of the stage that just ended and a list of the objects holding the results of the stages so far, and records the stage's memory use.
+        '''
+        traced, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        self.stages.append((name, traced, peak, get_max_rss(), count_objects(roots), get_top_sites(snapshot, self.snapshot)))
+        self.peak = max(self.peak, peak)
+        self.snapshot = snapshot
+        # Counting objects allocates memory, which should not be charged to the next stage
+        reset_peak()
+
+
+def reset_peak():
+    '''
+    This method resets the peak traced memory to the memory traced now, so that the next peak is the stage's own. Before python 3.9, tracemalloc cannot do this, and peaks are since the start of tracing.
+    '''
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+
+
+def get_max_rss():
+    '''
+    This method returns the peak resident memory of the process so far, in bytes, or None if the operating system does not report it.
+    '''
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    return max_rss if sys.platform == 'darwin' else max_rss*1024
+
+
+def count_objects(roots):
+    '''
+    This method takes as input a list of objects and returns a hash of the names of the classes in COUNTED_CLASSES mapped to the number of distinct objects of that class reachable from them ('snippets' being the total length of the snippet lists of the DateCandidate objects). References are followed through containers and instance attributes, but not into classes, modules, or functions, so that the objects of the interpreter itself are not counted.
+    '''
+    counts = dict([(name, 0) for name in COUNTED_CLASSES])
+    seen = set()
+    stack = list(roots)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, (type, ModuleType, FunctionType, BuiltinFunctionType)):
+            continue
+        seen.add(id(obj))
+        name = type(obj).__name__
+        if name in counts:
+            counts[name] += 1
+        if name == 'DateCandidate':
+            counts['snippets'] += len(obj.snippets)
+        stack.extend(gc.get_referents(obj))
+    return counts
+
+
+def get_top_sites(snapshot, previous, top=None):
+    '''
+    This method takes as input a tracemalloc snapshot and an earlier one, and returns a list of (traceback, size difference, count difference) 3-tuples for the source lines (or, with more than one frame traced, the call stacks) whose allocations grew the most between them (other than those of tracemalloc itself), in descending order by growth (only the first 'top', if given).
+    '''
+    # The snapshots themselves are left out
+    ignored = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    sites = [(stat.traceback, stat.size_diff, stat.count_diff) for stat in snapshot.filter_traces(ignored).compare_to(previous.filter_traces(ignored), 'traceback') if stat.size_diff > 0]
+    return sites[:top] if top is not None else sites
+
+
+def print_memory_profile(profile, notes, top=10):
+    '''
+    This method takes as input a MemoryProfile, the number of notes in the run, and the number of allocation sites to print per stage, and prints the report described at the top of this module to standard out.
+    '''
+    print('\t'.join(['stage', 'traced MB', 'peak traced MB', 'max RSS MB', 'bytes/note']))
+    for name, traced, peak, max_rss, counts, sites in profile.stages:
+        print('%s\t%.2f\t%.2f\t%s\t%.0f' % (name, traced/1e6, peak/1e6, '%.2f' % (max_rss/1e6) if max_rss is not None else 'unavailable', float(traced)/notes if notes else 0.0))
+    print("Peak traced memory: %.0f bytes per note (%s notes)" % (float(profile.peak)/notes if notes else 0.0, notes))
+
+    for name, traced, peak, max_rss, counts, sites in profile.stages:
+        print()
+        print("After %s: %s" % (name, ', '.join(['%s %s' % (class_name, counts[class_name]) for class_name in COUNTED_CLASSES])))
+        print("Top allocation sites during %s:" % name)
+        for traceback, size, count in sites[:top]:
+            print('%s\t+%.1f KB\t+%s blocks' % (' < '.join(['%s:%s' % (frame.filename, frame.lineno) for frame in reversed(traceback)]), size/1e3, count))
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+'''
+This script builds and queries a persistent index of every date mention in a notes file, so that questions about which dates appear in the notes at all (e.g. the recall ceiling of extraction against gold data) are answered by index lookups instead of by extracting every date from every note again.
+
+It is run with one of three commands:
+1) build: takes as input a path to a notes file (in the format read by extract_events.py) and a path to the index file to write. Every date expression in every note, absolute or relative, is found as in naive_extract_events() (see extract_events.get_date_mentions()) and written to the index file, one line per mention, in the format:
+date [tab] MRN [tab] note [tab] start [tab] end
+...where the date is packed as in a match matrix (see eval_output.pack_date()), note is the 0-based position of the note among the patient's notes in the notes file, and start and end are the character span of the date expression in the note text. The first line of the index file records the notes file it was built from.
+2) lookup: takes as input a path to an index file and one or more date expressions, and prints to standard out the mentions of each date (MRN [tab] note [tab] start [tab] end [tab] date), or with --fuzzy, of every date that is a fuzzy match for it.
+3) coverage: takes as input a path to an index file and a path to a gold data file (in the format read by eval_output.py), and prints to standard out the fraction of gold dates that are mentioned (strictly, or with a fuzzy match) in the patient's notes: the recall ceiling of any extraction from these notes. With --verbose, the gold dates that are not mentioned are also listed, one patient per line.
+'''
+
+import argparse
+import logging
+import os
+from sys import stderr
+from date import DateIntervalIndex, make_date
+from eval_output import get_data_dict, pack_date, unpack_date
+from extract_events import get_date_mentions, get_notes_dict
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.WARNING)
+
+
+def main():
+    logging.basicConfig()
+
+    parser = argparse.ArgumentParser(description='Build and query an index of the date mentions in a notes file.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='index every date mention in a notes file')
+    build_parser.add_argument('notes_filename', help='notes file')
+    build_parser.add_argument('index_filename', help='index file to write')
+    lookup_parser = subparsers.add_parser('lookup', help='print the mentions of dates')
+    lookup_parser.add_argument('index_filename', help='index file')
+    lookup_parser.add_argument('dates', nargs='+', help='date expressions, e.g. 2008-05-03 or 05/2008')
+    lookup_parser.add_argument('--fuzzy', action='store_true', help='also print the mentions of dates that are fuzzy matches')
+    coverage_parser = subparsers.add_parser('coverage', help='print the fraction of gold dates mentioned in the notes')
+    coverage_parser.add_argument('index_filename', help='index file')
+    coverage_parser.add_argument('gold_data_filename', help='gold data file')
+    coverage_parser.add_argument('--verbose', action='store_true', help='list the gold dates that are not mentioned')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        notes_file = open(args.notes_filename, encoding='utf-8', errors='replace')
+        notes_dict = get_notes_dict(notes_file)
+        notes_file.close()
+
+        index = DateMentionIndex(get_notes_source(args.notes_filename))
+        for MRN in sorted(notes_dict):
+            index.add_patient(MRN, notes_dict[MRN])
+        index_file = open(args.index_filename, 'w')
+        write_mention_index(index_file, index)
+        index_file.close()
+        stderr.write("Indexed %s date mentions of %s distinct dates in %s notes of %s patients\n" % (index.count, len(index.mentions), sum([len(notes) for notes in notes_dict.values()]), len(notes_dict)))
+        return
+
+    index_file = open(args.index_filename)
+    index = get_mention_index_from_file(index_file)
+    index_file.close()
+    index.check_source()
+
+    if args.command == 'lookup':
+        for string in args.dates:
+            dates = make_date(string)
+            if not dates:
+                LOG.warning("Could not make date: %s" % string)
+                continue
+            for date in dates:
+                for mention_date, mention in index.lookup(date, args.fuzzy):
+                    print('\t'.join([mention[0], str(mention[1]), str(mention[2]), str(mention[3]), str(mention_date)]))
+
+    else:
+        gold_data_file = open(args.gold_data_filename)
+        gold_data_dict = get_data_dict(gold_data_file)
+        gold_data_file.close()
+
+        strict, lenient, total, missing = index.get_coverage(gold_data_dict)
+        print("Gold dates: %s" % total)
+        print("Strict recall ceiling: %s" % (float(strict)/total if total else 0))
+        print("Lenient recall ceiling: %s" % (float(lenient)/total if total else 0))
+        if args.verbose:
+            for MRN in sorted(missing):
+                print(MRN + '\t' + str([str(date) for date in missing[MRN]]))
+
+
+class DateMentionIndex(object):
+    '''
+    A DateMentionIndex maps every date mentioned in a set of patients' notes to where it is mentioned. It has attributes 'source' (a list of (name, value) 2-tuples identifying the notes file the index was built from; see get_notes_source()), 'mentions' (a hash of Date objects mapped to lists of (MRN, note, start_index, end_index) 4-tuples), 'patients' (a hash of MRNs mapped to sets of the Date objects mentioned in the patient's notes), 'years' (a hash of years mapped to sets of the Date objects in 'mentions' in that year, used to look up fuzzy matches), and 'count' (the number of mentions).
+    NB: Dates without a datetime (which cannot be compared by year) are not indexed.
+    '''
+    def __init__(self, source=None):
+        self.source = source or []
+        self.mentions = {}
+        self.patients = {}
+        self.years = {}
+        self.count = 0
+
+    def __repr__(self):
+        return "%s date mentions of %s distinct dates for %s patients" % (self.count, len(self.mentions), len(self.patients))
+
+    def add_mention(self, date, MRN, note, start, end):
+        '''
+        This method takes as input a Date object, an MRN, the position of the note among the patient's notes, and the start and end indices of the date expression in the note text, and adds the mention to the index.
+        '''
+        if date is None or date.dt is None:
+            return
+        if date not in self.mentions:
+            self.mentions[date] = []
+            self.years.setdefault(date.dt.year, set()).add(date)
+        self.mentions[date].append((MRN, note, start, end))
+        self.patients.setdefault(MRN, set()).add(date)
+        self.count += 1
+
+    def add_patient(self, MRN, notes):
+        '''
+        This method takes as input an MRN and the list of ClinicNote objects for the patient, and adds every date mentioned in the notes to the index (see extract_events.get_date_mentions()).
+        '''
+        self.patients.setdefault(MRN, set())
+        for i, note_mentions in enumerate(get_date_mentions(notes)):
+            for date, start, end in note_mentions:
+                self.add_mention(date, MRN, i, start, end)
+
+    def lookup(self, date, fuzzy=False):
+        '''
+        This method takes as input a Date object and an optional boolean, and returns a list of (Date, (MRN, note, start_index, end_index)) 2-tuples for the mentions of the date, or, if fuzzy is True, of every date that is a fuzzy match for it (see Date.is_fuzzy_match()), ordered by MRN, note, and position.
+        '''
+        if fuzzy and date is not None and date.dt is not None:
+            dates = [other for other in self.years.get(date.dt.year, []) if date.is_fuzzy_match(other)]
+        else:
+            dates = [date] if date in self.mentions else []
+        return sorted([(other, mention) for other in dates for mention in self.mentions[other]], key=lambda x: x[1])
+
+    def get_coverage(self, gold_data):
+        '''
+        This method takes as input a hash of MRNs mapped to lists of gold Date objects, and returns a 4-tuple of the number of gold dates that are mentioned in the patient's notes, the number that are mentioned or have a fuzzy match that is (see Date.is_fuzzy_match()), the number of gold dates, and a hash of MRNs mapped to the lists of gold dates with neither (only for patients that have any).
+        '''
+        strict = 0
+        lenient = 0
+        total = 0
+        missing = {}
+
+        for MRN, gold_dates in gold_data.items():
+            mentioned = self.patients.get(MRN, set())
+            dates = list(mentioned)
+            index = DateIntervalIndex(dates)
+            for e in gold_dates:
+                total += 1
+                if e in mentioned:
+                    strict += 1
+                    lenient += 1
+                elif e is not None and e.dt is not None and [k for k in index.get_overlapping(e.get_interval()) if e.is_fuzzy_match(dates[k])]:
+                    lenient += 1
+                else:
+                    missing.setdefault(MRN, []).append(e)
+
+        return (strict, lenient, total, missing)
+
+    def check_source(self):
+        '''
+        This method warns if the notes file the index was built from has changed (or no longer exists) since the index was built.
+        '''
+        source = dict(self.source)
+        if 'notes' in source and os.path.exists(source['notes']) and get_notes_source(source['notes']) != self.source:
+            LOG.warning("Notes file %s has changed since the index was built" % source['notes'])
+
+
+
+def get_notes_source(notes_filename):
+    '''
+    This method takes as input a path to a notes file and returns a list of (name, value) 2-tuples identifying it (its absolute path, size, and modification time).
+    '''
+    notes_stat = os.stat(notes_filename)
+    return [('notes', os.path.abspath(notes_filename)), ('notes_size', str(notes_stat.st_size)), ('notes_mtime', str(notes_stat.st_mtime_ns))]
+
+
+def write_mention_index(file, index):
+    '''
+    This method takes as input an open file object and a DateMentionIndex, and writes the index to the file: a first line with the source of the index (# [tab] name=value ...), followed by one line per mention (see the format at the top of this module), ordered by date, MRN, note, and position.
+    '''
+    file.write('\t'.join(['#'] + ['%s=%s' % item for item in index.source]) + '\n')
+    for date in sorted(index.mentions, key=lambda date: (date.dt, date.month_known, date.day_known)):
+        packed_date = pack_date(date)
+        for MRN, note, start, end in sorted(index.mentions[date]):
+            file.write('%s\t%s\t%d\t%d\t%d\n' % (packed_date, MRN, note, start, end))
+
+
+def get_mention_index_from_file(file):
+    '''
+    This method takes as input an open file object containing an index written by write_mention_index() and returns the DateMentionIndex.
+    '''
+    index = DateMentionIndex()
+    # Packed dates repeat for every mention, so each is only unpacked once
+    dates = {}
+
+    for line in file:
+        line_elements = line.rstrip('\n').split('\t')
+        if line_elements[0] == '#':
+            index.source = [tuple(item.split('=', 1)) for item in line_elements[1:]]
+            continue
+        if len(line_elements) != 5:
+            LOG.warning("Bad mention index line format; skipping: %s" % line)
+            continue
+
+        packed_date, MRN, note, start, end = line_elements
+        date = dates.get(packed_date)
+        if date is None:
+            date = dates[packed_date] = unpack_date(packed_date)
+        index.add_mention(date, MRN, int(note), int(start), int(end))
+
+    return index
+
+
+if __name__=='__main__':
+    main()
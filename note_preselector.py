@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+'''
+This script preselects, for a single candidate keyword, the notes that extract_events.get_date_candidates() has to search, so that the keyword can be tried out without running extraction over every note. It does so with a positional index of the lowercased word tokens in a notes file: only the notes in which the keyword can match are read back and searched. It has no index of the dates in the notes: the selected notes are searched as extraction would search them, so a query takes time in proportion to the number of notes in which the keyword's tokens occur (and, for a keyword that is a single word, which can match inside longer tokens, to the number of distinct tokens in the index, which are scanned for those that contain it), and a keyword made of common words is little faster than a full run.
+
+It is run with one of two commands:
+1) build: takes as input a path to a notes file (in the format read by extract_events.py) and a path to the index file to write.
+2) query: takes as input a path to an index file and a keyword in the format of a line of the keywords file (keyword, PRE-DATE or POST-DATE, and optionally a window size and a weight; see extract_events.py), and prints to standard out one line per date found near the keyword, in the format:
+MRN [tab] date [tab] weight [tab] snippet
+...for exactly the DateCandidate objects that extract_events.get_date_candidates() returns for the keyword alone, patient by patient (in MRN order). The number of notes read and the time taken are written to standard error.
+
+The index file holds the notes file's identity (see mention_index.get_notes_source()), the position and length in the notes file and the creation date and description of every note, and, for every token, the positions at which it occurs in each note (its posting list). A keyword's tokens select the notes in which they occur at consecutive positions, and only those notes are read back from the notes file (which must not have changed since the index was built) and searched with the keyword regex itself, so the result does not depend on how the text is tokenized.
+'''
+
+import argparse
+import logging
+import re
+import time
+from bisect import bisect_left
+from sys import stderr
+from extract_events import ClinicNote, Keyword, KeywordIndex, get_date_candidates
+from mention_index import get_notes_source
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.WARNING)
+
+# Tokens are maximal runs of word characters in the lowercased note text
+token_regex = re.compile(r'\w+')
+
+
+def main():
+    logging.basicConfig()
+
+    parser = argparse.ArgumentParser(description='Preselect the notes that get_date_candidates() searches for a keyword, with a positional token index of a notes file.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='index the tokens of a notes file')
+    build_parser.add_argument('notes_filename', help='notes file')
+    build_parser.add_argument('index_filename', help='index file to write')
+    query_parser = subparsers.add_parser('query', help='print the dates found near a keyword, searching only the notes in which it can match')
+    query_parser.add_argument('index_filename', help='index file')
+    query_parser.add_argument('keyword', help='keyword text')
+    query_parser.add_argument('position', choices=['PRE-DATE', 'POST-DATE'], help='whether the date is looked for after (PRE-DATE) or before (POST-DATE) the keyword')
+    query_parser.add_argument('window', nargs='?', type=int, default=100, help='window size (default: 100)')
+    query_parser.add_argument('weight', nargs='?', type=float, default=1.0, help='keyword weight (default: 1.0)')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        index = build_token_index(args.notes_filename)
+        index_file = open(args.index_filename, 'w', encoding='utf-8')
+        write_token_index(index_file, index)
+        index_file.close()
+        stderr.write("Indexed %s distinct tokens in %s notes of %s patients\n" % (len(index.postings), len(index.notes), len(index.patients)))
+        return
+
+    index_file = open(args.index_filename, encoding='utf-8')
+    index = get_token_index_from_file(index_file)
+    index_file.close()
+    if get_notes_source(index.notes_filename) != index.source:
+        LOG.warning("Notes file %s has changed since the index was built; results may be wrong" % index.notes_filename)
+
+    start = time.perf_counter()
+    keyword = Keyword(args.keyword, args.position, args.window, args.weight)
+    candidates_dict, notes_read = index.get_date_candidates(keyword)
+    for MRN in sorted(candidates_dict):
+        for candidate in candidates_dict[MRN]:
+            print('\t'.join([MRN, candidate.date.make_date_expression(), str(candidate.weight), candidate.snippets[0]]))
+    stderr.write("Read %s of %s notes; %s dates found in %.1f ms\n" % (notes_read, len(index.notes), sum([len(candidates) for candidates in candidates_dict.values()]), 1000*(time.perf_counter()-start)))
+
+
+class TokenIndex(object):
+    '''
+    A TokenIndex is a positional index of the lowercased word tokens of the notes in a notes file. It has attributes 'source' (a list of (name, value) 2-tuples identifying the notes file; see mention_index.get_notes_source()), 'notes_filename' (the path of the notes file), 'notes' (a list of (MRN, date, description, offset, length) 5-tuples, one per note in file order, where offset and length locate the note's line in the notes file in bytes), 'patients' (a hash of MRNs mapped to the lists of the indices of their notes, in file order), 'postings' (a hash of tokens mapped to their posting lists, each either a hash of note indices mapped to lists of token positions, or the same in the packed form of the index file, unpacked on first use; see get_postings()), and 'vocabulary' and 'reversed_vocabulary' (sorted lists of the tokens and of the tokens spelled backwards, built on first use, to look up tokens by prefix and suffix).
+    NB: Notes are read back from the notes file as bytes and decoded line by line, so a note containing a bare carriage return (which get_notes_dict() would split into several lines) is not read back the same way.
+    '''
+    def __init__(self, source=None):
+        self.source = source or []
+        self.notes_filename = dict(self.source).get('notes')
+        self.notes = []
+        self.patients = {}
+        self.postings = {}
+        self.vocabulary = None
+        self.reversed_vocabulary = None
+
+    def __repr__(self):
+        return "token index of %s: %s notes, %s patients, %s distinct tokens" % (self.notes_filename, len(self.notes), len(self.patients), len(self.postings))
+
+    def add_note(self, MRN, date, desc, offset, length, text):
+        '''
+        This method takes as input the MRN, creation date, and description of a note, the position and length of its line in the notes file (in bytes), and its text, and adds the note and the positions of its tokens to the index.
+        '''
+        i = len(self.notes)
+        self.notes.append((MRN, date, desc, offset, length))
+        self.patients.setdefault(MRN, []).append(i)
+        for position, token in enumerate(token_regex.findall(text.lower())):
+            self.postings.setdefault(token, {}).setdefault(i, []).append(position)
+
+    def get_postings(self, token):
+        '''
+        This method takes as input a token and returns its posting list: a hash of note indices mapped to lists of the positions of the token in the note.
+        '''
+        postings = self.postings[token]
+        if isinstance(postings, str):
+            postings = self.postings[token] = unpack_postings(postings)
+        return postings
+
+    def get_tokens(self, token, prefix, suffix):
+        '''
+        This method takes as input a keyword token and two booleans, and returns the list of tokens in the index that start with it (if prefix is True), end with it (if suffix is True), are equal to it (if both are True), or contain it (if neither is).
+        NB: The tokens that contain the keyword token are found by scanning the whole vocabulary.
+        '''
+        if prefix and suffix:
+            return [token] if token in self.postings else []
+
+        if self.vocabulary is None:
+            self.vocabulary = sorted(self.postings)
+            self.reversed_vocabulary = sorted([other[::-1] for other in self.postings])
+        if prefix:
+            return get_prefixed(self.vocabulary, token)
+        elif suffix:
+            return [other[::-1] for other in get_prefixed(self.reversed_vocabulary, token[::-1])]
+        else:
+            return [other for other in self.vocabulary if token in other]
+
+    def get_keyword_notes(self, text):
+        '''
+        This method takes as input the text of a keyword and returns the sorted list of the indices of the notes in which it can match, or None if the keyword has no word characters (in which case it can match in any note).
+        A match of the keyword covers consecutive tokens of the note: those between its first and last tokens are equal to the corresponding tokens of the keyword, while the first (last) token of the note only has to end (start) with the keyword's token if the keyword starts (ends) with a word character.
+        '''
+        text = text.lower()
+        tokens = token_regex.findall(text)
+        if not tokens:
+            return None
+
+        # For each token of the keyword, a hash of note indices mapped to the sets of positions at which a token that can match it occurs
+        positions = []
+        for j, token in enumerate(tokens):
+            prefix = j > 0 or not re.match(r'\w', text)
+            suffix = j < len(tokens)-1 or not re.search(r'\w$', text)
+            token_positions = {}
+            for other in self.get_tokens(token, prefix, suffix):
+                for i, note_positions in self.get_postings(other).items():
+                    token_positions.setdefault(i, set()).update(note_positions)
+            positions.append(token_positions)
+
+        notes = set(positions[0])
+        for token_positions in positions[1:]:
+            notes &= set(token_positions)
+        return sorted([i for i in notes if any([all([position+j in positions[j][i] for j in range(1, len(tokens))]) for position in positions[0][i]])])
+
+    def get_date_candidates(self, keyword):
+        '''
+        This method takes as input a Keyword object and returns a 2-tuple of a hash of MRNs mapped to the lists of DateCandidate objects that extract_events.get_date_candidates() returns for the patient's notes and the keyword alone (only for patients for whom the list is not empty), and the number of notes read from the notes file.
+        Only the notes in which the keyword can match (see get_keyword_notes()) are read; the patient's other notes are passed to get_date_candidates() without their text, which only serve to resolve the anchor dates of the notes.
+        '''
+        keyword_index = KeywordIndex([keyword])
+        keyword_notes = self.get_keyword_notes(keyword.text)
+        if keyword_notes is None:
+            keyword_notes = range(len(self.notes))
+        texts = read_note_texts(self.notes_filename, [self.notes[i] for i in keyword_notes])
+        texts = dict(zip(keyword_notes, texts))
+
+        candidates_dict = {}
+        for MRN in sorted(set([self.notes[i][0] for i in keyword_notes])):
+            notes = [ClinicNote(self.notes[i][1], self.notes[i][2], texts.get(i, '')) for i in self.patients[MRN]]
+            candidates = get_date_candidates(notes, keyword_index)
+            if candidates:
+                candidates_dict[MRN] = candidates
+        return (candidates_dict, len(texts))
+
+
+
+def get_prefixed(sorted_tokens, prefix):
+    '''
+    This method takes as input a sorted list of tokens and a string, and returns the tokens in the list that start with the string.
+    '''
+    tokens = []
+    for i in range(bisect_left(sorted_tokens, prefix), len(sorted_tokens)):
+        if not sorted_tokens[i].startswith(prefix):
+            break
+        tokens.append(sorted_tokens[i])
+    return tokens
+
+
+def build_token_index(notes_filename):
+    '''
+    This method takes as input a path to a notes file and returns a TokenIndex of its notes. Lines that get_notes_dict() would skip are skipped (and reported) in the same way.
+    '''
+    index = TokenIndex(get_notes_source(notes_filename))
+    notes_file = open(notes_filename, 'rb')
+    offset = 0
+    for data in notes_file:
+        line_elements = data.decode('utf-8', errors='replace').strip().split('\t')
+        if len(line_elements) not in [3, 4]:
+            LOG.warning("Bad notes file line format; skipping: %s" % data)
+        else:
+            index.add_note(line_elements[0], line_elements[1], line_elements[2], offset, len(data), line_elements[3] if len(line_elements) == 4 else '')
+        offset += len(data)
+    notes_file.close()
+    return index
+
+
+def read_note_texts(notes_filename, notes):
+    '''
+    This method takes as input a path to a notes file and a list of (MRN, date, description, offset, length) 5-tuples (see TokenIndex), and returns the list of the texts of the notes, read from the notes file.
+    '''
+    texts = []
+    notes_file = open(notes_filename, 'rb')
+    for MRN, date, desc, offset, length in notes:
+        notes_file.seek(offset)
+        line_elements = notes_file.read(length).decode('utf-8', errors='replace').strip().split('\t')
+        texts.append(line_elements[3] if len(line_elements) == 4 else '')
+    notes_file.close()
+    return texts
+
+
+def pack_postings(postings):
+    '''
+    This method takes as input a posting list (a hash of note indices mapped to lists of positions) and returns it as a string: note:position,position ... separated by spaces, in ascending order of note index.
+    '''
+    return ' '.join(['%d:%s' % (i, ','.join([str(position) for position in postings[i]])) for i in sorted(postings)])
+
+
+def unpack_postings(string):
+    '''
+    This method takes as input a posting list packed by pack_postings() and returns it as a hash of note indices mapped to lists of positions.
+    '''
+    postings = {}
+    for entry in string.split(' '):
+        i, positions = entry.split(':')
+        postings[int(i)] = [int(position) for position in positions.split(',')]
+    return postings
+
+
+def write_token_index(file, index):
+    '''
+    This method takes as input an open file object and a TokenIndex, and writes the index to the file: a first line with the source of the index (# [tab] name=value ...), then one line per note (N [tab] MRN [tab] date [tab] description [tab] offset [tab] length), then one line per token, in sorted order (T [tab] token [tab] packed posting list; see pack_postings()).
+    '''
+    file.write('\t'.join(['#'] + ['%s=%s' % item for item in index.source]) + '\n')
+    for MRN, date, desc, offset, length in index.notes:
+        file.write('N\t%s\t%s\t%s\t%d\t%d\n' % (MRN, date, desc, offset, length))
+    for token in sorted(index.postings):
+        postings = index.postings[token]
+        file.write('T\t%s\t%s\n' % (token, postings if isinstance(postings, str) else pack_postings(postings)))
+
+
+def get_token_index_from_file(file):
+    '''
+    This method takes as input an open file object containing an index written by write_token_index() and returns the TokenIndex. Posting lists are kept packed until they are first used.
+    '''
+    index = None
+    for line in file:
+        line_elements = line.rstrip('\n').split('\t')
+        if line_elements[0] == '#':
+            index = TokenIndex([tuple(item.split('=', 1)) for item in line_elements[1:]])
+        elif index is None:
+            LOG.warning("Token index file has no header line")
+            index = TokenIndex()
+        if line_elements[0] == 'T' and len(line_elements) == 3:
+            index.postings[line_elements[1]] = line_elements[2]
+        elif line_elements[0] == 'N' and len(line_elements) == 6:
+            index.patients.setdefault(line_elements[1], []).append(len(index.notes))
+            index.notes.append((line_elements[1], line_elements[2], line_elements[3], int(line_elements[4]), int(line_elements[5])))
+        elif line_elements[0] != '#':
+            LOG.warning("Bad token index line format; skipping: %s" % line)
+    return index
+
+
+if __name__=='__main__':
+    main()
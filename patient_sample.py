@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+'''
+This module draws deterministic, stratified samples of patients, so that extract_events.py and eval_output.py can be run on a small fraction of the corpus during keyword development and give the same sample for the same options.
+
+Patients are grouped into strata by note volume (the number of notes, in powers of two: 1, 2-3, 4-7, ...) and by whether they have gold dates, when those are known. Within each stratum, patients are ordered by a hash of the seed and their MRN (see get_sample_key()), and the first ceil(fraction * stratum size) are taken, so that a sample includes every smaller sample drawn with the same seed. Each sampled patient stands for (stratum size / sampled patients in the stratum) patients of the corpus in estimates (see PatientSample.weights), and get_bootstrap_intervals() gives error bars for such estimates with a rescaling bootstrap within each stratum, corrected for the fraction of the stratum sampled.
+'''
+
+import hashlib
+import logging
+import math
+import random
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.WARNING)
+
+
+class PatientSample(object):
+    '''
+    A PatientSample is a stratified sample of a set of patients. It has attributes 'fraction' and 'seed' (those it was drawn with), 'strata' (a hash of strata, as returned by get_stratum(), mapped to the lists of the MRNs in them, in sample order), 'sampled' (a hash of the same strata mapped to the lists of the MRNs sampled from them), 'MRNs' (the set of sampled MRNs), and 'weights' (a hash of the sampled MRNs mapped to the number of patients each stands for).
+    '''
+    def __init__(self, MRNs, fraction, seed=0, note_counts=None, gold_MRNs=None):
+        if not 0 < fraction <= 1:
+            raise ValueError("Sample fraction must be greater than 0 and at most 1 (input: %s)" % fraction)
+        self.fraction = fraction
+        self.seed = seed
+        self.strata = {}
+        for MRN in MRNs:
+            self.strata.setdefault(get_stratum(MRN, note_counts, gold_MRNs), []).append(MRN)
+
+        self.sampled = {}
+        self.MRNs = set()
+        self.weights = {}
+        for stratum, stratum_MRNs in self.strata.items():
+            stratum_MRNs.sort(key=lambda MRN: get_sample_key(MRN, seed))
+            sampled = stratum_MRNs[:int(math.ceil(fraction * len(stratum_MRNs)))]
+            self.sampled[stratum] = sampled
+            self.MRNs.update(sampled)
+            for MRN in sampled:
+                self.weights[MRN] = float(len(stratum_MRNs)) / len(sampled)
+
+    def __repr__(self):
+        return "%s of %s patients in %s strata (fraction %s, seed %s)" % (len(self.MRNs), sum([len(stratum_MRNs) for stratum_MRNs in self.strata.values()]), len(self.strata), self.fraction, self.seed)
+
+    def __contains__(self, MRN):
+        return MRN in self.MRNs
+
+    def get_stratum_sizes(self):
+        '''
+        This method returns a hash of the sample's strata mapped to (sampled patients, patients) 2-tuples, for get_bootstrap_intervals().
+        '''
+        return dict([(stratum, (len(self.sampled[stratum]), len(self.strata[stratum]))) for stratum in self.strata])
+
+
+def get_stratum(MRN, note_counts=None, gold_MRNs=None):
+    '''
+    This method takes as input an MRN, an optional hash of MRNs mapped to their numbers of notes, and an optional set of the MRNs with gold dates, and returns the patient's stratum: a 2-tuple of the bit length of the number of notes (so that 1, 2-3, 4-7, ... notes fall in different strata) and a boolean specifying whether the patient has gold dates, either of which is None if it is not known.
+    '''
+    volume = note_counts.get(MRN, 0).bit_length() if note_counts is not None else None
+    has_gold = MRN in gold_MRNs if gold_MRNs is not None else None
+    return (volume, has_gold)
+
+
+def get_sample_key(MRN, seed=0):
+    '''
+    This method takes as input an MRN and a seed, and returns the hex digest that orders the patient within its stratum. It depends on nothing else, so samples are the same from run to run and machine to machine.
+    '''
+    return hashlib.sha1(('%s\t%s' % (seed, MRN)).encode('utf-8')).hexdigest()
+
+
+def count_notes(file):
+    '''
+    This method takes as input an open notes file (in the format read by extract_events.py) and returns a hash of MRNs mapped to their numbers of notes, counting the same lines as extract_events.get_notes_dict() reads, without splitting the note texts.
+    '''
+    note_counts = {}
+    for line in file:
+        line_elements = line.strip().split('\t', 4)
+        if len(line_elements) in [3, 4]:
+            note_counts[line_elements[0]] = note_counts.get(line_elements[0], 0) + 1
+    return note_counts
+
+
+def get_gold_MRNs(file):
+    '''
+    This method takes as input an open gold data file (in the format read by eval_output.py) and returns the set of the MRNs of its lines that list at least one date, without interpreting the dates.
+    '''
+    gold_MRNs = set()
+    for line in file:
+        tokens = line.strip().split('\t')
+        if len(tokens) >= 2:
+            gold_MRNs.add(tokens[0])
+    return gold_MRNs
+
+
+def get_bootstrap_intervals(sizes, statistics, replicates=200, seed=0, confidence=0.95):
+    '''
+    This method takes as input a hash of strata mapped to (sampled patients, patients) 2-tuples (see PatientSample.get_stratum_sizes()), a function taking a hash of the same strata mapped to lists of weight factors (one per sampled patient of the stratum, in sample order) and returning a list of floats computed with each patient's weight multiplied by its factor (e.g. a set of metrics), a number of bootstrap replicates, a seed, and a confidence level, and returns a list of the (lower bound, upper bound) 2-tuples of the percentile bootstrap intervals of the statistics, in order.
+    The factors of each replicate are those of the rescaling bootstrap of Rao and Wu: from a stratum of n sampled patients out of N, n-1 patients are drawn with replacement, and a patient drawn r times gets the factor 1 - l + l*r*n/(n-1), where l = sqrt(1 - n/N) is the finite population correction, so that a stratum sampled in full adds no variance. A stratum with fewer than 2 sampled patients has no variance of its own to resample, so it is collapsed with a neighbouring stratum first (see get_bootstrap_groups()).
+    '''
+    groups = get_bootstrap_groups(sizes)
+    if sum([sizes[stratum][0] for stratum in sizes]) < 2:
+        LOG.warning("Fewer than 2 patients sampled; bootstrap intervals cannot be estimated")
+    generator = random.Random(seed)
+    values = []
+    for i in range(replicates):
+        factors = dict([(stratum, [1.0] * sizes[stratum][0]) for stratum in sizes])
+        for group in groups:
+            units = [(stratum, j) for stratum in group for j in range(sizes[stratum][0])]
+            population = sum([sizes[stratum][1] for stratum in group])
+            if len(units) < 2:
+                continue
+            scale = math.sqrt(max(0.0, 1.0 - float(len(units))/population))
+            draws = {}
+            for k in range(len(units)-1):
+                unit = units[generator.randrange(len(units))]
+                draws[unit] = draws.get(unit, 0) + 1
+            for stratum, j in units:
+                factors[stratum][j] = 1.0 - scale + scale * draws.get((stratum, j), 0) * len(units) / (len(units)-1.0)
+        values.append(statistics(factors))
+    if not values:
+        return []
+
+    tail = (1.0 - confidence) / 2
+    low = int(math.floor(tail * (len(values)-1)))
+    high = int(math.ceil((1.0 - tail) * (len(values)-1)))
+    intervals = []
+    for statistic_values in zip(*values):
+        statistic_values = sorted(statistic_values)
+        intervals.append((statistic_values[low], statistic_values[high]))
+    return intervals
+
+
+def get_bootstrap_groups(sizes):
+    '''
+    This method takes as input a hash of strata (as returned by get_stratum()) mapped to (sampled patients, patients) 2-tuples, and returns a list of lists of strata, the groups within which get_bootstrap_intervals() resamples. Strata are taken in order of gold status and then note volume, and each is added to the group before it until that group has at least 2 sampled patients, so a stratum with fewer than 2 sampled patients is collapsed with its neighbours of the next (or, at the end, the previous) volume. Collapsing strata can only widen the intervals.
+    '''
+    groups = []
+    group = []
+    for stratum in sorted(sizes, key=lambda stratum: (repr(stratum[1]), stratum[0] if stratum[0] is not None else -1)):
+        group.append(stratum)
+        if sum([sizes[grouped][0] for grouped in group]) >= 2:
+            groups.append(group)
+            group = []
+    if group:
+        if groups:
+            groups[-1].extend(group)
+        else:
+            groups.append(group)
+    return groups
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+'''
+This module lets extract_events.py process patients in several worker processes without pickling note text to the workers.
+
+The texts of all the notes are encoded as UTF-8 into a single multiprocessing.shared_memory block, followed by a table of the offset of each note in the block (see SharedCorpus). Notes are laid out patient by patient, so each work item is just an MRN and the range of its notes in the table. Each worker attaches to the block once, reads the text of a patient's notes directly out of the shared buffer, and sends back only compact (date expression, score, snippets) tuples (see extract_events.get_output_rows()), from which the parent formats the output lines.
+'''
+
+import logging
+from array import array
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+from date import set_date_matcher
+from extract_events import ClinicNote, KeywordIndex, KeywordPrefilter, PatientStats, extract_events, get_output_rows
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.WARNING)
+
+# State of a worker process, set once by init_worker()
+_worker = {}
+
+
+class SharedCorpus(object):
+    '''
+    A SharedCorpus holds the text of a set of patients' notes in a shared memory block. It has attributes 'shm' (the SharedMemory object), 'offsets_start' (the position in the block at which the offset table starts), 'count' (the number of notes), 'dates' and 'descs' (lists of the creation dates and descriptions of the notes, in the order of the block), and 'ranges' (a list of (MRN, first note, last note + 1) 3-tuples, one per patient, in the order the patients were given).
+    The offset table holds count+1 64-bit ints: the text of note i is the UTF-8 bytes between offsets i and i+1.
+    NB: The block must be released with close(), which also removes it from the system.
+    '''
+    def __init__(self, notes_dict, MRNs=None):
+        if MRNs is None:
+            MRNs = sorted(notes_dict)
+
+        encoded = []
+        offsets = array('q', [0])
+        self.dates = []
+        self.descs = []
+        self.ranges = []
+        for MRN in MRNs:
+            first = len(self.dates)
+            for note in notes_dict[MRN]:
+                data = note.text.encode('utf-8')
+                encoded.append(data)
+                offsets.append(offsets[-1] + len(data))
+                self.dates.append(note.date)
+                self.descs.append(note.desc)
+            self.ranges.append((MRN, first, len(self.dates)))
+        self.count = len(self.dates)
+
+        # The offset table is aligned so that workers can view it as an array of ints without copying it
+        self.offsets_start = (offsets[-1] + 7) // 8 * 8
+        self.shm = SharedMemory(create=True, size=self.offsets_start + offsets.itemsize*len(offsets))
+        buffer = self.shm.buf
+        position = 0
+        for data in encoded:
+            buffer[position:position+len(data)] = data
+            position += len(data)
+        buffer[self.offsets_start:self.offsets_start + offsets.itemsize*len(offsets)] = offsets.tobytes()
+        del buffer
+
+    def __repr__(self):
+        return "shared corpus %s: %s patients, %s notes, %s bytes" % (self.shm.name, len(self.ranges), self.count, self.shm.size)
+
+    def close(self):
+        '''
+        This method releases the shared memory block and removes it from the system.
+        '''
+        self.shm.close()
+        self.shm.unlink()
+
+
+def attach_shared_memory(name):
+    '''
+    This method takes as input the name of an existing shared memory block and returns a SharedMemory object attached to it, without having the worker take over the block's cleanup.
+    '''
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13, attaching registers the block with the resource tracker. Workers share the parent's tracker, which keeps one entry per block, so this is harmless; the entry is removed when the parent unlinks the block.
+        return SharedMemory(name=name)
+
+
+def init_worker(name, offsets_start, count, dates, descs, keywords_list, filter, n, verbose, date_matcher='ordered', limits=None, copy_forward=None):
+    '''
+    This method is run once in each worker process. It takes as input the name of the shared memory block, the position and length of its offset table, the creation dates and descriptions of the notes, a list of Keyword objects, a minimum score, a minimum number of dates, a boolean specifying whether snippets are kept, the date matcher backend (see date.set_date_matcher()), an optional ExtractionLimits object, and an optional CopyForwardPolicy, and stores what extract_patient() needs.
+    '''
+    shm = attach_shared_memory(name)
+    _worker['shm'] = shm
+    _worker['text'] = shm.buf[:offsets_start]
+    _worker['offsets'] = shm.buf[offsets_start:offsets_start + 8*(count+1)].cast('q')
+    _worker['dates'] = dates
+    _worker['descs'] = descs
+    _worker['keyword_index'] = KeywordIndex(keywords_list)
+    _worker['prefilter'] = KeywordPrefilter(_worker['keyword_index'].keywords)
+    _worker['filter'] = filter
+    _worker['n'] = n
+    _worker['verbose'] = verbose
+    _worker['limits'] = limits
+    _worker['copy_forward'] = copy_forward
+    set_date_matcher(date_matcher)
+
+
+def extract_patient(item):
+    '''
+    This method is run in a worker process. It takes as input an (MRN, first note, last note + 1) 3-tuple and returns a 5-tuple of the MRN, the list of (date expression, score, snippets) 3-tuples for the patient (see extract_events.get_output_rows()), the number of notes checked and skipped by the keyword prefilter, and the PatientStats object for the patient.
+    '''
+    MRN, first, last = item
+    text = _worker['text']
+    offsets = _worker['offsets']
+    dates = _worker['dates']
+    descs = _worker['descs']
+    prefilter = _worker['prefilter']
+
+    notes = [ClinicNote(dates[i], descs[i], str(text[offsets[i]:offsets[i+1]], 'utf-8')) for i in range(first, last)]
+    notes_seen = prefilter.notes_seen
+    notes_skipped = prefilter.notes_skipped
+    stats = PatientStats()
+    candidates = extract_events(notes, _worker['keyword_index'], _worker['filter'], _worker['n'], prefilter, _worker['limits'], stats, _worker['copy_forward'])
+
+    return (MRN, get_output_rows(candidates, _worker['verbose']), prefilter.notes_seen-notes_seen, prefilter.notes_skipped-notes_skipped, stats)
+
+
+def extract_events_parallel(notes_dict, MRNs, keywords_list, filter=0.0, n=0, verbose=False, processes=2, date_matcher='ordered', limits=None, copy_forward=None, chunksize=16):
+    '''
+    This method takes as input a hash of MRNs mapped to lists of ClinicNote objects, the list of MRNs to process, a list of Keyword objects, a minimum score, a minimum number of dates, a boolean specifying whether snippets are kept, a number of worker processes, a date matcher backend, an optional ExtractionLimits object, an optional CopyForwardPolicy, and the number of patients sent to a worker at a time. It generates, in the order of MRNs, the 5-tuples returned by extract_patient().
+    '''
+    corpus = SharedCorpus(notes_dict, MRNs)
+    LOG.debug("Created %s" % corpus)
+    try:
+        pool = Pool(processes, init_worker, (corpus.shm.name, corpus.offsets_start, corpus.count, corpus.dates, corpus.descs, keywords_list, filter, n, verbose, date_matcher, limits, copy_forward))
+        try:
+            for result in pool.imap(extract_patient, corpus.ranges, chunksize):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        corpus.close()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+'''
+This script checks that extraction with the 'all' copy-forward policy (see extract_events.CopyForwardPolicy) gives exactly the same output as extraction without a policy, on a small corpus of copy-forwarded notes generated from a fixed seed. It can be run with python3 or with pytest.
+'''
+
+import random
+import unittest
+from extract_events import ClinicNote, CopyForwardPolicy, ExtractionLimits, Keyword, KeywordIndex, PatientStats, extract_events, format_output_line
+
+KEYWORDS = [Keyword('surgery', 'PRE-DATE', 40, 2.0), Keyword('admitted', 'POST-DATE', 40, 1.5), Keyword('diagnosed with', 'POST-DATE', 60, 1.0), Keyword('biopsy', 'PRE-DATE', 30, 0.5)]
+
+# Sentences with the keywords next to absolute, two-digit-year, and relative dates, and with snippet boundaries (commas and colons) that the keyword windows can reach past the period
+SENTENCES = ['Note from 2005: admitted to ICU.', 'Follow up.', 'surgery on 3/12/2004.', "surgery in June '98.", 'biopsy 2 weeks ago.', 'Seen 3 days ago and admitted.', 'diagnosed with cancer in 2001.', 'surgery: see below.', 'Plan: biopsy last month: pending.', 'Stable, admitted.', 'No change', 'diagnosed with anemia.']
+
+
+def get_patients(count, seed=0):
+    '''
+    This method takes as input a number of patients and a seed, and returns a list of lists of ClinicNote objects, one per patient, in which each note copies forward the text of the one before it, in part or in full, and adds new sentences.
+    '''
+    generator = random.Random(seed)
+    patients = []
+    for k in range(count):
+        notes = []
+        text = ''
+        for i in range(generator.randint(1, 6)):
+            if generator.random() < 0.3:
+                # Text copied from the middle of the previous note, with a different start
+                text = text[generator.randint(0, len(text)):]
+            text = (text + ' ' + ' '.join([generator.choice(SENTENCES) for j in range(generator.randint(1, 4))])).strip()
+            notes.append(ClinicNote('20%02d-%02d-01' % (generator.randint(0, 15), generator.randint(1, 12)), 'Note', text))
+        if generator.random() < 0.5:
+            notes.reverse()
+        patients.append(notes)
+    # The two orders of the same pair of notes, whose repeated sentence sits at a different offset in each
+    patients.append([ClinicNote('2010-01-01', 'Note', 'Note from 2005: admitted to ICU.'), ClinicNote('2010-02-01', 'Note', 'Follow up. Note from 2005: admitted to ICU.')])
+    patients.append([ClinicNote('2010-01-01', 'Note', 'Follow up. Note from 2005: admitted to ICU.'), ClinicNote('2010-02-01', 'Note', 'Note from 2005: admitted to ICU.')])
+    return patients
+
+
+def get_output(patients, copy_forward=None, limits=None, verbose=False):
+    '''
+    This method takes as input a list of lists of ClinicNote objects, an optional CopyForwardPolicy, an optional ExtractionLimits object, and a boolean specifying whether snippets are kept, and returns the list of the output lines and the list of the (keyword hits, flags) 2-tuples of the patients' PatientStats.
+    '''
+    keyword_index = KeywordIndex(KEYWORDS)
+    lines = []
+    stats_list = []
+    for k, notes in enumerate(patients):
+        stats = PatientStats()
+        lines.append(format_output_line('P%03d' % k, extract_events(notes, keyword_index, 0.0, 0, None, limits, stats, copy_forward), verbose))
+        stats_list.append((stats.hits, stats.flags))
+    return (lines, stats_list)
+
+
+class CopyForwardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.patients = get_patients(60)
+
+    def test_all_policy_output_is_unchanged(self):
+        for verbose in [False, True]:
+            self.assertEqual(get_output(self.patients, None, None, verbose), get_output(self.patients, CopyForwardPolicy('all'), None, verbose))
+
+    def test_all_policy_output_is_unchanged_with_limits(self):
+        for limits in [ExtractionLimits(max_hits_per_note=2), ExtractionLimits(max_hits_per_patient=5), ExtractionLimits(3, 8)]:
+            self.assertEqual(get_output(self.patients, None, limits), get_output(self.patients, CopyForwardPolicy('all'), limits))
+
+
+if __name__=='__main__':
+    unittest.main()
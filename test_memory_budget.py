@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+'''
+This script checks that the memory used by extraction and evaluation grows by no more than a fixed budget per note, on the notes, keywords, and gold data in the fixtures directory (see memory_report.py). The growth per note is measured between a run over every other patient and a run over all of them, so that costs that do not depend on the number of notes are left out. It can be run with python3 or with pytest.
+'''
+
+import os
+import unittest
+from extract_events import KeywordIndex, KeywordPrefilter, get_keywords_list
+from memory_report import get_MRNs, get_growth_per_note, profile_stages
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+NOTES_FILENAME = os.path.join(FIXTURES, 'memory_notes.txt')
+KEYWORDS_FILENAME = os.path.join(FIXTURES, 'memory_keywords.txt')
+GOLD_DATA_FILENAME = os.path.join(FIXTURES, 'memory_gold.txt')
+
+# Peak traced bytes per added note; the fixtures grow by about 3600 (3800 with snippets kept)
+BYTES_PER_NOTE = 5000
+
+
+class MemoryBudgetTest(unittest.TestCase):
+
+    def setUp(self):
+        keywords_file = open(KEYWORDS_FILENAME)
+        self.keyword_index = KeywordIndex(get_keywords_list(keywords_file))
+        keywords_file.close()
+        self.prefilter = KeywordPrefilter(self.keyword_index.keywords)
+        self.MRNs = set(get_MRNs(NOTES_FILENAME)[::2])
+
+    def get_growth_per_note(self, verbose):
+        # A first run pays the costs that are only paid once per process, such as compiling regexes on first use
+        profile_stages(NOTES_FILENAME, self.keyword_index, self.prefilter, verbose=verbose, gold_data_filename=GOLD_DATA_FILENAME, MRNs=self.MRNs)
+        smaller = profile_stages(NOTES_FILENAME, self.keyword_index, self.prefilter, verbose=verbose, gold_data_filename=GOLD_DATA_FILENAME, MRNs=self.MRNs)
+        larger = profile_stages(NOTES_FILENAME, self.keyword_index, self.prefilter, verbose=verbose, gold_data_filename=GOLD_DATA_FILENAME)
+        return get_growth_per_note(smaller, larger)
+
+    def test_growth_per_note_is_within_budget(self):
+        self.assertLess(self.get_growth_per_note(False), BYTES_PER_NOTE)
+
+    def test_growth_per_note_with_snippets_is_within_budget(self):
+        self.assertLess(self.get_growth_per_note(True), BYTES_PER_NOTE)
+
+
+if __name__=='__main__':
+    unittest.main()